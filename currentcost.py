@@ -25,6 +25,7 @@
 import os
 import sys
 import getopt
+import atexit
 import logging
 import urllib
 import urllib2
@@ -41,6 +42,7 @@ import time
 import datetime
 import webbrowser
 import serial
+import Queue
 
 
 from googleappengine           import GoogleAppEngine
@@ -53,6 +55,7 @@ from currentcostlivedata       import CurrentCostLiveData
 from currentcosthistorydata    import CurrentCostHistoryData
 from currentcostparser         import CurrentCostDataParser
 from currentcostserialconn     import CurrentCostConnection
+from currentcostserialreader   import getSerialReader
 from tracer                    import CurrentCostTracer
 
 from matplotlib.dates import DayLocator, HourLocator, MonthLocator, YearLocator, WeekdayLocator, DateFormatter, drange
@@ -106,8 +109,10 @@ from matplotlib.text import Text
 #                                     GUI's menus and their actions
 #   currentcostserialconn.py     - makes a serial connection to a CurrentCost
 #                                     meter
-#   currentcostdata.py           - represents data contained in a single 
-#                                     update from a CurrentCost meter
+#   currentcostserialreader.py   - reads data from a serial connection for
+#                                     the live and history connections
+#   currentcostdata.py           - decodes history data received via MQTT 
+#                                     into arrays
 #   currentcostparser.py         - CurrentCost XML data parser used when 
 #                                     receiving data over serial connection
 #   currentcostdataconvert.py    - used by XML parser to convert relative 
@@ -126,6 +131,8 @@ from matplotlib.text import Text
 #   currentcostlivedata.py       - draws tab to display a graph of live data
 #   currentcostmqttlive.py       - downloads live data for the live graph 
 #                                     from a remote CurrentCost meter via MQTT
+#   currentcostlivebatcher.py    - passes live readings to the live graph in
+#                                     batches, one per frame
 #   currentcostcomlive.py        - downloads live data for the live graph 
 #                                     from a CurrentCost meter
 #   currentcosthistorydata       - implements a download manager to handle 
@@ -136,6 +143,28 @@ from matplotlib.text import Text
 #                                     all updates in background 
 #   nationalgriddata.py          - downloads live national electricity usage 
 #                                     data from the National Grid realtime feed
+#   gridfueltypes.py             - the fuel types used to generate grid 
+#                                     electricity, and their carbon intensity
+#   currentcostreports.py        - renders graphs of CurrentCost data to 
+#                                     image files, without a GUI
+#   import-data-envir.py         - logs data from a CurrentCost meter to a 
+#                                     data file, without a GUI
+#   currentcostsimulator.py      - simulates a CurrentCost meter on a 
+#                                     pseudo-terminal, for testing
+#   currentcostmqttbroker.py     - a local MQTT broker and publisher of 
+#                                     CurrentCost data, for testing
+#   currentcostmqttpackets.py    - encodes and decodes the MQTT packets used
+#                                     by the session and the test broker
+#   currentcostmqttsession.py    - a connection to an MQTT broker which 
+#                                     reconnects if it is lost
+#   currentcostmqttpublish.py    - republishes data from a CurrentCost meter 
+#                                     to an MQTT broker
+#   currentcostwebfetch.py       - downloads National Grid data on a schedule,
+#                                     only passing on data which has changed
+#   currentcostgridstore.py      - stores National Grid data in the database
+#                                     in batches, on a background thread
+#   currentcostbenchmarks.py     - measures the performance of parts of the 
+#                                     code, such as parsing CurrentCost XML
 #   tracer.py                    - very simple tracing functionality
 # 
 # 
@@ -161,6 +190,10 @@ frame = None
 # target lines drawn on the different graphs
 targetlines = {}
 
+# data retrieved from the database to draw graphs, shared by the different 
+#  tabs. 'version' identifies the version of the database it came from
+graphdata = { 'version' : None }
+
 # the interface that we add tabs to
 plotter = None
 
@@ -425,6 +458,7 @@ class MyFrame(wx.Frame):
 
         progDlg.Update(2)
         livedataagent.disconnect()
+        livedataagent.closeGridData()
 
         progDlg.Update(3)
         historydataagent.disconnect()
@@ -890,6 +924,7 @@ class MyFrame(wx.Frame):
                     time.sleep(1)
                     (tocontinue, toskip) = dialog.Update(7, "Waiting for data")
                     if tocontinue == False:
+                        mqttClient.Disconnect()
                         dialog.Destroy()
                         return
 
@@ -898,7 +933,7 @@ class MyFrame(wx.Frame):
                 ccfuncs = CurrentCostDataFunctions()
 
                 dialog.Update(9, "Parsing data from message broker")
-                ccfuncs.ParseCurrentCostXML(ccdb, mqttupd)
+                ccfuncs.StoreHistoryUpdates(ccdb, mqttupd)
 
                 dialog.Update(10, "Drawing graphs")
                 drawMyGraphs(self, dialog, False)
@@ -924,28 +959,12 @@ class MyFrame(wx.Frame):
 
 
     #
-    # MQTT support requires the use of a third-party Python module, which I 
-    #  am not able to re-distribute.
-    # 
-    # The user is required to obtain this module for themselves. This function
-    #  checks for the presence of this module.
+    # MQTT support used to require the use of a third-party Python module, 
+    #  which the user had to obtain for themselves. MQTT connections are now
+    #  made by currentcostmqttsession, so support is always available.
     # 
     def IsMQTTSupportAvailable(self):
-        # location of the executable. we need a third-party MQTT module to 
-        #  provide the ability to subscribe to an MQTT topic, and we want to 
-        #  look for this in the same directory where the application is stored
-        currentdir = sys.path[0]
-
-        # special case : py2exe-compiled apps store the zip in a different place
-        if os.path.basename(currentdir) == "library.zip":
-            currentdir = os.path.join(currentdir, "..")
-
-        # location of the MQTT module
-        pythonmodule = os.path.join(currentdir, "mqttClient.py")
-    
-        # check if the MQTT client Python module file exists
-        #  if not, then it is likely that we do not have MQTT support
-        return os.path.isfile(pythonmodule)
+        return True
 
 
 
@@ -1081,7 +1100,7 @@ class MyFrame(wx.Frame):
                     # (the only exception to this is that it will close the connection
                     #  in the event of an error, so we do not need to do this explicitly)
                     trc.Trace("connecting to serial port")
-                    myserialconn.connect(newcom)
+                    connectToMeter(newcom)
                 except serial.SerialException, msg:
                     trc.Error("Failed to connect to CurrentCost meter")
                     trc.Error("SerialException: " + str(msg))
@@ -1304,6 +1323,7 @@ class MyFrame(wx.Frame):
 
         if reuseconnection == True:
             # create a live data connection
+            myserialconn.meterid = None
             livedataagent.connect(self, livedataagent.CONNECTION_SERIAL, ccdb,
                                   self.liveaxes, 
                                   None, None, 
@@ -1318,14 +1338,31 @@ class MyFrame(wx.Frame):
             # get information from the user required to establish the connection
             #  prefill with setting from database if possible
             #
-            dlg = wx.TextEntryDialog(self, 'Specify the COM port to connect to:','CurrentCost')
-            lastcom = ccdb.RetrieveSetting("comport")
+            dlg = wx.TextEntryDialog(self, 'Specify the COM port to connect to:\n' + 
+                                           '(to show data from several meters, separate their ports with commas)',
+                                     'CurrentCost')
+            # the list of ports is stored separately from "comport" which is 
+            #  also used when downloading history data from a single meter
+            lastcom = ccdb.RetrieveSetting("livecomports")
+            if not lastcom:
+                lastcom = ccdb.RetrieveSetting("comport")
             if lastcom:
                 dlg.SetValue(lastcom)
             if dlg.ShowModal() == wx.ID_OK:
                 newcom = dlg.GetValue()
-                if lastcom != newcom:
-                    ccdb.StoreSetting("comport", newcom)
+
+                # each meter is identified on the graph by its port
+                ports = [ port.strip() for port in newcom.split(',') if port.strip() != '' ]
+                if lastcom != newcom and len(ports) > 0:
+                    ccdb.StoreSetting("livecomports", newcom)
+                    ccdb.StoreSetting("comport", ports[0])
+                serialconns = [ myserialconn ]
+                if len(ports) > 1:
+                    myserialconn.meterid = ports[0]
+                    for port in ports[1:]:
+                        serialconns.append(CurrentCostConnection(port))
+                else:
+                    myserialconn.meterid = None
     
                 try:
                     # connect to the CurrentCost meter
@@ -1338,8 +1375,11 @@ class MyFrame(wx.Frame):
                     # catch and handle these ourselves
                     # (the only exception to this is that it will close the connection
                     #  in the event of an error, so we do not need to do this explicitly)
-                    myserialconn.connect(newcom)
+                    for i in range(len(ports)):
+                        connectToMeter(ports[i], serialconns[i])
                 except serial.SerialException, msg:
+                    for serialconn in serialconns:
+                        serialconn.disconnect()
                     errdlg = wx.MessageDialog(None,
                                               'Serial Exception: ' + str(msg),
                                               'Failed to connect to CurrentCost meter',
@@ -1350,6 +1390,8 @@ class MyFrame(wx.Frame):
                     self.MENU_LIVE.Check(self.MENU_LIVE_MQTT, False)
                     return False
                 except:
+                    for serialconn in serialconns:
+                        serialconn.disconnect()
                     errdlg = wx.MessageDialog(None,
                                               'CurrentCost',
                                               'Failed to connect to CurrentCost meter',
@@ -1361,10 +1403,12 @@ class MyFrame(wx.Frame):
                     return False
     
                 # create a new connection
+                if len(serialconns) == 1:
+                    serialconns = myserialconn
                 livedataagent.connect(self, livedataagent.CONNECTION_SERIAL, ccdb,
                                       self.liveaxes, 
                                       None, None, 
-                                      myserialconn)
+                                      serialconns)
                 
                 # update the GUI to show what the user has selected
                 self.MENU_LIVE.Check(self.MENU_LIVE_COM,  True)
@@ -1752,23 +1796,20 @@ class MyFrame(wx.Frame):
         return False
 
 
-    def displayUsageTarget(self):
+    #
+    # draw target lines on the graphs
+    # 
+    #  if axes is provided, the target is only drawn on that graph. redraw can
+    #   be set to False if the graph will be redrawn afterwards
+    # 
+    def displayUsageTarget(self, axes=None, redraw=True):
         global ccdb, ccvis, targetlines
     
         annualtarget = ccdb.RetrieveSetting("annualtarget")
         annualtargetfloat = float(annualtarget)
         kwhcost = self.getKWHCost(False)
 
-        # what unit are we using to plot?
-        #  we internally store everything in kWh, so if we want to display it in 
-        #   another unit, we need to know what to multiply the kWh by to get the 
-        #   value for displaying
-        kwhfactor = 1
-        graphUnit = ccdb.RetrieveSetting("graphunits")
-        if graphUnit == ccvis.GRAPHUNIT_KEY_GBP:
-            kwhfactor = float(kwhcost)
-        elif graphUnit == ccvis.GRAPHUNIT_KEY_CO2:
-            kwhfactor = float(self.getKgCO2PerKWh(False))
+        kwhfactor = getKWHFactor(self)
 
         # recap:
         # annualtargetfloat -  to spend in a year
@@ -1779,31 +1820,18 @@ class MyFrame(wx.Frame):
         dailykwh   = annualkwh / 365
         hourlykwh  = annualkwh / 4380
 
-        try:
-            targetlines[self.axes1] = ccvis.DrawTargetLine(hourlykwh, self.axes1, kwhfactor)
-        except:
-            # noop
-            i = 0
-        try:
-            targetlines[self.axes2] = ccvis.DrawTargetLine(dailykwh, self.axes2, kwhfactor)
-        except:
-            # noop
-            i = 0
-        try:
-            targetlines[self.axes3] = ccvis.DrawTargetLine(monthlykwh, self.axes3, kwhfactor)
-        except:
-            # noop
-            i = 0    
-        try:
-            targetlines[self.axes4] = ccvis.DrawTargetLine(hourlykwh, self.axes4, kwhfactor)
-        except:
-            # noop
-            i = 0    
-        try:
-            targetlines[self.axes5] = ccvis.DrawTargetLine(dailykwh, self.axes5, kwhfactor)
-        except:
-            # noop
-            i = 0    
+        targets = [ (self.axes1, hourlykwh),
+                    (self.axes2, dailykwh),
+                    (self.axes3, monthlykwh),
+                    (self.axes4, hourlykwh),
+                    (self.axes5, dailykwh) ]
+        for targetaxes, targetkwh in targets:
+            if axes == None or axes == targetaxes:
+                try:
+                    targetlines[targetaxes] = ccvis.DrawTargetLine(targetkwh, targetaxes, kwhfactor, redraw)
+                except:
+                    # noop
+                    i = 0
 
     #
     # redraw the graphs to use kWh as a unit in the graph
@@ -1885,15 +1913,43 @@ class MyFrame(wx.Frame):
 # GLOBAL FUNCTIONS
 # 
 
+#
+# connect to a CurrentCost meter on the given serial port
+# 
+#  the baud rate that works is remembered in the settings, so that next time
+#   it can be tried first when detecting the type of meter
+# 
+#  uses the app's main serial connection, unless another is provided (e.g. 
+#   to read from more than one meter at a time)
+# 
+def connectToMeter(portdet, serialconn=None):
+    global ccdb, myserialconn, trc
+    trc.FunctionEntry("connectToMeter")
+
+    if serialconn == None:
+        serialconn = myserialconn
+
+    lastbaudrate = None
+    try:
+        lastbaudrate = int(ccdb.RetrieveSetting("combaudrate"))
+    except (TypeError, ValueError):
+        trc.Trace("no valid baud rate setting stored")
+
+    serialconn.connect(portdet, lastbaudrate)
+
+    if serialconn.baudrate != None and serialconn.baudrate != lastbaudrate:
+        ccdb.StoreSetting("combaudrate", str(serialconn.baudrate))
+
+    trc.FunctionExit("connectToMeter")
+
+
 def getDataFromCurrentCostMeter(portdet, dialog):
     global ccdb, myparser, myserialconn, trc
     trc.FunctionEntry("getDataFromCurrentCostMeter")
     # 
     dialog.Update(0, 'Connecting to local CurrentCost meter - using device "' + portdet + '"')
 
-    # if already connected, we:
-    #  a) do not need to connect now
-    #  b) should not disconnect once complete
+    # if already connected, we do not need to connect now
     reuseconnection = myserialconn.isConnected()
 
     if reuseconnection == False:
@@ -1908,7 +1964,7 @@ def getDataFromCurrentCostMeter(portdet, dialog):
             # catch and handle these ourselves
             # (the only exception to this is that it will close the connection 
             #  in the event of an error, so we do not need to do this explicitly)
-            myserialconn.connect(portdet)
+            connectToMeter(portdet)
         except serial.SerialException, msg:
             trc.Error("Failed to receive data from CurrentCost meter")
             trc.Error("SerialException: " + str(msg))
@@ -1928,9 +1984,13 @@ def getDataFromCurrentCostMeter(portdet, dialog):
             trc.FunctionExit("getDataFromCurrentCostMeter")
             return False
 
-    # we keep trying to get an update from the CurrentCost meter
-    #  until we successfully populate the CurrentCost data object
-    currentcoststruct = None
+    # the shared reader owns the serial port - we subscribe to it for as long
+    #  as we are downloading, so that anything else using the meter (e.g. the
+    #  live graph) keeps receiving its data, and the port is closed when we 
+    #  unsubscribe if nothing else is using it
+    subscriber = CurrentCostDownloadSubscriber()
+    reader = getSerialReader(myserialconn)
+    reader.addSubscriber(subscriber)
 
     # the newer CC128 meter splits the history data over multiple updates
     # we use this number to indicate how many updates are remaining
@@ -1942,84 +2002,46 @@ def getDataFromCurrentCostMeter(portdet, dialog):
 
     loopMessage = "Waiting for data from CurrentCost meter"
 
-    while updatesremaining > 0:
-        (tocontinue, toskip) = dialog.Update(1, loopMessage)
-        if tocontinue == False:
-            if reuseconnection == False:
+    try:
+        while updatesremaining > 0:
+            (tocontinue, toskip) = dialog.Update(1, loopMessage)
+            if tocontinue == False:
                 loopMessage = "User cancelled. Closing connection to CurrentCost meter"
                 trc.Trace(loopMessage)
                 dialog.Update(10, loopMessage)
-                myserialconn.disconnect()
-            dialog.Update(11, 'Cancelled.')
-            trc.FunctionExit("getDataFromCurrentCostMeter")
-            return False
-
-        # line of data received from serial port
-        line = ""
-
-        while len(line) == 0:
-            try:
-                line = myserialconn.readUpdate()
-            except serial.SerialException, err:
-                trc.Error("Failed to receive data from CurrentCost meter")
-                trc.Error("SerialException: " + str(msg))
-                dialog.Update(11, 'Failed to receive data from CurrentCost meter')
-                errdlg = wx.MessageDialog(None,
-                                          'Serial Exception: ' + str(err),
-                                          'Failed to receive data from CurrentCost meter', 
-                                          style=(wx.OK | wx.ICON_EXCLAMATION))
-                errdlg.ShowModal()        
-                errdlg.Destroy()
+                dialog.Update(11, 'Cancelled.')
                 trc.FunctionExit("getDataFromCurrentCostMeter")
                 return False
-            except Exception, msg:
+
+            # wait for something from the reader - waking up regularly so 
+            #  that the user can cancel
+            try:
+                event, data = subscriber.events.get(True, subscriber.POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+
+            if event == subscriber.READER_ERROR:
                 trc.Error("Failed to receive data from CurrentCost meter")
-                trc.Error("Exception: " + str(msg))
+                trc.Error("Exception: " + str(data))
                 dialog.Update(11, 'Failed to receive data from CurrentCost meter')
                 errdlg = wx.MessageDialog(None,
-                                          'Exception: ' + str(msg),
+                                          'Exception: ' + str(data),
                                           'Failed to receive data from CurrentCost meter', 
                                           style=(wx.OK | wx.ICON_EXCLAMATION))
                 errdlg.ShowModal()        
                 errdlg.Destroy()
                 trc.FunctionExit("getDataFromCurrentCostMeter")
                 return False
-
-        trc.Trace("received line of XML from CurrentCost meter. about to parse")
-
-        # try to parse the XML
-        currentcoststruct = myparser.parseCurrentCostXML(line)
-
-        if currentcoststruct == None:
-            # something wrong with the line of xml we received
-            invalidUpdates += 1
-            loopMessage = datetime.datetime.now().strftime("%H:%M:%S") + \
-                          " : Received " + \
-                          str(validHistoryUpdates) + " updates with history data, " + \
-                          str(validLiveUpdates) + " updates with live (no history) data \n" + \
-                          str(invalidUpdates) + " invalid updates"
-            dialog.Update(1, loopMessage)
-            trc.Trace("Received data that could not be parsed")
-        elif 'hist' not in currentcoststruct['msg']:
-            # we received something which looked like valid CurrentCost data,
-            #  but did not contain any history data
-            # this means, either:
-            #  a) something wrong - we need to wait for history data
-            #  b) (CC128-only) the meter has finished outputting it's series of
-            #        history updates, and has gone back to outputting live data
-            #        in which case we have finished and need to break out of 
-            #        the loop we are in
-            trc.Trace("received (valid?) CurrentCost data without any history data")
-            validLiveUpdates += 1
-
-            loopMessage = datetime.datetime.now().strftime("%H:%M:%S") +  \
-                          " : Received " + \
-                          str(validHistoryUpdates) + " updates with history data, " + \
-                          str(validLiveUpdates) + " updates with live (no history) data \n" + \
-                          str(invalidUpdates) + " invalid updates"
-            #loopMessage = datetime.datetime.now().strftime("%H:%M:%S") + " : Received data from CurrentCost meter (live only, no history information)"
-
-            if type(currentcoststruct['msg']['src']) is unicode and currentcoststruct['msg']['src'].startswith('CC128-v0.'):
+            elif event == subscriber.FRAME_ERROR:
+                # something wrong with the line of xml we received
+                invalidUpdates += 1
+                trc.Trace("Received data that could not be parsed")
+            elif event == subscriber.LIVE_READING:
+                validLiveUpdates += 1
+            elif event == subscriber.HISTORY_FINISHED:
+                # the meter has finished outputting its series of history 
+                #  updates, and has gone back to outputting live data
+                # 
                 # HACK!
                 # this may or may not be true - there is a potential that a 
                 # CC128 meter returned us some data (e.g. broken or partial XML)
@@ -2031,59 +2053,128 @@ def getDataFromCurrentCostMeter(portdet, dialog):
                 # for now, we just assume that when the meter stops outputting 
                 # history, then it has finished correctly
                 # probably something to come back to at a future date!
-                trc.Trace("live data received from CC128. assuming that there is no history data remaining")
+                trc.Trace("live data received after history. assuming that there is no history data remaining")
                 if validHistoryUpdates > 0:
                     updatesremaining = 0
-                dialog.Update(1, loopMessage)
             else:
-                dialog.Update(1, loopMessage) # 'Waiting for history data from CurrentCost meter')
-                trc.Trace("waiting for history data")
-        else:
-            # we have received history data - parse and store the CurrentCost 
-            #  data in the datastore
-            # the parser will return the number of updates still expected 
-            #  (0 if this was the last or only expected update)
-            updatesremaining = myparser.storeTimedCurrentCostData(ccdb)
-            trc.Trace("stored history data. think there are now " + str(updatesremaining) + " updates remaining")
-            validHistoryUpdates += 1
+                # we have received history data - store the CurrentCost 
+                #  data in the datastore
+                # the parser will return the number of updates still expected 
+                #  (0 if this was the last or only expected update)
+                updatesremaining = myparser.storeTimedCurrentCostData(ccdb, data)
+                trc.Trace("stored history data. think there are now " + str(updatesremaining) + " updates remaining")
+                validHistoryUpdates += 1
+
             loopMessage = datetime.datetime.now().strftime("%H:%M:%S") + \
                           " : Received " + \
                           str(validHistoryUpdates) + " updates with history data, " + \
-                          str(validLiveUpdates) + " updates with live (no history) data \n" + \
+                          str(validLiveUpdates) + " updates with live data \n" + \
                           str(invalidUpdates) + " invalid updates"
+    finally:
+        # the serial port is closed once nothing else is using it
+        reader.removeSubscriber(subscriber)
 
     dialog.Update(2, 'Received complete history data from CurrentCost meter')
     #
-    if reuseconnection == False:
-        myserialconn.disconnect()    
-    #
     trc.FunctionExit("getDataFromCurrentCostMeter")
     return True
 
 
 #
-# redraw graphs on each of the tabs
+# receives data from the serial reader while getDataFromCurrentCostMeter
+#  downloads history data
 # 
-def drawMyGraphs(guihandle, dialog, changeaxesonly):
-    global ccdb, ccvis, trc
-    trc.FunctionEntry("drawMyGraphs")
+#  the reader calls us on its own thread, so events are queued for the GUI 
+#   thread to handle - as (event type, data) tuples
+# 
+class CurrentCostDownloadSubscriber():
+
+    HISTORY_RECEIVED = 'history'
+    HISTORY_FINISHED = 'finished'
+    LIVE_READING     = 'live'
+    FRAME_ERROR      = 'invalid'
+    READER_ERROR     = 'error'
+
+    # longest time (seconds) to wait for an event before checking whether the
+    #  user has cancelled
+    POLL_INTERVAL = 0.5
+
+    def __init__(self):
+        self.events = Queue.Queue()
+
+    def historyReceived(self, currentcoststruct):
+        self.events.put((self.HISTORY_RECEIVED, currentcoststruct))
+    def historyFinished(self):
+        self.events.put((self.HISTORY_FINISHED, None))
+    def liveReadingReceived(self, ccreading):
+        self.events.put((self.LIVE_READING, ccreading))
+    def frameError(self, line, err):
+        self.events.put((self.FRAME_ERROR, err))
+    def readerError(self, errmsg):
+        self.events.put((self.READER_ERROR, errmsg))
+
+
+#
+# what unit are we using to plot?
+#  we internally store everything in kWh, so if we want to display it in 
+#   another unit, we need to know what to multiply the kWh by to get the 
+#   value for displaying
+# 
+def getKWHFactor(guihandle):
+    global ccdb, ccvis
 
-    # what unit are we using to plot?
-    #  we internally store everything in kWh, so if we want to display it in 
-    #   another unit, we need to know what to multiply the kWh by to get the 
-    #   value for displaying
     kwhfactor = 1
     graphUnit = ccdb.RetrieveSetting("graphunits")
     if graphUnit == ccvis.GRAPHUNIT_KEY_GBP:
         kwhfactor = float(ccdb.RetrieveSetting("kwhcost"))
     elif graphUnit == ccvis.GRAPHUNIT_KEY_CO2:
         kwhfactor = float(guihandle.getKgCO2PerKWh(False))
+    return kwhfactor
 
-    hourDataCollection = ccdb.GetHourDataCollection()
-    dayDataCollection = ccdb.GetDayDataCollection()
-    monthDataCollection = ccdb.GetMonthDataCollection()
 
-    if len(hourDataCollection) == 0:
+#
+# returns data from the database needed to draw graphs
+# 
+#  data is cached, and only retrieved from the database again if the data in 
+#   the database has been modified since it was last retrieved
+# 
+def getGraphData(datakey):
+    global ccdb, graphdata
+
+    dataversion = ccdb.GetDataVersion()
+    if graphdata['version'] != dataversion:
+        graphdata = { 'version' : dataversion }
+
+    if datakey not in graphdata:
+        if datakey == 'hours':
+            graphdata[datakey] = ccdb.GetHourDataCollection()
+        elif datakey == 'days':
+            graphdata[datakey] = ccdb.GetDayDataCollection()
+        elif datakey == 'months':
+            graphdata[datakey] = ccdb.GetMonthDataCollection()
+        elif datakey == 'averageday':
+            graphdata[datakey] = CurrentCostDataFunctions().CalculateAverageDayFromDB(ccdb)
+        elif datakey == 'averageweek':
+            graphdata[datakey] = CurrentCostDataFunctions().CalculateAverageWeekFromDB(ccdb)
+
+    return graphdata[datakey]
+
+
+#
+# redraw graphs on each of the tabs
+# 
+#  tabs are drawn on demand - this identifies what the tabs should now be 
+#   showing, and redraws the tab that is currently displayed. other tabs are 
+#   redrawn when they are next displayed, if the data or units they show have 
+#   changed since they were last drawn
+# 
+#  changeaxesonly is True if only the units used on the graphs have changed
+# 
+def drawMyGraphs(guihandle, dialog, changeaxesonly):
+    global ccdb, ccvis, plotter, trc
+    trc.FunctionEntry("drawMyGraphs")
+
+    if ccdb.CountHourData() == 0:
         trc.Trace("Empty hour data collection")
         if dialog != None:
             dialog.Update(11, 'Data store initialised')
@@ -2091,141 +2182,156 @@ def drawMyGraphs(guihandle, dialog, changeaxesonly):
         return
 
     if dialog != None:
-        dialog.Update(3, 'Charting hourly electricity usage...')
-        trc.Trace("charting hourly electricity usage")
-    ccvis.PlotHourlyData(guihandle.axes1, hourDataCollection, kwhfactor)
-    for storednote in ccdb.RetrieveAnnotations(1):
-        ccvis.AddNote(storednote[0], # storednote[4], 
-                      guihandle.axes1, 
-                      storednote[1], 
-                      storednote[2], 
-                      storednote[5], 
-                      kwhfactor,
-                      "hours")        
+        dialog.Update(3, 'Charting electricity usage...')
+
+    # anything which affects what is drawn on the tabs needs to be included 
+    #  in the keys - tabs are redrawn when the render key changes, and have 
+    #  their units changed in place when only the rescale key changes
+    renderkey = (ccdb.GetDataVersion(), 
+                 ccdb.RetrieveSetting("enabletarget"),
+                 ccdb.RetrieveSetting("annualtarget"),
+                 ccdb.RetrieveSetting("kwhcost"))
+    rescalekey = (ccdb.RetrieveSetting("graphunits"), 
+                  getKWHFactor(guihandle))
+    plotter.refresh(renderkey, rescalekey)
 
     if dialog != None:
-        dialog.Update(4, 'Charting daily electricity usage...')
-        trc.Trace("charting daily electricity usage")
-    ccvis.PlotDailyData(guihandle.axes2, dayDataCollection, kwhfactor)
-    for storednote in ccdb.RetrieveAnnotations(2):
-        ccvis.AddNote(storednote[0], # storednote[4], 
-                      guihandle.axes2, 
-                      storednote[1], 
-                      storednote[2], 
-                      storednote[5], 
-                      kwhfactor,
-                      "days")        
+        dialog.Update(11, 'Complete')
 
-    if dialog != None:
-        dialog.Update(5, 'Charting monthly electricity usage...')
-        trc.Trace("charting monthly electricity usage")
-    ccvis.PlotMonthlyData(guihandle.axes3, monthDataCollection, kwhfactor)
-    for storednote in ccdb.RetrieveAnnotations(3):        
-        ccvis.AddNote(storednote[0], # storednote[4], 
-                      guihandle.axes3, 
-                      storednote[1], 
-                      storednote[2], 
-                      storednote[5], 
-                      kwhfactor,
-                      "months")        
+    trc.FunctionExit("drawMyGraphs")
 
-    ccdata = CurrentCostDataFunctions()
-    averageDayData = ccdata.CalculateAverageDay(hourDataCollection)
-    averageWeekData = ccdata.CalculateAverageWeek(dayDataCollection)
 
-    if changeaxesonly == False:
-        if dialog != None:
-            dialog.Update(6, 'Identifying electricity usage trends...')
-            trc.Trace("identifying usage trends")
-        ccvis.IdentifyTrends(guihandle.trendspg, hourDataCollection, dayDataCollection, monthDataCollection)
+#
+# renderers for each of the tabs - called by the PlotNotebook when the tab 
+#  is displayed, if it has changed since it was last drawn
+# 
 
-    if dialog != None:
-        dialog.Update(7, 'Charting an average day...')
-        trc.Trace("charting average day")
+def drawTrendsPage():
+    global frame, ccdb, ccvis, trc
+    trc.FunctionEntry("drawTrendsPage")
+
+    ccvis.IdentifyTrends(frame.trendspg, ccdb)
+    averageDayData = getGraphData('averageday')
     if averageDayData:
-        ccvis.PlotAverageDay(averageDayData, guihandle.axes4, guihandle.trendspg, kwhfactor)
+        ccvis.DescribeAverageDay(averageDayData, frame.trendspg)
+    averageWeekData = getGraphData('averageweek')
+    if averageWeekData:
+        ccvis.DescribeAverageWeek(averageWeekData, frame.trendspg)
+
+    trc.FunctionExit("drawTrendsPage")
+
+def drawHourlyGraph():
+    global frame, ccvis
+    kwhfactor = getKWHFactor(frame)
+    ccvis.PlotHourlyData(frame.axes1, getGraphData('hours'), kwhfactor)
+    drawAnnotations(frame.axes1, 1, "hours", kwhfactor)
+    completeGraph(frame.axes1, 'hourly')
+
+def drawDailyGraph():
+    global frame, ccvis
+    kwhfactor = getKWHFactor(frame)
+    ccvis.PlotDailyData(frame.axes2, getGraphData('days'), kwhfactor)
+    drawAnnotations(frame.axes2, 2, "days", kwhfactor)
+    completeGraph(frame.axes2, 'daily')
+
+def drawMonthlyGraph():
+    global frame, ccvis
+    kwhfactor = getKWHFactor(frame)
+    ccvis.PlotMonthlyData(frame.axes3, getGraphData('months'), kwhfactor)
+    drawAnnotations(frame.axes3, 3, "months", kwhfactor)
+    completeGraph(frame.axes3, 'monthly')
+
+def drawAverageDayGraph():
+    global frame, ccvis
+    averageDayData = getGraphData('averageday')
+    if averageDayData:
+        ccvis.PlotAverageDay(averageDayData, frame.axes4, None, getKWHFactor(frame))
+    completeGraph(frame.axes4, 'average day')
 
-    if dialog != None:    
-        dialog.Update(8, 'Charting an average week...')
-        trc.Trace("charting average week")
+def drawAverageWeekGraph():
+    global frame, ccvis
+    averageWeekData = getGraphData('averageweek')
     if averageWeekData:
-        ccvis.PlotAverageWeek(averageWeekData, guihandle.axes5, guihandle.trendspg, kwhfactor)
+        ccvis.PlotAverageWeek(averageWeekData, frame.axes5, None, getKWHFactor(frame))
+    completeGraph(frame.axes5, 'average week')
+
+#
+# rescalers for the graph tabs - called by the PlotNotebook when the tab is 
+#  displayed, if only the units used for the graph have changed since it was 
+#  last drawn
+# 
+
+def rescaleHourlyGraph():
+    rescaleGraph(frame.axes1, 1, "hours", 'hourly', drawHourlyGraph)
+
+def rescaleDailyGraph():
+    rescaleGraph(frame.axes2, 2, "days", 'daily', drawDailyGraph)
+
+def rescaleMonthlyGraph():
+    rescaleGraph(frame.axes3, 3, "months", 'monthly', drawMonthlyGraph)
+
+def rescaleAverageDayGraph():
+    rescaleGraph(frame.axes4, None, None, 'average day', drawAverageDayGraph)
+
+def rescaleAverageWeekGraph():
+    rescaleGraph(frame.axes5, None, None, 'average week', drawAverageWeekGraph)
+
+#
+# scale the bars and lines already drawn on a graph to use the current units, 
+#  falling back to replotting the graph if that isn't possible
+# 
+def rescaleGraph(axes, graphid, graphname, pagename, renderer):
+    global frame, ccvis, trc
+    trc.FunctionEntry("rescaleGraph")
+
+    kwhfactor = getKWHFactor(frame)
+    if ccvis.RescaleGraph(axes, kwhfactor):
+        if graphid != None:
+            drawAnnotations(axes, graphid, graphname, kwhfactor)
+        drawGraphCanvas(axes, pagename)
+    else:
+        renderer()
+
+    trc.FunctionExit("rescaleGraph")
+
+#
+# add the notes that the user has stored for a graph
+# 
+def drawAnnotations(axes, graphid, graphname, kwhfactor):
+    global ccdb, ccvis
+    for storednote in ccdb.RetrieveAnnotations(graphid):
+        ccvis.AddNote(storednote[0], # storednote[4], 
+                      axes, 
+                      storednote[1], 
+                      storednote[2], 
+                      storednote[5], 
+                      kwhfactor,
+                      graphname,
+                      False)
+
+#
+# add a target line to a graph if the user wants one, then draw it
+# 
+def completeGraph(axes, pagename):
+    global ccdb, frame
 
-    if dialog != None:
-        dialog.Update(9, 'Formatting charts...')
-    #    
-    daysl = DayLocator() 
-    hoursl = HourLocator(range(12,24,12)) 
-    datesFmt = DateFormatter('%d %b')
-    timesFmt = DateFormatter('%I%p') #('%H:%M')
-    guihandle.axes1.xaxis.set_minor_formatter(timesFmt)
-    guihandle.axes1.xaxis.set_major_formatter(datesFmt)
-    guihandle.axes1.xaxis.set_major_locator(daysl) 
-    guihandle.axes1.xaxis.set_minor_locator(hoursl)    
-    # 
-    # 
-    daysFmt  = DateFormatter('%d')
-    mthsFmt  = DateFormatter('%b %y')
-    datesl = DayLocator(range(2,31,2)) 
-    monthsl = MonthLocator()
-    guihandle.axes2.xaxis.set_major_formatter(mthsFmt)
-    guihandle.axes2.xaxis.set_major_locator(monthsl)
-    guihandle.axes2.xaxis.set_minor_formatter(daysFmt)
-    guihandle.axes2.xaxis.set_minor_locator(datesl)
-    #
-    monthsFmt = DateFormatter('%b')
-    yearsFmt = DateFormatter('%Y')
-    guihandle.axes3.xaxis.set_minor_formatter(monthsFmt)
-    monthsl = MonthLocator(range(2,13,1))
-    yearsl = YearLocator()
-    guihandle.axes3.xaxis.set_major_locator(yearsl)
-    guihandle.axes3.xaxis.set_minor_locator(monthsl)
-    guihandle.axes3.xaxis.set_major_formatter(yearsFmt)
-    #
-    guihandle.axes4.xaxis.set_major_locator(HourLocator(range(1, 24, 2)))
-    guihandle.axes4.xaxis.set_major_formatter(DateFormatter('%H00'))
-    #
-    guihandle.axes5.xaxis.set_major_locator(DayLocator(range(0,8,1)))
-    guihandle.axes5.xaxis.set_major_formatter(DateFormatter('%a'))
-    #
-    if dialog != None:
-        dialog.Update(10, 'Complete. Redrawing...')
-    #
-    try:
-        guihandle.axes1.figure.canvas.draw()
-    except:
-        trc.Trace("failed to draw canvas on hourly page")
-        plotter.deletepage('hourly')
-    try:
-        guihandle.axes2.figure.canvas.draw()
-    except:
-        trc.Trace("failed to draw canvas on daily page")
-        plotter.deletepage('daily')
-    try:
-        guihandle.axes3.figure.canvas.draw() # error?
-    except:
-        trc.Trace("failed to draw canvas on monthly page")
-        plotter.deletepage('monthly')
-    try:
-        guihandle.axes4.figure.canvas.draw()
-    except:
-        trc.Trace("failed to draw canvas on average day page")
-        plotter.deletepage('average day')
-    try:
-        guihandle.axes5.figure.canvas.draw()
-    except:
-        trc.Trace("failed to draw canvas on average week page")
-        plotter.deletepage('average week')
-    #
     # retrieve preference for whether targets should be shown
     enableTarget = ccdb.RetrieveSetting("enabletarget")
     if enableTarget == '1':
-        guihandle.displayUsageTarget()
-    #
-    if dialog != None:
-        dialog.Update(11, 'Complete')
+        frame.displayUsageTarget(axes, False)
 
-    trc.FunctionExit("drawMyGraphs")
+    drawGraphCanvas(axes, pagename)
+
+#
+# draw a graph, removing the tab if it can't be drawn
+# 
+def drawGraphCanvas(axes, pagename):
+    global plotter, trc
+    try:
+        axes.figure.canvas.draw()
+    except:
+        trc.Trace("failed to draw canvas on " + pagename + " page")
+        plotter.deletepage(pagename)
 
 
 #
@@ -2386,6 +2492,9 @@ def connectToDatabase(guihandle):
                                  style=wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE)
     ccdb.InitialiseDB(dbLocation)
 
+    # keep National Grid data downloaded for the live graphs
+    livedataagent.storeGridData(dbLocation)
+
     if storeLocation:
         settingscontents = open(settingsfile, 'w')
         settingscontents.write(dbLocation)
@@ -2512,12 +2621,12 @@ def appInit():
     #
     plotter = PlotNotebook(frame)
     # 
-    frame.trendspg = plotter.addtextpage('trends')
-    frame.axes1    = plotter.add('hourly').gca()
-    frame.axes2    = plotter.add('daily').gca()
-    frame.axes3    = plotter.add('monthly').gca()    
-    frame.axes4    = plotter.add('average day').gca()
-    frame.axes5    = plotter.add('average week').gca()
+    frame.trendspg = plotter.addtextpage('trends', drawTrendsPage)
+    frame.axes1    = plotter.add('hourly', drawHourlyGraph, rescaleHourlyGraph).gca()
+    frame.axes2    = plotter.add('daily', drawDailyGraph, rescaleDailyGraph).gca()
+    frame.axes3    = plotter.add('monthly', drawMonthlyGraph, rescaleMonthlyGraph).gca()    
+    frame.axes4    = plotter.add('average day', drawAverageDayGraph, rescaleAverageDayGraph).gca()
+    frame.axes5    = plotter.add('average week', drawAverageWeekGraph, rescaleAverageWeekGraph).gca()
     #
     frame.axes1.figure.canvas.mpl_connect('motion_notify_event', frame.UpdateStatusBar)    
     frame.axes2.figure.canvas.mpl_connect('motion_notify_event', frame.UpdateStatusBar)
@@ -2541,14 +2650,22 @@ def appInit():
 
 
 debug = False
-options, rem = getopt.getopt(sys.argv[1:], '', ['debug'])
+metrics = False
+options, rem = getopt.getopt(sys.argv[1:], '', ['debug', 'metrics'])
 for opt, arg in options:
     if opt == '--debug':
         debug = True
+    elif opt == '--metrics':
+        metrics = True
 
 trc.EnableTrace(debug)
+trc.EnableMetrics(metrics)
 trc.InitialiseTraceFile()
 
+# time spent in each function is written to the diagnostics log on exit
+if metrics:
+    atexit.register(trc.DumpMetrics)
+
 
 if __name__ == "__main__": 
     try:
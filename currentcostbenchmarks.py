@@ -0,0 +1,1264 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+
+import os
+import sys
+import time
+import getopt
+import datetime
+import threading
+import tempfile
+import subprocess
+import BaseHTTPServer
+
+import tracer
+import currentcostparser
+
+
+#
+# Benchmarks for performance-sensitive parts of the CurrentCost code
+# 
+#  Each benchmark prints the time taken and throughput for a fixed amount of 
+#   work, so that the effect of changes can be compared between versions.
+# 
+#  usage: 
+#    python currentcostbenchmarks.py [--iterations=N] [benchmark ...]
+# 
+#  benchmarks:
+#    parse       - parse and store CurrentCost XML, with tracing disabled, 
+#                   enabled (queued to be written to a temporary file by the
+#                   background trace writer), with span metrics enabled, and
+#                   compiled out (all trace functions replaced with no-ops)
+#    genmix      - parse generation mix XML from the BM reports website (see 
+#                   gridsourcedata.py), with a regular expression per fuel 
+#                   type and in a single pass, divide live readings 
+#                   between the sources of electricity, and draw them
+#    griddb      - store National Grid data in a temporary database through 
+#                   a background writer (see currentcostgridstore.py), and 
+#                   find the carbon intensity of grid electricity for each 
+#                   period of history data
+#    mqtt        - publish live readings through a local MQTT broker (see 
+#                   currentcostmqttbroker.py), and measure how long MQTT 
+#                   sessions take to reconnect when the broker drops them,
+#                   and republish live and history data parsed from CurrentCost
+#                   XML (see currentcostmqttpublish.py)
+#    mqtthistory - decode history data published via MQTT and store it in a 
+#                   temporary database, one value at a time and in bulk
+#    imports     - time taken to import the modules used without a GUI, each 
+#                   in a new python process. fails if any of them import 
+#                   libraries only needed to draw graphs or run the GUI
+#    serial      - read live and history updates from a simulated meter (see
+#                   currentcostsimulator.py) through the same classes used by
+#                   the GUI, measuring throughput and latency. Linux/Mac only
+#    webfetch    - download National Grid data from a local stub web server
+#                   (see currentcostwebfetch.py), checking that unchanged data
+#                   isn't downloaded or passed on again, and that errors back 
+#                   off without losing the last data downloaded
+# 
+#  exits with a non-zero return code if any benchmark fails
+# 
+
+
+# sample updates from a CC128 meter - one live reading, and one history 
+#  update containing 2-hourly data
+SAMPLE_LIVE_XML = "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:39</time>" + \
+                  "<tmpr>18.7</tmpr><sensor>0</sensor><id>01234</id><type>1</type>" + \
+                  "<ch1><watts>00345</watts></ch1></msg>"
+
+SAMPLE_HISTORY_XML = "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:10:50</time>" + \
+                     "<hist><dsw>00032</dsw><type>1</type><units>kwhr</units>" + \
+                     "<data><sensor>0</sensor>" + \
+                     "".join([ "<h%03d>%05.1f</h%03d>" % (h, (h % 7) * 0.3, h) for h in range(2, 34, 2) ]) + \
+                     "</data></hist></msg>"
+
+
+#
+# a data store which discards everything it is given, so that benchmarks 
+#  measure the parser rather than the database
+# 
+class DiscardingDataStore():
+    stored = 0
+    def StoreHourData(self, timestamp, ccvalue):
+        self.stored += 1
+    def StoreDayData(self, timestamp, ccvalue):
+        self.stored += 1
+    def StoreMonthData(self, timestamp, ccvalue):
+        self.stored += 1
+
+
+#
+# a tracer with every function replaced by a no-op - equivalent to removing 
+#  all trace calls from the code
+# 
+class NullTracer():
+    def Trace(self, debuginfo, *args):
+        pass
+    def Error(self, errorinfo, *args):
+        pass
+    def FunctionEntry(self, functionname):
+        pass
+    def FunctionExit(self, functionname):
+        pass
+
+
+#
+# run a function the given number of times, and print how long it took
+# 
+def timeRuns(description, function, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        function()
+    elapsed = time.time() - start
+    if elapsed > 0:
+        rate = iterations / elapsed
+    else:
+        rate = float('inf')
+    print "  %-40s %8.3f secs  %10.0f /sec" % (description, elapsed, rate)
+    return elapsed
+
+
+def benchmarkParse(iterations):
+    print "parse and store CurrentCost XML (%d updates of each type)" % iterations
+
+    parser = currentcostparser.CurrentCostDataParser()
+    store = DiscardingDataStore()
+
+    def parseLive():
+        parser.parseCurrentCostXML(SAMPLE_LIVE_XML)
+
+    def parseHistory():
+        if parser.parseCurrentCostXML(SAMPLE_HISTORY_XML) != None:
+            parser.storeTimedCurrentCostData(store)
+
+    realtracer = currentcostparser.trc
+    tracestate = tracer.enableTrace
+    metricsstate = tracer.enableMetrics
+
+    # write trace to a temporary file rather than the normal diagnostics log
+    tracefile, tracefilename = tempfile.mkstemp(suffix='.log')
+    os.close(tracefile)
+    tracefilesetting = tracer.TRACE_FILE_NAME
+    tracer.TRACE_FILE_NAME = tracefilename
+    tracer.startTraceWriter()
+
+    try:
+        for description, tracing, metrics, trc in [ ("tracing disabled",     False, False, realtracer),
+                                                    ("tracing enabled",      True,  False, realtracer),
+                                                    ("metrics enabled",      False, True,  realtracer),
+                                                    ("tracing compiled out", False, False, NullTracer()) ]:
+            tracer.enableTrace = tracing
+            tracer.enableMetrics = metrics
+            currentcostparser.trc = trc
+            timeRuns("live    - " + description, parseLive, iterations)
+            timeRuns("history - " + description, parseHistory, iterations)
+            # finish writing the trace from this phase before timing the 
+            #  next, so that the writer thread isn't competing with it
+            tracer.stopTraceWriter()
+            tracer.restartTraceWriter(tracer.traceLogger)
+        if tracer.traceDropped > 0:
+            print "  (%d trace messages dropped)" % tracer.traceDropped
+    finally:
+        currentcostparser.trc = realtracer
+        tracer.enableTrace = tracestate
+        tracer.enableMetrics = metricsstate
+        tracer.stopTraceWriter()
+        for handler in tracer.traceLogger.handlers[:]:
+            tracer.traceLogger.removeHandler(handler)
+            handler.close()
+        tracer.TRACE_FILE_NAME = tracefilesetting
+        for filename in [ tracefilename ] + [ tracefilename + "." + str(i) for i in range(1, tracer.TRACE_FILE_BACKUPS + 1) ]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+#
+# receives data from a serial reader in place of the live and history 
+#  connections
+# 
+class FanOutSubscriber():
+    def __init__(self, parser, store):
+        self.parser = parser
+        self.store = store
+    def liveReadingReceived(self, ccreading):
+        pass
+    def historyReceived(self, currentcoststruct):
+        self.parser.storeTimedCurrentCostData(self.store, currentcoststruct)
+
+def benchmarkFanOut(iterations):
+    # imported here so that the other benchmarks can be run without pyserial
+    from currentcostserialconn   import CurrentCostConnection
+    from currentcostserialreader import CurrentCostSerialReader, parseLiveXML
+
+    print "pass updates to live and history consumers (%d updates of each type)" % iterations
+
+    parser = currentcostparser.CurrentCostDataParser()
+    store = DiscardingDataStore()
+
+    # each consumer parsing every update itself, as the live and history 
+    #  connections used to
+    def separately(line):
+        parseLiveXML(line)
+        if parser.parseCurrentCostXML(line) != None and 'hist' in parser.currentcoststruct['msg']:
+            parser.storeTimedCurrentCostData(store)
+
+    # a reader parsing each update once for both
+    reader = CurrentCostSerialReader(CurrentCostConnection())
+    reader.subscribers = [ FanOutSubscriber(parser, store) ]
+    try:
+        timeRuns("live    - parsed by each consumer", lambda: separately(SAMPLE_LIVE_XML), iterations)
+        timeRuns("live    - parsed once by reader", lambda: reader.processLine(SAMPLE_LIVE_XML), iterations)
+        timeRuns("history - parsed by each consumer", lambda: separately(SAMPLE_HISTORY_XML), iterations)
+        timeRuns("history - parsed once by reader", lambda: reader.processLine(SAMPLE_HISTORY_XML), iterations)
+    finally:
+        reader.stop()
+
+
+# number of live readings in a flood of MQTT messages, and how long (seconds)
+#  it takes to redraw the live graph
+FLOOD_READINGS = 2000
+FLOOD_REDRAW_TIME = 0.002
+
+#
+# stands in for the live graph, taking FLOOD_REDRAW_TIME to redraw
+# 
+class SlowLiveGraph():
+    def __init__(self):
+        self.readings = 0
+        self.redraws = 0
+        self.lastReading = None
+    def redrawGraph(self):
+        time.sleep(FLOOD_REDRAW_TIME)
+        self.redraws += 1
+    def updateGraph(self, ccreading, meterid=None):
+        self.readings += 1
+        self.lastReading = ccreading
+        self.redrawGraph()
+    def updateGraphBatch(self, readings, meterid=None):
+        self.readings += len(readings)
+        self.lastReading = readings[-1][1]
+        self.redrawGraph()
+
+def benchmarkFlood(iterations):
+    from currentcostlivebatcher import CurrentCostLiveBatcher
+
+    print "receive a flood of %d live readings (graph redraws take %d ms)" % (FLOOD_READINGS, FLOOD_REDRAW_TIME * 1000)
+
+    # a redraw for every reading
+    graph = SlowLiveGraph()
+    start = time.time()
+    for i in xrange(FLOOD_READINGS):
+        graph.updateGraph(1.0)
+    elapsed = time.time() - start
+    print "  %-40s %8.3f secs  %6d redraws  %6d drawn" % ("each reading drawn", elapsed, graph.redraws, graph.readings)
+
+    # readings collected and drawn in batches
+    graph = SlowLiveGraph()
+    batcher = CurrentCostLiveBatcher(graph)
+    batcher.start()
+    start = time.time()
+    # each reading is its sequence number, so that we can check the graph 
+    #  ends with the last one even when they are decimated
+    for i in xrange(FLOOD_READINGS):
+        batcher.addReading(float(i))
+    received = time.time() - start
+    # wait for the last batch to be drawn
+    time.sleep(batcher.FRAME_INTERVAL * 2)
+    batcher.stop()
+    print "  %-40s %8.3f secs  %6d redraws  %6d drawn  %6d dropped  %6d decimated" % ("batched", 
+                                                                                  received, 
+                                                                                  graph.redraws,
+                                                                                  graph.readings,
+                                                                                  batcher.dropped,
+                                                                                  batcher.decimated)
+    if graph.lastReading != FLOOD_READINGS - 1:
+        print "  last reading drawn was %s, not %d" % (graph.lastReading, FLOOD_READINGS - 1)
+        return False
+    return batcher.received == FLOOD_READINGS and graph.redraws > 0
+
+
+# number of live readings published through the MQTT broker
+MQTT_LIVE_READINGS = 5000
+# give up if they haven't all been received by then (seconds)
+MQTT_TIMEOUT = 60
+
+#
+# receives live readings from the MQTT live connection in place of the GUI
+# 
+class MQTTLiveReadingCollector():
+    def __init__(self):
+        self.readings = 0
+        self.batches = 0
+        self.errors = []
+    def updateGraph(self, ccreading, meterid=None):
+        self.readings += 1
+    def updateGraphBatch(self, readings, meterid=None):
+        self.readings += len(readings)
+        self.batches += 1
+    def exitOnError(self, errmsg):
+        self.errors.append(errmsg)
+
+#
+# receives publications and events from MQTT sessions
+# 
+class MQTTSessionListener():
+    def __init__(self):
+        self.connected = threading.Event()
+        self.reconnected = threading.Event()
+        self.received = threading.Event()
+        self.lost = 0
+    def sessionConnected(self, reconnected):
+        if reconnected:
+            self.reconnected.set()
+        self.connected.set()
+    def sessionLost(self, errmsg):
+        self.lost += 1
+    def messageReceived(self, topic, payload):
+        self.received.set()
+
+# number of times the broker drops its clients when measuring reconnects
+MQTT_SESSION_DROPS = 5
+
+#
+# drop the connections to MQTT sessions and measure how long it takes until
+#  they are receiving publications again, and check that two sessions for the
+#  same purpose don't disconnect each other
+# 
+def benchmarkMQTTSessions():
+    from currentcostmqttbroker  import CurrentCostMQTTBroker, CurrentCostMQTTTestClient
+    from currentcostmqttsession import CurrentCostMQTTSession
+    from tracer                 import percentile
+
+    passed = True
+    broker = CurrentCostMQTTBroker()
+    broker.start()
+    publisher = CurrentCostMQTTTestClient('benchmark-pub', port=broker.port)
+    publisher.connect()
+    sessions = []
+    try:
+        listeners = [ MQTTSessionListener(), MQTTSessionListener() ]
+        for listener in listeners:
+            session = CurrentCostMQTTSession('benchmark', '127.0.0.1:%d' % broker.port, listener)
+            # reconnect straight away, rather than waiting as we would for a 
+            #  real broker
+            session.RECONNECT_DELAY = 0.01
+            session.subscribe('benchmark/session')
+            session.start()
+            session.waitUntilConnected(MQTT_TIMEOUT)
+            sessions.append(session)
+
+        # both sessions should still be connected
+        time.sleep(0.5)
+        clientids = broker.getClientIds()
+        if len([ session for session in sessions if session.clientid in clientids ]) != len(sessions) or \
+           len([ listener for listener in listeners if listener.lost > 0 ]) > 0:
+            passed = False
+            print "  sessions - FAILED - sessions with the same purpose disconnected each other"
+        else:
+            print "  %-40s %s" % ("sessions - unique client ids", ", ".join([ session.clientid for session in sessions ]))
+
+        # drop the connections, and time how long until a publication is 
+        #  received again
+        listener = listeners[0]
+        times = []
+        for i in range(MQTT_SESSION_DROPS):
+            listener.reconnected.clear()
+            listener.received.clear()
+            start = time.time()
+            broker.dropClients()
+            publisher.close()
+            publisher = CurrentCostMQTTTestClient('benchmark-pub', port=broker.port)
+            publisher.connect()
+            listener.reconnected.wait(MQTT_TIMEOUT)
+            if not listener.reconnected.isSet():
+                break
+            while not listener.received.isSet() and time.time() - start < MQTT_TIMEOUT:
+                publisher.publish('benchmark/session', 'ping')
+                listener.received.wait(0.01)
+            if listener.received.isSet():
+                times.append(time.time() - start)
+        if len(times) < MQTT_SESSION_DROPS:
+            passed = False
+            print "  sessions - FAILED - resubscribed after %d of %d dropped connections" % (len(times), MQTT_SESSION_DROPS)
+        else:
+            times.sort()
+            print "  %-40s %8.2f ms    max %6.2f ms" % ("sessions - reconnect and resubscribe p50", 
+                                                      percentile(times, 50) * 1000, times[-1] * 1000)
+    finally:
+        for session in sessions:
+            session.stop()
+        publisher.disconnect()
+        broker.stop()
+    return passed
+
+# number of live readings given to the MQTT republisher
+REPUBLISH_READINGS = 20000
+
+#
+# republish live readings (each with its channels) and a history update, 
+#  and check what is received by a subscriber
+# 
+def benchmarkMQTTRepublish():
+    from currentcostmqttbroker   import CurrentCostMQTTBroker, CurrentCostMQTTTestClient
+    from currentcostmqttpublish  import CurrentCostMQTTRepublisher
+    from currentcostserialreader import parseLiveXML, parseLiveChannels
+    from currentcostdata         import decodeMQTTHistory
+
+    passed = True
+    broker = CurrentCostMQTTBroker()
+    broker.start()
+    received = {}
+    def messageReceived(topic, payload):
+        received[topic] = received.get(topic, 0) + 1
+        if topic.find('/history/') != -1:
+            history[topic[topic.rfind('/') + 1:]] = payload
+    history = {}
+    subscriber = CurrentCostMQTTTestClient('benchmark-sub', port=broker.port)
+    subscriber.messageCallback = messageReceived
+    subscriber.connect()
+    subscriber.subscribe('benchmark/#')
+
+    republisher = CurrentCostMQTTRepublisher('127.0.0.1:%d' % broker.port, 'benchmark')
+    republisher.BATCH_INTERVAL = 0.1
+    republisher.start()
+    try:
+        republisher.session.waitUntilConnected(MQTT_TIMEOUT)
+        parser = currentcostparser.CurrentCostDataParser()
+        republisher.historyReceived(parser.parseCurrentCostXML(SAMPLE_HISTORY_XML))
+
+        # the time taken to give readings to the republisher is the time the 
+        #  serial reader's thread would spend on them
+        start = time.time()
+        for i in xrange(REPUBLISH_READINGS):
+            republisher.liveReadingReceived(parseLiveXML(SAMPLE_LIVE_XML))
+            sensor, watts = parseLiveChannels(SAMPLE_LIVE_XML)
+            republisher.liveChannelsReceived(sensor, watts)
+        elapsed = time.time() - start
+    finally:
+        republisher.stop()
+        time.sleep(0.5)
+        subscriber.disconnect()
+        broker.stop()
+
+    print "  %-40s %8.3f secs  %10.0f /sec" % ("republish - %d readings" % REPUBLISH_READINGS, elapsed, REPUBLISH_READINGS / elapsed)
+    print "  %-40s %8d msgs  %6d batches  %6d coalesced" % ("republish - published", republisher.published, 
+                                                             republisher.batches, republisher.coalesced)
+    decoded = [ decodeMQTTHistory(datatype, history[datatype]) for datatype in sorted(history.keys()) ]
+    if received.get('benchmark/live', 0) == 0 or received.get('benchmark/live/0/ch1', 0) == 0:
+        passed = False
+        print "  republish - FAILED - live data not received %s" % received
+    elif len(decoded) != 3 or decoded[1].values.sum() <= 0:
+        passed = False
+        print "  republish - FAILED - history data not received %s" % history
+    return passed
+
+def benchmarkMQTT(iterations):
+    from currentcostmqttbroker import CurrentCostMQTTBroker, CurrentCostMQTTPublisher
+    from currentcostmqttbroker import CurrentCostMQTTTestClient
+    from tracer                import percentile
+
+    print "publish %d live readings through a local MQTT broker" % MQTT_LIVE_READINGS
+
+    passed = True
+    broker = CurrentCostMQTTBroker()
+    broker.start()
+    try:
+        for qos in [ 0, 1 ]:
+            publisher = CurrentCostMQTTPublisher('benchmark', port=broker.port)
+            publisher.liveInterval = None
+            publisher.historyInterval = None
+            publisher.qos = qos
+            publisher.start()
+
+            latencies = []
+            finished = threading.Event()
+            def messageReceived(topic, payload):
+                latencies.append(time.time() - publisher.getSendTime(float(payload)))
+                if len(latencies) >= MQTT_LIVE_READINGS:
+                    finished.set()
+            subscriber = CurrentCostMQTTTestClient('benchmark-sub', port=broker.port)
+            subscriber.messageCallback = messageReceived
+            subscriber.connect()
+            subscriber.subscribe('benchmark/live', qos)
+
+            start = time.time()
+            for i in xrange(MQTT_LIVE_READINGS):
+                publisher.publishLive()
+            finished.wait(MQTT_TIMEOUT)
+            elapsed = time.time() - start
+            subscriber.disconnect()
+            publisher.stop()
+
+            latencies.sort()
+            if len(latencies) < MQTT_LIVE_READINGS:
+                passed = False
+                print "  qos %d   - FAILED - received %d of %d readings" % (qos, len(latencies), MQTT_LIVE_READINGS)
+            else:
+                print "  %-40s %8.3f secs  %10.0f /sec" % ("qos %d   - %d readings" % (qos, len(latencies)), elapsed, len(latencies) / elapsed)
+                print "  %-40s %8.2f ms    p95 %6.2f ms  max %6.2f ms" % ("qos %d   - latency p50" % qos, 
+                                                                         percentile(latencies, 50) * 1000, 
+                                                                         percentile(latencies, 95) * 1000,
+                                                                         latencies[-1] * 1000)
+    finally:
+        broker.stop()
+
+    if not benchmarkMQTTSessions():
+        passed = False
+    if not benchmarkMQTTRepublish():
+        passed = False
+
+    # the live connection used by the GUI
+    from currentcostmqttlive import CurrentCostMQTTLiveConnection
+
+    broker = CurrentCostMQTTBroker()
+    broker.start()
+    try:
+        publisher = CurrentCostMQTTPublisher('benchmark', port=broker.port)
+        publisher.liveInterval = None
+        publisher.historyInterval = None
+        publisher.start()
+
+        collector = MQTTLiveReadingCollector()
+        live = CurrentCostMQTTLiveConnection()
+        live.EstablishConnection('127.0.0.1:%d' % broker.port, 'benchmark/live', collector)
+        start = time.time()
+        for i in xrange(MQTT_LIVE_READINGS):
+            publisher.publishLive()
+        while collector.readings + live.batcher.dropped + live.batcher.decimated < MQTT_LIVE_READINGS and \
+              time.time() - start < MQTT_TIMEOUT:
+            time.sleep(0.1)
+        elapsed = time.time() - start
+        live.Disconnect()
+        publisher.stop()
+    finally:
+        broker.stop()
+
+    if collector.readings == 0 or len(collector.errors) > 0:
+        passed = False
+        print "  live connection - FAILED - %d readings drawn %s" % (collector.readings, collector.errors)
+    else:
+        print "  %-40s %8.3f secs  %6d batches  %6d drawn" % ("live connection", elapsed, collector.batches, collector.readings)
+
+    return passed
+
+
+# number of sets of MQTT history data (hours, days and months) stored for 
+#  every 100 iterations - each is written to a database file
+MQTT_HISTORY_SETS_PER_100 = 1
+
+def benchmarkMQTTHistory(iterations):
+    from currentcostdata          import decodeMQTTHistory
+    from currentcostdatafunctions import CurrentCostDataFunctions
+    from currentcostdb            import CurrentCostDB
+    from currentcostmqttbroker    import CurrentCostMQTTPublisher
+
+    sets = max(1, iterations * MQTT_HISTORY_SETS_PER_100 / 100)
+    print "decode and store MQTT history data (%d sets of hours, days and months)" % sets
+
+    payloads = CurrentCostMQTTPublisher('benchmark').getHistoryPayloads()
+    ccfuncs = CurrentCostDataFunctions()
+
+    # how history data was stored before it was decoded into arrays - each 
+    #  value converted and stored (and committed) separately
+    def storeEachValue(ccdb):
+        currtime = datetime.datetime.now()
+        today = currtime.date()
+        for datatype, payload in payloads:
+            values = payload.split()
+            for i in range(len(values)):
+                if datatype == 'hours':
+                    ccdb.StoreHourData(ccfuncs.GetOldHour(currtime, i * 2), float(values[i]))
+                elif datatype == 'days':
+                    ccdb.StoreDayData(ccfuncs.GetOldDay(today, i + 1), int(values[i]))
+                else:
+                    ccdb.StoreMonthData(ccfuncs.GetOldMonth(today, i + 1), int(values[i]))
+
+    def storeDecoded(ccdb):
+        ccfuncs.StoreHistoryUpdates(ccdb, [ decodeMQTTHistory(datatype, payload) for datatype, payload in payloads ])
+
+    passed = True
+    results = {}
+    for description, store in [ ("one value at a time", storeEachValue),
+                                ("decoded in bulk",     storeDecoded) ]:
+        dbfile, dbfilename = tempfile.mkstemp(suffix='.db')
+        os.close(dbfile)
+        ccdb = CurrentCostDB()
+        ccdb.InitialiseDB(dbfilename)
+        try:
+            timeRuns(description, lambda: store(ccdb), sets)
+            results[description] = (ccdb.GetHourDataCollection(), ccdb.GetDayDataCollection(), ccdb.GetMonthDataCollection())
+        finally:
+            ccdb.CloseDB()
+            os.remove(dbfilename)
+
+    # both should have stored the same data
+    if results["one value at a time"] != results["decoded in bulk"]:
+        passed = False
+        print "  decoded in bulk - FAILED - stored data differs"
+    return passed
+
+
+# days of National Grid data stored, and the time (minutes) between samples
+GRID_DAYS           = 30
+GRID_SAMPLE_MINUTES = 3
+
+def benchmarkGridData(iterations):
+    from currentcostdb        import CurrentCostDB
+    from currentcostgridstore import CurrentCostGridDataWriter
+    from gridfueltypes        import FUEL_TYPES, carbonIntensity
+
+    numsamples = GRID_DAYS * 24 * 60 / GRID_SAMPLE_MINUTES
+    print "store National Grid data (%d days, %d samples) and compare it with history data" % (GRID_DAYS, numsamples)
+
+    passed = True
+    dbfile, dbfilename = tempfile.mkstemp(suffix='.db')
+    os.close(dbfile)
+    ccdb = CurrentCostDB()
+    ccdb.InitialiseDB(dbfilename)
+    try:
+        starttime = datetime.datetime(2011, 6, 1)
+        sampletimes = [ starttime + datetime.timedelta(minutes=GRID_SAMPLE_MINUTES * i) for i in range(numsamples) ]
+        mixes = [ dict([ (fueltype, float((i / 20 + j) % 12)) for j, fueltype in enumerate(FUEL_TYPES) ] + [ ('UNKNOWN', 0.0) ])
+                  for i in range(numsamples) ]
+
+        # the time taken to give samples to the writer is the time the 
+        #  threads downloading National Grid data spend on them
+        writer = CurrentCostGridDataWriter(dbfilename)
+        writer.BATCH_INTERVAL = 0.1
+        writer.start()
+        start = time.time()
+        for i in xrange(numsamples):
+            writer.storeDemand(sampletimes[i], 35000 + i % 1000, 50.0)
+            writer.storeMix(sampletimes[i], mixes[i])
+        elapsed = time.time() - start
+        print "  %-40s %8.3f secs  %10.0f /sec" % ("griddb  - queue samples", elapsed, numsamples * 2 / elapsed)
+        start = time.time()
+        writer.shutdown()
+        elapsed = time.time() - start
+        print "  %-40s %8.3f secs  %6d batches" % ("griddb  - write queued samples", elapsed, writer.batches)
+        if writer.stored != numsamples * 2 or len(ccdb.GetGridDemandData()) != numsamples:
+            passed = False
+            print "  griddb  - FAILED - stored %d of %d samples" % (writer.stored, numsamples * 2)
+
+        # 2-hourly history data for the same days
+        hours = [ starttime + datetime.timedelta(hours=2 * i) for i in range(GRID_DAYS * 12) ]
+        ccdb.StoreHourDataMany(hours, [ 0.5 + (i % 12) * 0.1 for i in range(len(hours)) ])
+
+        runs = max(iterations / 1000, 1)
+        weekend = starttime + datetime.timedelta(days=7)
+        timeRuns("griddb  - carbon intensity, %d days" % GRID_DAYS, ccdb.GetHourDataWithCarbonIntensity, runs)
+        timeRuns("griddb  - carbon intensity, 7 days", lambda: ccdb.GetHourDataWithCarbonIntensity(starttime, weekend), runs)
+
+        # the intensity for each period is the average of the samples in it
+        rows = ccdb.GetHourDataWithCarbonIntensity(starttime, weekend)
+        persample = 120 / GRID_SAMPLE_MINUTES
+        expected = sum([ carbonIntensity(mix) for mix in mixes[persample:persample * 2] ]) / persample
+        if len(rows) != 7 * 12 + 1 or rows[1][0] != hours[1] or abs(rows[1][2] - expected) > 0.001:
+            passed = False
+            print "  griddb  - FAILED - unexpected carbon intensity %s" % (rows[1:2],)
+
+        plan = " ".join([ str(row) for row in ccdb.connection.execute("EXPLAIN QUERY PLAN SELECT AVG(intensity) FROM gridmix " + 
+                                                                       "WHERE ts >= ? AND ts < ?", (starttime, weekend)) ])
+        if plan.find('INDEX') == -1:
+            passed = False
+            print "  griddb  - FAILED - gridmix times not indexed : %s" % plan
+    finally:
+        ccdb.CloseDB()
+        os.remove(dbfilename)
+    return passed
+
+
+# number of requests made to the stub web server for each measurement
+WEBFETCH_REQUESTS = 200
+# time (seconds) between requests when polling the stub web server
+WEBFETCH_INTERVAL = 0.01
+# time (seconds) to poll the stub web server for
+WEBFETCH_POLL_TIME = 0.5
+
+SAMPLE_NATIONAL_GRID_HTML = "<html><body><div><p class='small'>Demand:%dMW</p>" + \
+                            "<p class='small'>Frequency:50.02Hz</p></div></body></html>"
+
+#
+# a web server which serves one webpage in place of the National Grid 
+#  website. it supports conditional requests using ETags unless useETags is 
+#  False, and returns errors if failing is True
+# 
+class StubWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        stub = self.server
+        stub.requests += 1
+        if stub.failing:
+            self.send_error(503)
+            return
+        etag = '"%d"' % hash(stub.body)
+        if stub.useETags and self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(stub.body)))
+        if stub.useETags:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(stub.body)
+    def log_message(self, format, *args):
+        pass
+
+def startStubWebServer(body):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubWebHandler)
+    server.body = body
+    server.useETags = True
+    server.failing = False
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+#
+# receives National Grid data from a web fetcher in place of the live graph
+# 
+class NationalGridCollector():
+    def __init__(self, ngdata):
+        self.ngdata = ngdata
+        self.readings = []
+    def contentReceived(self, nghtml):
+        self.readings.append(self.ngdata.ParseRealtimeHTML(nghtml))
+
+def benchmarkWebFetch(iterations):
+    from currentcostwebfetch import CurrentCostWebFetcher
+    from nationalgriddata    import NationalGridDataSource
+
+    print "download National Grid data from a local stub web server"
+
+    passed = True
+    server = startStubWebServer(SAMPLE_NATIONAL_GRID_HTML % 35000)
+    url = 'http://127.0.0.1:%d/systemdata.aspx' % server.server_address[1]
+    try:
+        fetcher = CurrentCostWebFetcher(url)
+        fetcher.fetch()
+        timeRuns("webfetch - conditional requests", fetcher.fetch, WEBFETCH_REQUESTS)
+        if fetcher.notModified != WEBFETCH_REQUESTS:
+            passed = False
+            print "  webfetch - FAILED - %d of %d requests not modified" % (fetcher.notModified, WEBFETCH_REQUESTS)
+
+        # a website which ignores conditional requests sends the data again
+        server.useETags = False
+        fetcher.fetch()
+        timeRuns("webfetch - repeated responses", fetcher.fetch, WEBFETCH_REQUESTS)
+        if fetcher.duplicates != WEBFETCH_REQUESTS + 1 or fetcher.changes != 1:
+            passed = False
+            print "  webfetch - FAILED - %d duplicates, %d changes" % (fetcher.duplicates, fetcher.changes)
+
+        # only requests which are due are made, however often data is asked for
+        fetcher.setInterval(60)
+        fetcher.getContent()
+        requests = server.requests
+        timeRuns("webfetch - getContent between polls", fetcher.getContent, iterations)
+        if server.requests != requests:
+            passed = False
+            print "  webfetch - FAILED - %d requests made before they were due" % (server.requests - requests)
+
+        # errors back off, and don't replace the last data downloaded
+        server.failing = True
+        fetcher.setInterval(WEBFETCH_INTERVAL)
+        fetcher.nextPoll = 0
+        delays = []
+        for i in range(4):
+            fetcher.nextPoll = 0
+            fetcher.poll()
+            delays.append(fetcher.nextPoll - fetcher.lastPoll)
+        print "  %-40s %s secs" % ("webfetch - delays after errors", ", ".join([ "%.2f" % delay for delay in delays ]))
+        if delays != sorted(delays) or delays[0] <= WEBFETCH_INTERVAL or fetcher.getContent() != server.body:
+            passed = False
+            print "  webfetch - FAILED - did not back off, or lost the last data downloaded"
+        server.failing = False
+        server.useETags = True
+
+        # subscribers are only given data which has changed
+        ngdata = NationalGridDataSource(url, WEBFETCH_INTERVAL)
+        collector = NationalGridCollector(ngdata)
+        requests = server.requests
+        ngdata.startUpdates(collector)
+        time.sleep(WEBFETCH_POLL_TIME)
+        server.body = SAMPLE_NATIONAL_GRID_HTML % 36000
+        time.sleep(WEBFETCH_POLL_TIME)
+        ngdata.stopUpdates(collector)
+        requests = server.requests - requests
+        print "  %-40s %8d requests  %6d updates" % ("webfetch - polled for %.1f secs" % (WEBFETCH_POLL_TIME * 2), requests, len(collector.readings))
+        if collector.readings != [ (35000, 50.02), (36000, 50.02) ]:
+            passed = False
+            print "  webfetch - FAILED - unexpected updates %s" % collector.readings
+    finally:
+        server.shutdown()
+        server.server_close()
+    return passed
+
+
+# number of half-hourly figures in the generation XML - a day's worth, as in
+#  a typical response from the BM reports website
+GENERATION_HALF_HOURS = 48
+
+#
+# generation XML in the format returned by the BM reports website - the 
+#  latest figures, followed by half-hourly and daily figures
+# 
+def makeGenerationXML(missing=None):
+    from gridsourcedata import FUEL_TYPES
+    def fuels(scale):
+        return "".join([ '<FUEL TYPE="%s" IC="N" VAL="%d" PCT="%.1f"></FUEL>' % (fueltype, (i + 1) * scale, (i + 1) * 100.0 / 66) 
+                         for i, fueltype in enumerate(FUEL_TYPES) if fueltype != missing ])
+    xml = '<?xml version="1.0"?><GENERATION_BY_FUEL_TYPE_TABLE>'
+    xml += '<INST AT="2011-06-01 12:30:00" TOTAL="35000">' + fuels(530) + '</INST>'
+    for i in range(GENERATION_HALF_HOURS):
+        xml += '<HH SD="2011-06-01" SP="%d" AT="%02d:%02d-%02d:%02d" TOTAL="35000">' % (i + 1, i / 2, (i % 2) * 30, (i + 1) / 2, ((i + 1) % 2) * 30) + fuels(265) + '</HH>'
+    xml += '<LAST24H FROM_SD="2011-05-31" FROM_SP="26" AT="12:30-12:30" TOTAL="840000">' + fuels(12720) + '</LAST24H>'
+    xml += '</GENERATION_BY_FUEL_TYPE_TABLE>'
+    return xml
+
+#
+# the way generation XML was parsed before ParseGenerationMix - a separate 
+#  regular expression search through the XML for each fuel type
+# 
+def parseGenerationXMLPerFuel(xml):
+    import re
+    from gridsourcedata import FUEL_TYPES, MIN_PERCENTAGE
+    energygendata = {}
+    energygendata['UNKNOWN'] = 0.0000000000000000000000000001
+    for key in FUEL_TYPES:
+        m = re.search("<INST.*?<FUEL TYPE=\"" + key + "\".*?PCT=\"(.*?)\"></FUEL>.*?</INST>", xml)
+        energygendata[key] = float(m.group(1))
+        if energygendata[key] == 0.0:
+            energygendata[key] = MIN_PERCENTAGE
+    return energygendata
+
+def benchmarkGenerationMix(iterations):
+    from gridsourcedata import ElectricityGenerationDataSource, FUEL_TYPES, MIN_PERCENTAGE
+
+    xml = makeGenerationXML()
+    print "parse generation mix XML (%d bytes)" % len(xml)
+
+    passed = True
+    ngdata = ElectricityGenerationDataSource()
+    runs = max(iterations / 10, 1)
+    timeRuns("genmix  - regex per fuel type", lambda: parseGenerationXMLPerFuel(xml), runs)
+    timeRuns("genmix  - single pass", lambda: ngdata.ParseGenerationMix(xml), runs)
+
+    timestamp, mix = ngdata.ParseGenerationMix(xml)
+    if mix != parseGenerationXMLPerFuel(xml):
+        passed = False
+        print "  genmix  - FAILED - results differ"
+    if timestamp != datetime.datetime(2011, 6, 1, 12, 30):
+        passed = False
+        print "  genmix  - FAILED - unexpected time %s" % timestamp
+    if ngdata.ParseRealtimeXML(makeGenerationXML('WIND'))['WIND'] != MIN_PERCENTAGE:
+        passed = False
+        print "  genmix  - FAILED - missing fuel type not defaulted"
+
+    if benchmarkGenerationSplit(iterations, mix) == False:
+        passed = False
+    return passed
+
+# number of live readings divided between sources of electricity, and the 
+#  number of changes to the energy mix while they were collected
+GENERATION_SPLIT_READINGS = 5000
+GENERATION_SPLIT_CHANGES  = 10
+
+#
+# divide live readings between sources of electricity, as the live graph did
+#  for each reading as it was stored, and as the generation graph now does 
+#  for all of the readings when it is drawn
+# 
+def benchmarkGenerationSplit(iterations, mix):
+    import pytz
+    import numpy as np
+    from electricitygeneration import CurrentCostElectricityGeneration, SOURCES, mixVector
+
+    passed = True
+    elecgen = CurrentCostElectricityGeneration()
+    starttime = datetime.datetime.now(pytz.utc)
+    dates = [ starttime + datetime.timedelta(seconds=6 * i) for i in range(GENERATION_SPLIT_READINGS) ]
+    readings = [ 0.2 + (i % 50) * 0.05 for i in range(GENERATION_SPLIT_READINGS) ]
+
+    # the mix in use when each reading was taken
+    mixes = []
+    changeevery = GENERATION_SPLIT_READINGS / GENERATION_SPLIT_CHANGES
+    for i in range(GENERATION_SPLIT_READINGS):
+        if i % changeevery == 0:
+            energymix = dict([ (source, mix[source] * (1 + i / changeevery)) for source in SOURCES ])
+            elecgen.mixChanges.append((dates[i], mixVector(energymix)))
+        mixes.append(energymix)
+
+    def splitEachReading():
+        return [ dict([ (source, (mixes[i][source] / 100) * readings[i]) for source in SOURCES ])
+                 for i in range(GENERATION_SPLIT_READINGS) ]
+    runs = max(iterations / 1000, 1)
+    timeRuns("genmix  - split %d readings as stored" % GENERATION_SPLIT_READINGS, splitEachReading, runs)
+    timeRuns("genmix  - split %d readings when drawn" % GENERATION_SPLIT_READINGS, lambda: elecgen.splitBySource(dates, readings), runs)
+
+    expected = splitEachReading()
+    split = elecgen.splitBySource(dates, readings)
+    for i, source in enumerate(SOURCES):
+        if not np.allclose(split[i], [ reading[source] for reading in expected ]):
+            passed = False
+            print "  genmix  - FAILED - %s readings differ" % source
+
+    if benchmarkGenerationGraph(iterations, dates, readings, elecgen.mixChanges) == False:
+        passed = False
+    return passed
+
+#
+# draw the generation graph for the live readings, and update it with new 
+#  readings, without displaying it
+# 
+def benchmarkGenerationGraph(iterations, dates, readings, mixchanges):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.dates import DateFormatter
+    from electricitygeneration import CurrentCostElectricityGeneration, SOURCES
+
+    elecgen = CurrentCostElectricityGeneration()
+    elecgen.mixChanges = mixchanges
+    def drawGraph():
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        elecgen.initialiseGraph(list(dates), list(readings), figure.add_subplot(111), DateFormatter('%H:%M'))
+        figure.canvas.draw()
+    def updateGraph():
+        dates.append(dates[-1] + datetime.timedelta(seconds=6))
+        readings.append(readings[-1])
+        elecgen.updateGraph(dates, readings)
+    runs = max(iterations / 1000, 1)
+    timeRuns("genmix  - draw graph of %d readings" % len(dates), drawGraph, runs)
+    timeRuns("genmix  - update graph with a reading", updateGraph, runs)
+
+    passed = True
+    if len(elecgen.livegraph.patches) != len(SOURCES) or len(elecgen.xvalues) != len(dates):
+        passed = False
+        print "  genmix  - FAILED - graph not updated in place"
+    return passed
+
+
+# modules which should be usable without a GUI, and the libraries they 
+#  should not import
+HEADLESS_MODULES   = [ 'tracer', 'currentcostparser', 'currentcostdataconvert', 
+                       'currentcostdb', 'currentcostserialconn', 
+                       'currentcostserialreader', 'currentcostlivebatcher',
+                       'currentcostmqttpackets', 'currentcostmqttbroker', 
+                       'currentcostmqttsession', 
+                       'currentcostmqttpublish', 'currentcostdata',
+                       'currentcostdatafunctions', 'currentcostwebfetch',
+                       'nationalgriddata', 'gridfueltypes', 'gridsourcedata', 
+                       'currentcostgridstore' ]
+GUI_ONLY_LIBRARIES = [ 'wx', 'matplotlib', 'scipy', 'pylab' ]
+
+# number of times each module is imported - the fastest time is reported
+IMPORT_RUNS = 5
+
+IMPORT_TIMING_CODE = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print elapsed
+print ",".join(sorted(sys.modules.keys()))
+"""
+
+def benchmarkImports(iterations):
+    print "import modules used without a GUI (best of %d runs)" % IMPORT_RUNS
+
+    passed = True
+    codedir = os.path.dirname(os.path.abspath(__file__))
+    for modulename in HEADLESS_MODULES:
+        best = None
+        for i in range(IMPORT_RUNS):
+            output = subprocess.Popen([ sys.executable, '-c', IMPORT_TIMING_CODE % modulename ], 
+                                      cwd=codedir, stdout=subprocess.PIPE).communicate()[0]
+            elapsed, loaded = output.strip().split('\n')[-2:]
+            if best == None or float(elapsed) < best:
+                best = float(elapsed)
+        loaded = loaded.split(',')
+        unwanted = [ library for library in GUI_ONLY_LIBRARIES if library in loaded ]
+        if len(unwanted) > 0:
+            passed = False
+            print "  %-40s %8.3f secs  FAILED - imported %s" % (modulename, best, ", ".join(unwanted))
+        else:
+            print "  %-40s %8.3f secs  %4d modules loaded" % (modulename, best, len(loaded))
+    return passed
+
+
+# number of live updates, and history bursts, read from the simulated meter
+SIMULATED_LIVE_UPDATES   = 2000
+SIMULATED_HISTORY_BURSTS = 5
+# seconds between live updates from the simulated meter
+SIMULATED_INTERVAL = 0.001
+# give up if the simulated meter hasn't been read by then (seconds)
+SIMULATED_TIMEOUT = 120
+# number of live updates read while also reading history updates
+SIMULATED_SHARED_LIVE_UPDATES = 500
+# seconds between live updates when measuring how long it takes to cancel
+SIMULATED_QUIET_INTERVAL = 10
+
+#
+# receives live readings in place of the GUI, recording how long each took 
+#  to arrive from the simulated meter
+# 
+class LiveReadingCollector():
+    def __init__(self, simulator, connection, expected):
+        self.simulator = simulator
+        self.connection = connection
+        self.expected = expected
+        self.latencies = []
+        self.errors = []
+    def updateGraph(self, ccreading, meterid=None):
+        received = time.time()
+        sent = self.simulator.getSendTime(round(ccreading * 1000))
+        if sent != None:
+            self.latencies.append(received - sent)
+        if len(self.latencies) >= self.expected:
+            self.connection.Disconnect()
+    def exitOnError(self, errmsg):
+        self.errors.append(errmsg)
+
+#
+# receives notifications from the history connection in place of the GUI
+# 
+class HistoryCollector():
+    def __init__(self, connection, expected):
+        self.connection = connection
+        self.expected = expected
+        self.bursts = 0
+        self.errors = []
+    def updateGraphs(self):
+        self.bursts += 1
+        if self.bursts >= self.expected:
+            self.connection.Disconnect()
+    def exitOnError(self, errmsg):
+        self.errors.append(errmsg)
+
+def benchmarkSerial(iterations):
+    # imported here as the simulator is only available on some platforms
+    import threading
+    from currentcostsimulator  import CurrentCostSimulator
+    from currentcostserialconn import CurrentCostConnection
+    from currentcostcomlive    import CurrentCostSerialLiveConnection
+    from currentcostcomhistory import CurrentCostSerialHistoryConnection
+    from tracer                import percentile
+
+    print "read updates from a simulated CC128 meter (with 1% garbage and 1% split updates)"
+
+    passed = True
+
+    # live updates
+    simulator = CurrentCostSimulator()
+    simulator.interval = SIMULATED_INTERVAL
+    simulator.garbageRate = 0.01
+    simulator.splitRate = 0.01
+    simulator.start()
+    connection = CurrentCostConnection()
+    try:
+        connection.connect(simulator.portname)
+        # ignore anything written before we were ready to read it
+        connection.connection.flushInput()
+
+        live = CurrentCostSerialLiveConnection()
+        collector = LiveReadingCollector(simulator, live, SIMULATED_LIVE_UPDATES)
+        timeout = threading.Timer(SIMULATED_TIMEOUT, live.Disconnect)
+        timeout.start()
+        start = time.time()
+        live.EstablishConnection(connection, collector)
+        elapsed = time.time() - start
+        timeout.cancel()
+    finally:
+        connection.disconnect()
+        simulator.close()
+
+    latencies = sorted(collector.latencies)
+    if len(latencies) < SIMULATED_LIVE_UPDATES or len(collector.errors) > 0:
+        passed = False
+        print "  live    - FAILED - received %d of %d updates %s" % (len(latencies), SIMULATED_LIVE_UPDATES, collector.errors)
+    else:
+        print "  %-40s %8.3f secs  %10.0f /sec" % ("live    - %d updates" % len(latencies), elapsed, len(latencies) / elapsed)
+        print "  %-40s %8.2f ms    p95 %6.2f ms  max %6.2f ms" % ("live    - latency p50", 
+                                                                 percentile(latencies, 50) * 1000, 
+                                                                 percentile(latencies, 95) * 1000,
+                                                                 latencies[-1] * 1000)
+
+    # history updates - stored in a temporary database
+    dbfile, dbfilename = tempfile.mkstemp(suffix='.ccd')
+    os.close(dbfile)
+    simulator = CurrentCostSimulator()
+    simulator.interval = 0
+    simulator.historyEvery = 1
+    simulator.start()
+    connection = CurrentCostConnection()
+    try:
+        connection.connect(simulator.portname)
+
+        history = CurrentCostSerialHistoryConnection()
+        collector = HistoryCollector(history, SIMULATED_HISTORY_BURSTS)
+        timeout = threading.Timer(SIMULATED_TIMEOUT, history.Disconnect)
+        timeout.start()
+        start = time.time()
+        history.EstablishConnection(connection, collector, dbfilename)
+        elapsed = time.time() - start
+        timeout.cancel()
+    finally:
+        connection.disconnect()
+        simulator.close()
+        os.remove(dbfilename)
+
+    if collector.bursts < SIMULATED_HISTORY_BURSTS or len(collector.errors) > 0:
+        passed = False
+        print "  history - FAILED - received %d of %d bursts %s" % (collector.bursts, SIMULATED_HISTORY_BURSTS, collector.errors)
+    else:
+        updates = collector.bursts * len(simulator.historyXML())
+        print "  %-40s %8.3f secs  %10.0f /sec" % ("history - %d updates" % updates, elapsed, updates / elapsed)
+
+    # live and history connections sharing a port - both should see every 
+    #  update from the meter
+    dbfile, dbfilename = tempfile.mkstemp(suffix='.ccd')
+    os.close(dbfile)
+    simulator = CurrentCostSimulator()
+    simulator.interval = SIMULATED_INTERVAL
+    simulator.historyEvery = SIMULATED_SHARED_LIVE_UPDATES / SIMULATED_HISTORY_BURSTS
+    simulator.start()
+    connection = CurrentCostConnection()
+    try:
+        connection.connect(simulator.portname)
+        connection.connection.flushInput()
+
+        live = CurrentCostSerialLiveConnection()
+        livecollector = LiveReadingCollector(simulator, live, SIMULATED_SHARED_LIVE_UPDATES)
+        history = CurrentCostSerialHistoryConnection()
+        historycollector = HistoryCollector(history, SIMULATED_HISTORY_BURSTS - 1)
+        timeouts = [ threading.Timer(SIMULATED_TIMEOUT, live.Disconnect),
+                     threading.Timer(SIMULATED_TIMEOUT, history.Disconnect) ]
+        for timeout in timeouts:
+            timeout.start()
+        historythread = threading.Thread(target=history.EstablishConnection, 
+                                         args=(connection, historycollector, dbfilename))
+        historythread.start()
+        live.EstablishConnection(connection, livecollector)
+        historythread.join()
+        for timeout in timeouts:
+            timeout.cancel()
+    finally:
+        connection.disconnect()
+        simulator.close()
+        os.remove(dbfilename)
+
+    if len(livecollector.latencies) < SIMULATED_SHARED_LIVE_UPDATES or \
+       historycollector.bursts < SIMULATED_HISTORY_BURSTS - 1 or \
+       len(livecollector.errors + historycollector.errors) > 0:
+        passed = False
+        print "  shared  - FAILED - received %d live updates and %d history bursts %s" % (len(livecollector.latencies), 
+                                                                                         historycollector.bursts,
+                                                                                         livecollector.errors + historycollector.errors)
+    else:
+        print "  %-40s %8d live    %10d history bursts" % ("shared  - live and history from one port", 
+                                                          len(livecollector.latencies), 
+                                                          historycollector.bursts)
+
+    # cancelling while the meter is quiet - we shouldn't have to wait for the
+    #  next update, or for a read to time out
+    simulator = CurrentCostSimulator()
+    simulator.interval = SIMULATED_QUIET_INTERVAL
+    simulator.start()
+    connection = CurrentCostConnection()
+    try:
+        connection.connect(simulator.portname)
+
+        live = CurrentCostSerialLiveConnection()
+        collector = LiveReadingCollector(simulator, live, SIMULATED_LIVE_UPDATES)
+        livethread = threading.Thread(target=live.EstablishConnection, args=(connection, collector))
+        livethread.start()
+        time.sleep(0.5)
+        start = time.time()
+        live.Disconnect()
+        livethread.join(SIMULATED_TIMEOUT)
+        elapsed = time.time() - start
+    finally:
+        connection.disconnect()
+        simulator.close()
+
+    if livethread.isAlive() or connection.isConnected():
+        passed = False
+        print "  cancel  - FAILED - still reading after %.3f secs" % elapsed
+    else:
+        print "  %-40s %8.2f ms" % ("cancel  - disconnect while quiet", elapsed * 1000)
+
+    return passed
+
+
+BENCHMARKS = { 'parse'       : benchmarkParse,
+               'fanout'      : benchmarkFanOut,
+               'flood'       : benchmarkFlood,
+               'genmix'      : benchmarkGenerationMix,
+               'griddb'      : benchmarkGridData,
+               'mqtt'        : benchmarkMQTT,
+               'mqtthistory' : benchmarkMQTTHistory,
+               'imports'     : benchmarkImports,
+               'serial'      : benchmarkSerial,
+               'webfetch'    : benchmarkWebFetch }
+
+
+def usage():
+    print "usage: python currentcostbenchmarks.py [--iterations=N] [" + "|".join(sorted(BENCHMARKS.keys())) + " ...]"
+
+
+if __name__ == "__main__":
+    try:
+        options, names = getopt.getopt(sys.argv[1:], 'h', ['iterations=', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    iterations = 10000
+
+    try:
+        for opt, arg in options:
+            if opt == '--iterations':
+                iterations = int(arg)
+            elif opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+    except ValueError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    if len(names) == 0:
+        names = sorted(BENCHMARKS.keys())
+    if len([ name for name in names if name not in BENCHMARKS ]) > 0:
+        usage()
+        sys.exit(2)
+
+    failed = False
+    for name in names:
+        if BENCHMARKS[name](iterations) == False:
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -25,17 +25,23 @@ import os
 import serial
 import time
 import string
+import Queue
 
-from currentcostparser import CurrentCostDataParser
-from currentcostdb     import CurrentCostDB
-from tracer            import CurrentCostTracer 
+from currentcostparser       import CurrentCostDataParser
+from currentcostdb           import CurrentCostDB
+from currentcostserialreader import getSerialReader
+from tracer                  import CurrentCostTracer 
 
 # class for logging diagnostics
 trc = CurrentCostTracer()
 
 #
-#  
+#  Stores history data received from a CurrentCost meter
 # 
+#  Data is read from the meter and parsed by a CurrentCostSerialReader, which
+#   can share it with a live connection to the same meter. History data is 
+#   queued for the thread that called EstablishConnection, which has the 
+#   connection to the database.
 # 
 #  Dale Lane (http://dalelane.co.uk/blog)
 
@@ -44,6 +50,15 @@ class CurrentCostSerialHistoryConnection():
 
     guicallback = None
 
+    # history data received from the meter waiting to be stored, and 
+    #  HISTORY_FINISHED when the meter has finished sending history data - 
+    #  None is queued when we are disconnected
+    updates = None
+    HISTORY_FINISHED = 'finished'
+
+    # error reported by the reader, if it gave up on the meter
+    readerErrorMsg = None
+
     #
     # Establish a connection to the CurrentCost meter
     # 
@@ -53,6 +68,8 @@ class CurrentCostSerialHistoryConnection():
         self.ser = comportobj
         self.toCancel = False
         self.guicallback = guihandle
+        self.updates = Queue.Queue()
+        self.readerErrorMsg = None
 
         myparser = CurrentCostDataParser()
 
@@ -70,59 +87,77 @@ class CurrentCostSerialHistoryConnection():
         dbconnection.InitialiseDB(dbfilelocation)
 
 
+        reader = getSerialReader(comportobj)
+        reader.addSubscriber(self)
+
         #
-        # look for the current reading in the data
+        # store history data as it is received
         # 
-        line = ""
         receivedHistory = False
         while self.toCancel == False:
+            currentcoststruct = self.updates.get()
+            if currentcoststruct == None:
+                break
             try:
-                line = self.ser.readUpdate()
-
-                # try to parse the XML
-                currentcoststruct = myparser.parseCurrentCostXML(line)
-        
-                if currentcoststruct != None:
-                    if 'hist' in currentcoststruct['msg']:
-                        # we have received history data - parse and store the CurrentCost 
-                        #  data in the datastore
-                        # the parser will return the number of updates still expected 
-                        #  (0 if this was the last or only expected update)
-                        myparser.storeTimedCurrentCostData(dbconnection)
-                        receivedHistory = True
-                    elif receivedHistory == True:
-                        # we received live data only
-                        # if we have received un-graphed history data, we refresh the
-                        # graphs now
-                        trc.Trace("finished receiving history data - need to redraw graphs")
-                        self.guicallback.updateGraphs()
-                        receivedHistory = False
-                
+                if currentcoststruct != self.HISTORY_FINISHED:
+                    # we have received history data - store the CurrentCost 
+                    #  data in the datastore
+                    myparser.storeTimedCurrentCostData(dbconnection, currentcoststruct)
+                    receivedHistory = True
+                elif receivedHistory == True:
+                    # we received live data only
+                    # if we have received un-graphed history data, we refresh the
+                    # graphs now
+                    trc.Trace("finished receiving history data - need to redraw graphs")
+                    self.guicallback.updateGraphs()
+                    receivedHistory = False
+
             except Exception, exception:
                 if self.toCancel == False:
-                    self.guicallback.exitOnError('Error reading from COM port: ' + str(exception))
-                    trc.Error("Error when closing COM port")
+                    self.toCancel = True
+                    self.guicallback.exitOnError('Error storing data from COM port: ' + str(exception))
+                    trc.Error("Error storing data from COM port")
                     trc.Error(str(exception))
-                    trc.FunctionExit("EstablishConnection")
-                    return
 
+        if self.readerErrorMsg != None and self.toCancel == False:
+            self.guicallback.exitOnError(self.readerErrorMsg)
 
-        # cleanup
-        dbconnection.CloseDB()
-
+        # cleanup - the serial port is closed once nothing else is using it
         try:
-            self.ser.disconnect()
+            reader.removeSubscriber(self)
         except Exception, exc:
             self.guicallback.exitOnError('Error when closing COM port')
             trc.Error("Error when closing COM port")
             trc.Error(str(exc))
 
+        dbconnection.CloseDB()
+
         trc.FunctionExit("EstablishConnection")
 
+    #
+    # called on the reader's thread with history data received from the meter
+    # 
+    def historyReceived(self, currentcoststruct):
+        self.updates.put(currentcoststruct)
+
+    def historyFinished(self):
+        self.updates.put(self.HISTORY_FINISHED)
+
+    #
+    # called if the reader gives up on the meter
+    # 
+    def readerError(self, errmsg):
+        self.readerErrorMsg = errmsg
+        self.updates.put(None)
+
     #
     # Disconnect from the serial port
     # 
     def Disconnect(self):
         self.toCancel = True
-        self.ser.disconnect()
+        if self.updates != None:
+            self.updates.put(None)
+        else:
+            # we never started reading
+            self.ser.disconnect()
 
@@ -25,6 +25,9 @@ import os
 import serial
 import time
 import string
+import threading
+
+from currentcostserialreader import getSerialReader, parseLiveXML
 
 # this class provides logging and diagnostics
 from tracer                 import CurrentCostTracer
@@ -39,8 +42,14 @@ trc = CurrentCostTracer()
 #   a floating point kW value which is returned to the GUI for displaying on 
 #   a live data graph.
 # 
-#  This continues until Disconnect is called, at which point the serial port
-#   is closed.
+#  Data is read from the meter and parsed by a CurrentCostSerialReader, which
+#   can share it with a history connection to the same meter. This 
+#   continues until Disconnect is called, at which point the serial port
+#   is closed (unless it is still being used for history data).
+# 
+#  If reading from the meter fails (e.g. because the USB cable is briefly 
+#   disconnected) the reader tries to reconnect. The GUI is only told about 
+#   the error if it can't reconnect.
 # 
 # 
 #  Dale Lane (http://dalelane.co.uk/blog)
@@ -51,9 +60,16 @@ class CurrentCostSerialLiveConnection():
     numberOfErrors = 0
     guicallback = None
 
+    # set when we are disconnected - EstablishConnection waits for this
+    cancelled = None
+    # reads data from the meter
+    reader = None
+
     #
     # Establish a connection to the CurrentCost meter
     # 
+    #  returns once we are disconnected
+    # 
     def EstablishConnection(self, comportobj, guihandle):
         global trc
         trc.FunctionEntry("currentcostcomlive :: EstablishConnection")
@@ -61,54 +77,62 @@ class CurrentCostSerialLiveConnection():
         self.guicallback = guihandle
         self.ser = comportobj
         self.toCancel = False
+        self.cancelled = threading.Event()
         self.numberOfErrors = 0
-        
-        #
-        # look for the current reading in the data
-        # 
-        line = ""
-        while self.toCancel == False:
-            try:
-                line = self.ser.readUpdate()
-
-                try:
-                    ccreading = self.parseLiveXML(line)
-                    trc.Trace("reading from live XML: " + str(ccreading))
-                    if ccreading >= 0:
-                        guihandle.updateGraph(ccreading)
-                        self.numberOfErrors = 0
-                except Exception, err:
-                    trc.Trace("error encountered parsing XML: " + str(err))
-                    # Exiting on a single garbled string from the 
-                    #  serial port is a bit extreme - it isn't unusual 
-                    #  to get a partial string, particularly if we've 
-                    #  been reading from the serial port for a few 
-                    #  hours
-                    # So we count the number of times we hit an error
-                    #  and only exit after we see ten of them
-                    if self.numberOfErrors < 10:
-                        self.numberOfErrors += 1
-                    else:
-                        guihandle.exitOnError('Unable to parse reading from meter: ' + str(line))
-                        trc.Trace("encountered our tenth error - quitting")
-                        trc.FunctionExit("currentcostcomlive :: EstablishConnection")
-                        return
-            except Exception, exception:
-                trc.Trace("encountered error: " + str(exception))
-                if self.toCancel == False:
-                    guihandle.exitOnError('Error reading from COM port: ' + str(exception))
-                    trc.FunctionExit("currentcostcomlive :: EstablishConnection")
-                    return
-
-        try:
-            trc.Trace("disconnecting")
-            self.ser.disconnect()
-        except:
-            self.guicallback.exitOnError('Error when closing COM port')
+
+        # live readings from the meter are passed to liveReadingReceived on 
+        #  the reader's thread
+        self.reader = getSerialReader(comportobj)
+        self.reader.addSubscriber(self)
+        self.cancelled.wait()
+        self.reader.removeSubscriber(self)
 
         trc.FunctionExit("currentcostcomlive :: EstablishConnection")
 
 
+    #
+    # called with each live reading from the meter
+    # 
+    def liveReadingReceived(self, ccreading):
+        global trc
+        if self.toCancel:
+            return
+        trc.Trace("reading from live XML: %s", ccreading)
+        self.guicallback.updateGraph(ccreading, self.ser.meterid)
+        self.numberOfErrors = 0
+
+    #
+    # called when live data from the meter couldn't be parsed
+    # 
+    def frameError(self, line, err):
+        global trc
+        if self.toCancel:
+            return
+        # Exiting on a single garbled string from the 
+        #  serial port is a bit extreme - it isn't unusual 
+        #  to get a partial string, particularly if we've 
+        #  been reading from the serial port for a few 
+        #  hours
+        # So we count the number of times we hit an error
+        #  and only exit after we see ten of them
+        if self.numberOfErrors < 10:
+            self.numberOfErrors += 1
+        else:
+            trc.Trace("encountered our tenth error - quitting")
+            self.toCancel = True
+            self.guicallback.exitOnError('Unable to parse reading from meter: ' + str(line))
+            self.cancelled.set()
+
+    #
+    # called if the reader gives up on the meter
+    # 
+    def readerError(self, errmsg):
+        if self.toCancel == False:
+            self.toCancel = True
+            self.guicallback.exitOnError(errmsg)
+        self.cancelled.set()
+
+
     #
     # Parse live XML
     # 
@@ -116,54 +140,7 @@ class CurrentCostSerialLiveConnection():
     #  return the sum of them
     # 
     def parseLiveXML(self, line):
-
-        START_TAG_LENGTH = 12    # 12 is the length of the "<chX><watts>" string
-        END_TAG_LENGTH = 14    # 14 is the length of the "</watts></chX>" string
-
-        ccreading = 0
-
-        idx = line.find('<ch1><watts>')
-        if idx <= 0:
-            # raise Exception('Unable to find an opening ch1 tag')
-            return -1
-        idx += START_TAG_LENGTH
-
-        endidx = line.find('</watts></ch1>', idx)
-        if endidx <= 0:
-            # raise Exception('Unable to find a closing ch1 tag')
-            return -1
-
-        substr = line[idx : endidx]
-
-        ccreading += float(float(substr) / 1000)
-
-        idx = line.find('<ch2><watts>', endidx)
-        if idx <= 0:
-            return ccreading
-        idx += START_TAG_LENGTH
-
-        endidx = line.find('</watts></ch2>', idx)
-        if endidx <= 0:
-            return ccreading
-
-        substr = line[idx : endidx]
-
-        ccreading += float(float(substr) / 1000)
-
-        idx = line.find('<ch3><watts>', endidx)
-        if idx <= 0:
-            return ccreading
-        idx += START_TAG_LENGTH
-
-        endidx = line.find('</watts></ch3>', idx)
-        if endidx <= 0:
-            return ccreading
-
-        substr = line[idx : endidx]
-
-        ccreading += float(float(substr) / 1000)
-
-        return ccreading
+        return parseLiveXML(line)
 
 
 
@@ -172,5 +149,9 @@ class CurrentCostSerialLiveConnection():
     # 
     def Disconnect(self):
         self.toCancel = True
-        self.ser.disconnect()
+        if self.cancelled != None:
+            self.cancelled.set()
+        else:
+            # we never started reading
+            self.ser.disconnect()
 
@@ -24,6 +24,7 @@
 import datetime
 import csv
 import os
+import numpy
 
 
 
@@ -46,69 +47,35 @@ import os
 # 
 class CurrentCostDataFunctions():
 
-    def ParseCurrentCostXML(self, ccdb, newupd):
-        today = datetime.date.today()
-        #
-        ccdb.StoreMonthData(self.GetOldMonth(today, 1),  newupd.WattsMonth01)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 2),  newupd.WattsMonth02)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 3),  newupd.WattsMonth03)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 4),  newupd.WattsMonth04)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 5),  newupd.WattsMonth05)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 6),  newupd.WattsMonth06)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 7),  newupd.WattsMonth07)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 8),  newupd.WattsMonth08)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 9),  newupd.WattsMonth09)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 10), newupd.WattsMonth10)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 11), newupd.WattsMonth11)
-        ccdb.StoreMonthData(self.GetOldMonth(today, 12), newupd.WattsMonth12)
-        #
-        ccdb.StoreDayData(self.GetOldDay(today, 1),  newupd.WattsDay01)
-        ccdb.StoreDayData(self.GetOldDay(today, 2),  newupd.WattsDay02)
-        ccdb.StoreDayData(self.GetOldDay(today, 3),  newupd.WattsDay03)
-        ccdb.StoreDayData(self.GetOldDay(today, 4),  newupd.WattsDay04)
-        ccdb.StoreDayData(self.GetOldDay(today, 5),  newupd.WattsDay05)
-        ccdb.StoreDayData(self.GetOldDay(today, 6),  newupd.WattsDay06)
-        ccdb.StoreDayData(self.GetOldDay(today, 7),  newupd.WattsDay07)
-        ccdb.StoreDayData(self.GetOldDay(today, 8),  newupd.WattsDay08)
-        ccdb.StoreDayData(self.GetOldDay(today, 9),  newupd.WattsDay09)
-        ccdb.StoreDayData(self.GetOldDay(today, 10), newupd.WattsDay10)
-        ccdb.StoreDayData(self.GetOldDay(today, 11), newupd.WattsDay11)
-        ccdb.StoreDayData(self.GetOldDay(today, 12), newupd.WattsDay12)
-        ccdb.StoreDayData(self.GetOldDay(today, 13), newupd.WattsDay13)
-        ccdb.StoreDayData(self.GetOldDay(today, 14), newupd.WattsDay14)
-        ccdb.StoreDayData(self.GetOldDay(today, 15), newupd.WattsDay15)
-        ccdb.StoreDayData(self.GetOldDay(today, 16), newupd.WattsDay16)
-        ccdb.StoreDayData(self.GetOldDay(today, 17), newupd.WattsDay17)
-        ccdb.StoreDayData(self.GetOldDay(today, 18), newupd.WattsDay18)
-        ccdb.StoreDayData(self.GetOldDay(today, 19), newupd.WattsDay19)
-        ccdb.StoreDayData(self.GetOldDay(today, 20), newupd.WattsDay20)
-        ccdb.StoreDayData(self.GetOldDay(today, 21), newupd.WattsDay21)
-        ccdb.StoreDayData(self.GetOldDay(today, 22), newupd.WattsDay22)
-        ccdb.StoreDayData(self.GetOldDay(today, 23), newupd.WattsDay23)
-        ccdb.StoreDayData(self.GetOldDay(today, 24), newupd.WattsDay24)
-        ccdb.StoreDayData(self.GetOldDay(today, 25), newupd.WattsDay25)
-        ccdb.StoreDayData(self.GetOldDay(today, 26), newupd.WattsDay26)
-        ccdb.StoreDayData(self.GetOldDay(today, 27), newupd.WattsDay27)
-        ccdb.StoreDayData(self.GetOldDay(today, 28), newupd.WattsDay28)
-        ccdb.StoreDayData(self.GetOldDay(today, 29), newupd.WattsDay29)
-        ccdb.StoreDayData(self.GetOldDay(today, 30), newupd.WattsDay30)
-        ccdb.StoreDayData(self.GetOldDay(today, 31), newupd.WattsDay31)
-        #
+    #
+    # how each type of history data received via MQTT is stored: the function
+    #  that gives the time of the n'th value (values are most recent first), 
+    #  and the db function that stores them all in one go
+    # 
+    HISTORY_STORES = { 'hours'  : ('GetHistoryHour',  'StoreHourDataMany'),
+                       'days'   : ('GetHistoryDay',   'StoreDayDataMany'),
+                       'months' : ('GetHistoryMonth', 'StoreMonthDataMany') }
+
+    #
+    # store history data received via MQTT - a list of 
+    #  CurrentCostHistoryUpdate objects (see currentcostdata.py)
+    # 
+    #  any number of values can be stored for each type of data
+    # 
+    def StoreHistoryUpdates(self, ccdb, updates):
         currtime = datetime.datetime.now()
-        #
-        ccdb.StoreHourData(self.GetOldHour(currtime, 0),  newupd.kWattsHour02)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 2),  newupd.kWattsHour04)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 4),  newupd.kWattsHour06)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 6),  newupd.kWattsHour08)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 8),  newupd.kWattsHour10)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 10), newupd.kWattsHour12)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 12), newupd.kWattsHour14)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 14), newupd.kWattsHour16)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 16), newupd.kWattsHour18)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 18), newupd.kWattsHour20)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 20), newupd.kWattsHour22)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 22), newupd.kWattsHour24)
-        ccdb.StoreHourData(self.GetOldHour(currtime, 24), newupd.kWattsHour26)           
+        for update in updates:
+            timefn, storefn = self.HISTORY_STORES[update.datatype]
+            timefn = getattr(self, timefn)
+            timestamps = [ timefn(currtime, i) for i in range(len(update.values)) ]
+            getattr(ccdb, storefn)(timestamps, update.values)
+
+    def GetHistoryHour(self, currtime, n):
+        return self.GetOldHour(currtime, n * 2)
+    def GetHistoryDay(self, currtime, n):
+        return self.GetOldDay(currtime.date(), n + 1)
+    def GetHistoryMonth(self, currtime, n):
+        return self.GetOldMonth(currtime.date(), n + 1)
 
     #
     ######################### 
@@ -119,14 +86,9 @@ class CurrentCostDataFunctions():
     # 
 
     def GetOldMonth(self, referenceDate, monthsago):
-        newmonth = referenceDate.month - monthsago
-        newyear  = referenceDate.year
-    
-        if newmonth <= 0:
-            newmonth += 12
-            newyear -= 1
-    
-        return datetime.date(newyear, newmonth, 1)
+        # counted in months so that we can go back more than a year
+        months = (referenceDate.year * 12) + (referenceDate.month - 1) - monthsago
+        return datetime.date(months / 12, (months % 12) + 1, 1)
         
     def GetOldDay(self, referenceDate, daysago):
         newday = referenceDate.day - daysago
@@ -146,27 +108,8 @@ class CurrentCostDataFunctions():
         if referenceDate.hour % 2 == 0:
             hoursago = hoursago + 1
     
-        newhour = referenceDate.hour - hoursago
-        newday = referenceDate.day
-        newmonth = referenceDate.month
-        newyear = referenceDate.year
-    
-        if newhour < -24:
-            newhour += 48
-            d = datetime.timedelta(hours=hoursago)
-            sub = referenceDate - d
-            newday = sub.day
-            newmonth = sub.month
-            newyear = sub.year        
-        elif newhour < 0:
-            newhour += 24
-            d = datetime.timedelta(hours=hoursago)
-            sub = referenceDate - d
-            newday = sub.day
-            newmonth = sub.month
-            newyear = sub.year
-    
-        return datetime.datetime(newyear, newmonth, newday, newhour, 0, 0)
+        sub = referenceDate - datetime.timedelta(hours=hoursago)
+        return datetime.datetime(sub.year, sub.month, sub.day, sub.hour, 0, 0)
 
 
     #
@@ -274,3 +217,132 @@ class CurrentCostDataFunctions():
                 weekAvg[avday] = daysSum[i] / daysCount[i]
 
         return weekAvg
+
+    #
+    # array versions of the functions above
+    # 
+    #  timestamps are given as day numbers - the proleptic Gregorian ordinal 
+    #   of the day (as returned by date.toordinal), plus the time of day as a 
+    #   fraction. this is the same as matplotlib's date2num
+    # 
+    #  values of zero or less are ignored
+    # 
+    #  returns a dictionary containing arrays with a value for each hour of 
+    #   the day (or day of the week, starting with Monday):
+    #    'count'  - number of values 
+    #    'mean'   - average value (nan if there are no values)
+    #    and an array for each of the requested percentiles (e.g. 10, 50, 90),
+    #     keyed by the percentile
+    # 
+
+    def CalculateAverageDayArrays(self, timestamps, values, weekendsonly=True, percentiles=None):
+        timestamps = numpy.asarray(timestamps, dtype=float)
+        values     = numpy.asarray(values, dtype=float)
+
+        # the hour of the day (allowing for rounding errors in the fraction)
+        hours = numpy.floor(numpy.mod(timestamps, 1.0) * 24 + 0.0001).astype(int)
+        valid = values > 0
+        if weekendsonly:
+            valid &= weekdays(timestamps) >= 5
+
+        return groupedStatistics(hours[valid], values[valid], 24, percentiles)
+
+    def CalculateAverageWeekArrays(self, timestamps, values, percentiles=None):
+        timestamps = numpy.asarray(timestamps, dtype=float)
+        values     = numpy.asarray(values, dtype=float)
+
+        valid = values > 0
+
+        return groupedStatistics(weekdays(timestamps)[valid], values[valid], 7, percentiles)
+
+    #
+    # calculate an average day or week using the array functions, reading 
+    #  the data straight from the database
+    # 
+    #  returns the same dictionaries as CalculateAverageDay and 
+    #   CalculateAverageWeek, without creating a datetime for every value
+    # 
+    def CalculateAverageDayFromDB(self, ccdb):
+        hoursAvg = {}
+        rows = numpy.array(ccdb.GetHourDataAsDayNumbers(), dtype=float)
+        if len(rows) == 0:
+            return self.CalculateAverageDay({})
+        hoursStats = self.CalculateAverageDayArrays(rows[:,0], rows[:,1])
+        for i in range(0, 24):
+            if hoursStats['count'][i] != 0:
+                hoursAvg[datetime.datetime(2000, 1, 1, i, 0, 0)] = float(hoursStats['mean'][i])
+        return hoursAvg
+
+    def CalculateAverageWeekFromDB(self, ccdb):
+        weekAvg = {}
+        rows = numpy.array(ccdb.GetDayDataAsDayNumbers(), dtype=float)
+        if len(rows) == 0:
+            return self.CalculateAverageWeek({})
+        daysStats = self.CalculateAverageWeekArrays(rows[:,0], rows[:,1])
+        for i in range(0, 7):
+            if daysStats['count'][i] != 0:
+                weekAvg[datetime.datetime(2008, 9, i+1)] = float(daysStats['mean'][i])
+        return weekAvg
+
+    #
+    # convert a collection of data (a dictionary of dates or datetimes, as 
+    #  returned by CurrentCostDB) into the timestamps and values arrays used 
+    #  by the functions above
+    # 
+    def CollectionToArrays(self, datacollection):
+        timestamps = numpy.empty(len(datacollection))
+        values     = numpy.empty(len(datacollection))
+        i = 0
+        for k, v in datacollection.iteritems():
+            timestamps[i] = k.toordinal()
+            if isinstance(k, datetime.datetime):
+                timestamps[i] += (k.hour * 3600 + k.minute * 60 + k.second) / 86400.0
+            values[i] = v
+            i += 1
+        return timestamps, values
+
+
+#
+# day of the week (Monday is 0) for an array of day numbers
+# 
+def weekdays(timestamps):
+    return numpy.mod(numpy.floor(timestamps).astype(int) + 6, 7)
+
+#
+# calculate statistics for values in a number of groups - where groups is an
+#  array which identifies the group (from 0 to numgroups-1) for each value
+# 
+#  means are calculated using bincount. percentiles (using the same linear 
+#   interpolation as numpy.percentile) are all calculated from a single sort
+#   of the values by group
+# 
+def groupedStatistics(groups, values, numgroups, percentiles=None):
+    counts = numpy.bincount(groups, minlength=numgroups)
+    sums   = numpy.bincount(groups, weights=values, minlength=numgroups)
+
+    hasvalues = counts > 0
+
+    means = numpy.empty(numgroups)
+    means.fill(numpy.nan)
+    means[hasvalues] = sums[hasvalues] / counts[hasvalues]
+
+    stats = { 'count' : counts, 'mean' : means }
+
+    if percentiles:
+        # sort by group, then by value within each group
+        sortedvalues = values[numpy.lexsort((values, groups))]
+        starts = numpy.cumsum(counts) - counts
+        lasts  = starts + counts - 1
+
+        for percentile in percentiles:
+            position = starts + (counts - 1) * (percentile / 100.0)
+            lower = numpy.floor(position).astype(int)[hasvalues]
+            upper = numpy.minimum(lower + 1, lasts[hasvalues])
+            fraction = position[hasvalues] - lower
+
+            result = numpy.empty(numgroups)
+            result.fill(numpy.nan)
+            result[hasvalues] = (sortedvalues[lower] * (1 - fraction)) + (sortedvalues[upper] * fraction)
+            stats[percentile] = result
+
+    return stats
@@ -24,6 +24,16 @@
 from pysqlite2 import dbapi2 as sqlite
 import datetime, time
 
+from gridfueltypes import FUEL_TYPES, carbonIntensity
+
+# columns of the gridmix table which store the percentage of electricity 
+#  generated from each fuel type
+GRID_MIX_COLUMNS = [ fueltype.lower() for fueltype in FUEL_TYPES ] + [ 'unknown' ]
+
+# length of the periods that hourdata values are for - CurrentCost meters
+#  give hourly history data in 2-hour blocks
+HOUR_DATA_PERIOD = '+2 hours'
+
 #
 # We use a SQLite database to persist data - both historical CurrentCost data,
 #   and user preferences and settings.
@@ -38,6 +48,18 @@ class CurrentCostDB():
     # connection to the database
     connection = None
 
+    # if True, data stored is not committed until CommitBatch is called
+    batching = False
+
+    # identifies the meter that data stored through this connection came 
+    #  from, when logging data from more than one meter
+    # 
+    #  data from the meter used by the GUI (meterid None) is stored in the 
+    #   hourdata, daydata and monthdata tables. data from other meters is 
+    #   stored in meterhourdata, meterdaydata and metermonthdata tagged with
+    #   the meter id
+    meterid = None
+
     # what is the path to the database used to store CurrentCost data?
     dbLocation = ""
 
@@ -67,10 +89,55 @@ class CurrentCostDB():
         if not cursor.fetchone():
             cursor.execute('CREATE TABLE monthdata(d date unique, ccvalue REAL, uploaded INT)')
 
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="livedata" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE livedata(ts timestamp, ccvalue REAL, meterid TEXT)')
+        elif 'meterid' not in [ column[1] for column in cursor.execute('PRAGMA table_info(livedata)') ]:
+            cursor.execute('ALTER TABLE livedata ADD COLUMN meterid TEXT')
+
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="meterhourdata" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE meterhourdata(meterid TEXT, ts timestamp, ccvalue REAL, hourofday INT, UNIQUE(meterid, ts))')
+
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="meterdaydata" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE meterdaydata(meterid TEXT, d date, ccvalue REAL, dayofweek INT, UNIQUE(meterid, d))')
+
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="metermonthdata" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE metermonthdata(meterid TEXT, d date, ccvalue REAL, UNIQUE(meterid, d))')
+
+        # samples of National Grid data - one row each time the National Grid
+        #  website had new figures. the unique timestamps are indexed, so data
+        #  for a range of times can be found quickly
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="griddemand" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE griddemand(ts timestamp unique, demand INT, frequency REAL)')
+
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="gridmix" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE gridmix(ts timestamp unique, ' + 
+                           ", ".join([ column + ' REAL' for column in GRID_MIX_COLUMNS ]) + 
+                           ', intensity REAL)')
+
         cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="annotation" ORDER BY name')
         if not cursor.fetchone():
             cursor.execute('CREATE TABLE annotation(key INTEGER PRIMARY KEY AUTOINCREMENT, ts timestamp, timeoffset REAL, graphid INT, annotation TEXT, ccvalue REAL)')
 
+        # version counters for the tables of historical data
+        #  incremented by triggers whenever the data in a table is modified, 
+        #  so that the GUI can tell if graphs it has already drawn are stale
+        cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND NAME="datachanges" ORDER BY name')
+        if not cursor.fetchone():
+            cursor.execute('CREATE TABLE datachanges(tablename TEXT unique, version INT)')
+        for tablename in ['hourdata', 'daydata', 'monthdata']:
+            cursor.execute('INSERT OR IGNORE INTO datachanges(tablename, version) values(?, ?)',
+                           (tablename, 0))
+            for action in ['INSERT', 'UPDATE', 'DELETE']:
+                cursor.execute('CREATE TRIGGER IF NOT EXISTS ' + tablename + '_' + action.lower() + 
+                               ' AFTER ' + action + ' ON ' + tablename + 
+                               ' BEGIN UPDATE datachanges SET version = version + 1 WHERE tablename = "' + tablename + '"; END')
+
         self.connection.commit()
 
     #
@@ -141,20 +208,131 @@ class CurrentCostDB():
     #
     def StoreHourData(self, timestamp, ccvalue):
         if ccvalue > 0:
-            self.connection.execute('INSERT OR REPLACE INTO hourdata(ts, ccvalue, hourofday, uploaded) values(?, ?, ?, ?)',
-                                    (timestamp, ccvalue, timestamp.hour, 0))
-            self.connection.commit()
+            if self.meterid == None:
+                self.connection.execute('INSERT OR REPLACE INTO hourdata(ts, ccvalue, hourofday, uploaded) values(?, ?, ?, ?)',
+                                        (timestamp, ccvalue, timestamp.hour, 0))
+            else:
+                self.connection.execute('INSERT OR REPLACE INTO meterhourdata(meterid, ts, ccvalue, hourofday) values(?, ?, ?, ?)',
+                                        (self.meterid, timestamp, ccvalue, timestamp.hour))
+            if not self.batching:
+                self.connection.commit()
     def StoreDayData(self, timestamp, ccvalue):
         if ccvalue > 0:
-            self.connection.execute('INSERT OR REPLACE INTO daydata(d, ccvalue, dayofweek, uploaded) values(?, ?, ?, ?)',
-                                    (timestamp, ccvalue, timestamp.weekday(), 0))
-            self.connection.commit()
+            if self.meterid == None:
+                self.connection.execute('INSERT OR REPLACE INTO daydata(d, ccvalue, dayofweek, uploaded) values(?, ?, ?, ?)',
+                                        (timestamp, ccvalue, timestamp.weekday(), 0))
+            else:
+                self.connection.execute('INSERT OR REPLACE INTO meterdaydata(meterid, d, ccvalue, dayofweek) values(?, ?, ?, ?)',
+                                        (self.meterid, timestamp, ccvalue, timestamp.weekday()))
+            if not self.batching:
+                self.connection.commit()
     def StoreMonthData(self, timestamp, ccvalue):
         if ccvalue > 0:
-            self.connection.execute('INSERT OR REPLACE INTO monthdata(d, ccvalue, uploaded) values(?, ?, ?)',
-                                    (timestamp, ccvalue, 0))
+            if self.meterid == None:
+                self.connection.execute('INSERT OR REPLACE INTO monthdata(d, ccvalue, uploaded) values(?, ?, ?)',
+                                        (timestamp, ccvalue, 0))
+            else:
+                self.connection.execute('INSERT OR REPLACE INTO metermonthdata(meterid, d, ccvalue) values(?, ?, ?)',
+                                        (self.meterid, timestamp, ccvalue))
+            if not self.batching:
+                self.connection.commit()
+
+    #
+    # store a set of values at once - timestamps and ccvalues are sequences 
+    #  of the same length
+    # 
+    #  this is much quicker than storing them one at a time, and they are 
+    #   committed together
+    # 
+    def StoreHourDataMany(self, timestamps, ccvalues):
+        if self.meterid == None:
+            self.storeMany('INSERT OR REPLACE INTO hourdata(ts, ccvalue, hourofday, uploaded) values(?, ?, ?, ?)',
+                           [ (timestamp, ccvalue, timestamp.hour, 0) 
+                             for timestamp, ccvalue in self.positiveValues(timestamps, ccvalues) ])
+        else:
+            self.storeMany('INSERT OR REPLACE INTO meterhourdata(meterid, ts, ccvalue, hourofday) values(?, ?, ?, ?)',
+                           [ (self.meterid, timestamp, ccvalue, timestamp.hour) 
+                             for timestamp, ccvalue in self.positiveValues(timestamps, ccvalues) ])
+    def StoreDayDataMany(self, timestamps, ccvalues):
+        if self.meterid == None:
+            self.storeMany('INSERT OR REPLACE INTO daydata(d, ccvalue, dayofweek, uploaded) values(?, ?, ?, ?)',
+                           [ (timestamp, ccvalue, timestamp.weekday(), 0) 
+                             for timestamp, ccvalue in self.positiveValues(timestamps, ccvalues) ])
+        else:
+            self.storeMany('INSERT OR REPLACE INTO meterdaydata(meterid, d, ccvalue, dayofweek) values(?, ?, ?, ?)',
+                           [ (self.meterid, timestamp, ccvalue, timestamp.weekday()) 
+                             for timestamp, ccvalue in self.positiveValues(timestamps, ccvalues) ])
+    def StoreMonthDataMany(self, timestamps, ccvalues):
+        if self.meterid == None:
+            self.storeMany('INSERT OR REPLACE INTO monthdata(d, ccvalue, uploaded) values(?, ?, ?)',
+                           [ (timestamp, ccvalue, 0) 
+                             for timestamp, ccvalue in self.positiveValues(timestamps, ccvalues) ])
+        else:
+            self.storeMany('INSERT OR REPLACE INTO metermonthdata(meterid, d, ccvalue) values(?, ?, ?)',
+                           [ (self.meterid, timestamp, ccvalue) 
+                             for timestamp, ccvalue in self.positiveValues(timestamps, ccvalues) ])
+    # pairs of timestamp and value, for the values that are worth storing - 
+    #  values are converted from numpy types so that they're stored the same
+    #  way as values stored one at a time
+    def positiveValues(self, timestamps, ccvalues):
+        if hasattr(ccvalues, 'tolist'):
+            ccvalues = ccvalues.tolist()
+        return [ (timestamp, ccvalue) for timestamp, ccvalue in zip(timestamps, ccvalues) if ccvalue > 0 ]
+    def storeMany(self, sql, rows):
+        if len(rows) > 0:
+            self.connection.executemany(sql, rows)
+            if not self.batching:
+                self.connection.commit()
+
+    # live readings (in kW) received from a meter 
+    def StoreLiveData(self, timestamp, ccvalue):
+        self.connection.execute('INSERT INTO livedata(ts, ccvalue, meterid) values(?, ?, ?)',
+                                (timestamp, ccvalue, self.meterid))
+        if not self.batching:
             self.connection.commit()
 
+    #
+    # National Grid data - lists of (timestamp, demand, frequency) samples and
+    #  (timestamp, energymix) samples, where energymix is a dictionary of 
+    #  percentages as returned by ElectricityGenerationDataSource
+    # 
+    #  timestamps are stored to the second, so that they can be compared with
+    #   the times of other data in queries
+    # 
+    def StoreGridDemandMany(self, samples):
+        self.storeMany('INSERT OR REPLACE INTO griddemand(ts, demand, frequency) values(?, ?, ?)',
+                       [ (timestamp.replace(microsecond=0), demand, frequency) 
+                         for timestamp, demand, frequency in samples ])
+    def StoreGridMixMany(self, samples):
+        self.storeMany('INSERT OR REPLACE INTO gridmix(ts, ' + ", ".join(GRID_MIX_COLUMNS) + ', intensity) ' + 
+                       'values(' + ", ".join([ '?' ] * (len(GRID_MIX_COLUMNS) + 2)) + ')',
+                       [ tuple([ timestamp.replace(microsecond=0) ] + 
+                               [ energymix.get(column.upper(), 0.0) for column in GRID_MIX_COLUMNS ] + 
+                               [ carbonIntensity(energymix) ]) 
+                         for timestamp, energymix in samples ])
+
+    # ids of the meters that data has been stored for, other than the meter
+    #  used by the GUI
+    def GetMeterIds(self):
+        meterids = set()
+        for tablename in ['livedata', 'meterhourdata', 'meterdaydata', 'metermonthdata']:
+            for row in self.connection.execute('SELECT DISTINCT meterid FROM ' + tablename + ' WHERE meterid IS NOT NULL'):
+                meterids.add(row[0])
+        return sorted(meterids)
+
+    #
+    # storing a lot of data is much quicker if it is committed in a single
+    #  transaction rather than one row at a time
+    # 
+    #  data stored between StartBatch and CommitBatch is not committed to the
+    #   database (or seen by other connections) until CommitBatch is called
+    # 
+    def StartBatch(self):
+        self.batching = True
+    def CommitBatch(self):
+        self.connection.commit()
+        self.batching = False
+
     #
     ############################################################
     # helper functions for retrieving data from the database
@@ -165,20 +343,27 @@ class CurrentCostDB():
     # COUNT THE NUMBER OF OBJECTS IN THE DATABASE
 
     def CountMonthData(self):
-        cnt = 0
-        for row in self.connection.execute("SELECT * FROM monthdata"):
-            cnt += 1
-        return cnt
+        return self.connection.execute("SELECT COUNT(*) FROM monthdata").fetchone()[0]
     def CountDayData(self):
-        cnt = 0
-        for row in self.connection.execute("SELECT * FROM daydata"):
-            cnt += 1
-        return cnt
+        return self.connection.execute("SELECT COUNT(*) FROM daydata").fetchone()[0]
     def CountHourData(self):
-        cnt = 0
-        for row in self.connection.execute("SELECT * FROM hourdata"):
-            cnt += 1
-        return cnt
+        return self.connection.execute("SELECT COUNT(*) FROM hourdata").fetchone()[0]
+
+    # FIND THE RANGE OF VALUES IN THE DATABASE
+    # 
+    # returns a (lowest, highest) tuple - ignoring any zero values
+
+    def GetHourDataRange(self):
+        return self.connection.execute("SELECT MIN(ccvalue), MAX(ccvalue) FROM hourdata WHERE ccvalue > 0").fetchone()
+    def GetDayDataRange(self):
+        return self.connection.execute("SELECT MIN(ccvalue), MAX(ccvalue) FROM daydata WHERE ccvalue > 0").fetchone()
+
+    # IDENTIFY THE VERSION OF THE DATA IN THE DATABASE
+    # 
+    # returns a number which increases every time that historical data is 
+    #  stored or modified - by this or any other connection to the database
+    def GetDataVersion(self):
+        return self.connection.execute("SELECT SUM(version) FROM datachanges").fetchone()[0]
 
 
     ##################
@@ -217,9 +402,15 @@ class CurrentCostDB():
     # ideally, this function will no longer be required once the migration to 
     #  pysqlite is complete.
     # 
-    def GetMonthDataCollection(self):
+    # startdate and enddate (inclusive) can be used to only return data for 
+    #  a range of dates
+    # 
+    def GetMonthDataCollection(self, startdate=None, enddate=None):
         monthdatacollection = {}
-        for row in self.connection.execute("SELECT d, ccvalue FROM monthdata"):
+        if startdate != None:
+            startdate = datetime.date(startdate.year, startdate.month, 1)
+        query, params = self.prepareDateRangeQuery("SELECT d, ccvalue FROM monthdata", "d", startdate, enddate)
+        for row in self.connection.execute(query, params):
             monthdatacollection[row[0]] = row[1]
         return monthdatacollection
 
@@ -248,6 +439,15 @@ class CurrentCostDB():
                                 (daydataitem['timestamp'], daydataitem['ccvalue'], 1))
         self.connection.commit()
 
+    # get the recorded electricity usage for a single day, or None if we 
+    #  don't have a value for that day
+    def GetDayData(self, day):
+        row = self.connection.execute('SELECT ccvalue FROM daydata WHERE d = ?', (day,)).fetchone()
+        if row:
+            return row[0]
+        else:
+            return None
+
     # convert the database's store of day electricity usage into a 
     #  dictionary. 
     # 
@@ -260,9 +460,13 @@ class CurrentCostDB():
     # ideally, this function will no longer be required once the migration to 
     #  pysqlite is complete.
     # 
-    def GetDayDataCollection(self):
+    # startdate and enddate (inclusive) can be used to only return data for 
+    #  a range of dates
+    # 
+    def GetDayDataCollection(self, startdate=None, enddate=None):
         daydatacollection = {}
-        for row in self.connection.execute("SELECT d, ccvalue FROM daydata"):
+        query, params = self.prepareDateRangeQuery("SELECT d, ccvalue FROM daydata", "d", startdate, enddate)
+        for row in self.connection.execute(query, params):
             daydatacollection[row[0]] = row[1]
         return daydatacollection
 
@@ -303,10 +507,79 @@ class CurrentCostDB():
     # ideally, this function will no longer be required once the migration to 
     #  pysqlite is complete.
     # 
-    def GetHourDataCollection(self):
+    # startdate and enddate (inclusive) can be used to only return data for 
+    #  a range of dates
+    # 
+    def GetHourDataCollection(self, startdate=None, enddate=None):
         hourdatacollection = {}
-        for row in self.connection.execute("SELECT ts, ccvalue FROM hourdata"):
+        if startdate != None:
+            startdate = datetime.datetime(startdate.year, startdate.month, startdate.day)
+        if enddate != None:
+            enddate = datetime.datetime(enddate.year, enddate.month, enddate.day, 23, 59, 59)
+        query, params = self.prepareDateRangeQuery("SELECT ts, ccvalue FROM hourdata", "ts", startdate, enddate)
+        for row in self.connection.execute(query, params):
             hourdatacollection[row[0]] = row[1]
         return hourdatacollection
 
+    #
+    # get the stored hourly or daily electricity usage as a list of 
+    #  (day number, value) tuples - where the day number is the ordinal of the
+    #  day plus the time as a fraction of a day (as used by matplotlib)
+    # 
+    # sqlite does the date conversion, which avoids creating a datetime 
+    #  object for every row when the data is going to be processed as arrays
+    # 
+    def GetHourDataAsDayNumbers(self):
+        return self.connection.execute("SELECT julianday(ts) - 1721424.5, ccvalue FROM hourdata").fetchall()
+    def GetDayDataAsDayNumbers(self):
+        return self.connection.execute("SELECT julianday(d) - 1721424.5, ccvalue FROM daydata").fetchall()
+
+    #
+    # get the stored National Grid demand samples as a list of (timestamp, 
+    #  demand, frequency) tuples
+    # 
+    def GetGridDemandData(self, startdate=None, enddate=None):
+        query, params = self.prepareDateRangeQuery("SELECT ts, demand, frequency FROM griddemand", "ts", startdate, enddate)
+        return self.connection.execute(query + " ORDER BY ts", params).fetchall()
+
+    #
+    # get the stored hourly electricity usage alongside the carbon intensity 
+    #  of grid electricity at the time, as a list of (timestamp, kWh, g CO2 
+    #  per kWh) tuples
+    # 
+    #  the carbon intensity is the average of the samples of the generation 
+    #   mix taken during each period. if there weren't any, the last sample 
+    #   taken before it is used, as the mix is only sampled when it changes.
+    #   it is None if there are no samples from before the end of the period
+    # 
+    #  both lookups use the index on gridmix timestamps, so this is a single
+    #   query however many samples have been stored
+    # 
+    def GetHourDataWithCarbonIntensity(self, startdate=None, enddate=None):
+        query = "SELECT h.ts AS ts, h.ccvalue, " + \
+                "COALESCE((SELECT AVG(m.intensity) FROM gridmix m " + \
+                          "WHERE m.ts >= h.ts AND m.ts < datetime(h.ts, '" + HOUR_DATA_PERIOD + "')), " + \
+                         "(SELECT m.intensity FROM gridmix m " + \
+                          "WHERE m.ts < h.ts ORDER BY m.ts DESC LIMIT 1)) " + \
+                "FROM hourdata h"
+        query, params = self.prepareDateRangeQuery(query, "h.ts", startdate, enddate)
+        return self.connection.execute(query + " ORDER BY h.ts", params).fetchall()
+
+    #
+    # adds a WHERE clause to a query to restrict the rows returned to a 
+    #  range of dates, if one is provided
+    # 
+    def prepareDateRangeQuery(self, query, column, startdate, enddate):
+        conditions = []
+        params = []
+        if startdate != None:
+            conditions.append(column + " >= ?")
+            params.append(startdate)
+        if enddate != None:
+            conditions.append(column + " <= ?")
+            params.append(enddate)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params
+
 
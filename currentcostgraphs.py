@@ -42,8 +42,16 @@ from matplotlib.text import Text
 
 
 class Plot(wx.Panel):    
-    def __init__(self, parent, id = -1, dpi = None, **kwargs):
+    def __init__(self, parent, id = -1, dpi = None, renderer = None, rescaler = None, **kwargs):
         wx.Panel.__init__(self, parent, id=id, **kwargs)
+        # function used to draw the contents of this tab, and the key that 
+        #  identifies what the tab was showing when it was last drawn
+        self.renderer = renderer
+        self.renderedkey = None
+        # function used to change the units of a graph already drawn on this
+        #  tab, and the key that identifies the units last used
+        self.rescaler = rescaler
+        self.rescaledkey = None
         self.figure = mpl.figure.Figure(dpi=dpi, figsize=(2,2))
         self.canvas = Canvas(self, -1, self.figure)
         self.toolbar = Toolbar(self.canvas)
@@ -54,6 +62,16 @@ class Plot(wx.Panel):
         self.SetSizer(sizer)
 
 
+#
+# tabs can be given a renderer - a function which draws the contents of the tab
+# 
+#  tabs with a renderer are drawn on demand: only when they are displayed, and
+#   only if the key passed to refresh has changed since they were last drawn
+# 
+#  tabs can also be given a rescaler - a function which updates a graph that 
+#   has already been drawn to use different units. if only the rescale key 
+#   passed to refresh has changed, the rescaler is used instead of the renderer
+# 
 class PlotNotebook(wx.Panel):
     def __init__(self, parent, id = -1):
         # parent is a frame --> MyFrame (wx.Frame)
@@ -62,12 +80,51 @@ class PlotNotebook(wx.Panel):
         sizer = wx.BoxSizer()
         sizer.Add(self.nb, 1, wx.EXPAND)
         self.SetSizer(sizer)
+        # identifies what tabs with a renderer should currently be showing
+        self.renderkey = None
+        self.rescalekey = None
+        self.nb.Bind(wx.aui.EVT_AUINOTEBOOK_PAGE_CHANGED, self.onPageChanged)
 
-    def add(self,name="plot"):
-        page = Plot(self.nb)
+    def add(self,name="plot",renderer=None,rescaler=None):
+        page = Plot(self.nb, renderer=renderer, rescaler=rescaler)
         self.nb.AddPage(page,name)
         return page.figure
 
+    #
+    # the data or settings displayed by tabs has changed, as identified by 
+    #  a new renderkey
+    # 
+    # the tab currently displayed is redrawn now - other tabs will be redrawn
+    #  when they are next displayed
+    # 
+    def refresh(self, renderkey, rescalekey=None):
+        self.renderkey = renderkey
+        self.rescalekey = rescalekey
+        selected = self.nb.GetSelection()
+        if selected >= 0:
+            self.renderpage(self.nb.GetPage(selected))
+
+    def renderpage(self, page):
+        renderer = getattr(page, 'renderer', None)
+        if renderer == None or self.renderkey == None:
+            return
+        rescaler = getattr(page, 'rescaler', None)
+        if page.renderedkey != self.renderkey:
+            renderer()
+        elif page.rescaledkey != self.rescalekey:
+            if rescaler != None:
+                rescaler()
+            else:
+                renderer()
+        else:
+            return
+        page.renderedkey = self.renderkey
+        page.rescaledkey = self.rescalekey
+
+    def onPageChanged(self, event):
+        self.renderpage(self.nb.GetPage(event.GetSelection()))
+        event.Skip()
+
     def deletepage(self,pagename):
         for i in range(0, self.nb.GetPageCount()):
            if self.nb.GetPageText(i) == pagename:
@@ -80,8 +137,8 @@ class PlotNotebook(wx.Panel):
                 self.nb.SetSelection(i)
                 return
 
-    def addtextpage(self,name):
-        page = TextPage(self.nb)
+    def addtextpage(self,name,renderer=None):
+        page = TextPage(self.nb, renderer=renderer)
         self.nb.AddPage(page,name)
         return page
 
@@ -144,8 +201,11 @@ class Toolbar(NavigationToolbar2Wx):
 #  includes a helper function to update the text displayed on this page
 # 
 class TextPage(wx.Panel):
-    def __init__(self, parent, id = -1, dpi = None, **kwargs):
+    def __init__(self, parent, id = -1, dpi = None, renderer = None, **kwargs):
         wx.Panel.__init__(self, parent, id=id, **kwargs)
+        self.renderer = renderer
+        self.renderedkey = None
+        self.rescaledkey = None
         #
         self.text = wx.StaticText(self, -1, "Your CurrentCost data", wx.Point(30, 20))
         self.text.SetFont(wx.Font(13, wx.DEFAULT, wx.NORMAL, wx.BOLD))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import time
+from threading import Thread
+from Queue     import Queue, Empty
+
+from currentcostdb import CurrentCostDB
+
+# this class provides logging and diagnostics
+from tracer        import CurrentCostTracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  Stores National Grid data (demand and frequency, and the mix of fuel types
+#   used to generate electricity) in the database, so that it isn't lost 
+#   when the application exits and can be compared with historical 
+#   CurrentCost data (see CurrentCostDB.GetHourDataWithCarbonIntensity)
+# 
+#  Samples are given to the writer on whichever thread downloads them, and 
+#   written by a background thread in batches - each batch is committed in a
+#   single transaction once it has waited for BATCH_INTERVAL seconds, or 
+#   has BATCH_SIZE samples in it. 
+# 
+#  The writer needs its own connection to the database, because pysqlite 
+#   connections cannot be shared between threads.
+# 
+#  Dale Lane (http://dalelane.co.uk/blog)
+
+# types of sample
+SAMPLE_DEMAND = 'demand'
+SAMPLE_MIX    = 'mix'
+
+class CurrentCostGridDataWriter(Thread):
+
+    # longest time (seconds) a sample waits before it is written, and the 
+    #  most samples written in a single transaction
+    BATCH_INTERVAL = 60
+    BATCH_SIZE     = 500
+
+    dbloc = None
+    pendingSamples = None
+
+    # number of samples written, and the number of transactions used
+    stored  = 0
+    batches = 0
+
+    def __init__(self, dblocation):
+        Thread.__init__(self, name="CurrentCostGridDataWriter")
+        self.setDaemon(True)
+        self.dbloc = dblocation
+        self.pendingSamples = Queue(0)
+        self.stored = 0
+        self.batches = 0
+
+    #
+    # request that the thread store National Grid data - these return 
+    #  straight away, and can be called on any thread
+    # 
+    def storeDemand(self, timestamp, demand, frequency):
+        self.pendingSamples.put((SAMPLE_DEMAND, (timestamp, demand, frequency)))
+    def storeMix(self, timestamp, energymix):
+        self.pendingSamples.put((SAMPLE_MIX, (timestamp, energymix)))
+
+    #
+    # stop the thread, once it has written everything it has been given
+    # 
+    def shutdown(self):
+        # samples are written in the order they were given, so the thread 
+        #  stops when it gets this null sample - see DatabaseUpdateThread
+        self.pendingSamples.put(None)
+        if self.isAlive():
+            self.join()
+
+    def run(self):
+        global trc
+        trc.FunctionEntry("currentcostgridstore :: run")
+        dbconn = CurrentCostDB()
+        dbconn.InitialiseDB(self.dbloc)
+
+        finished = False
+        while finished == False:
+            batch, finished = self.nextBatch()
+            self.write(dbconn, batch)
+
+        dbconn.CloseDB()
+        trc.FunctionExit("currentcostgridstore :: run")
+
+    #
+    # wait for a sample, then collect any more given to us until it is time
+    #  to write them
+    # 
+    #  returns the samples, and True if we have been shut down
+    # 
+    def nextBatch(self):
+        batch = []
+        sample = self.pendingSamples.get()
+        deadline = time.time() + self.BATCH_INTERVAL
+        while sample != None:
+            batch.append(sample)
+            timeout = deadline - time.time()
+            if len(batch) >= self.BATCH_SIZE or timeout <= 0:
+                return batch, False
+            try:
+                sample = self.pendingSamples.get(True, timeout)
+            except Empty:
+                return batch, False
+        return batch, True
+
+    def write(self, dbconn, batch):
+        global trc
+        if len(batch) == 0:
+            return
+        demand = [ sample for sampletype, sample in batch if sampletype == SAMPLE_DEMAND ]
+        mix    = [ sample for sampletype, sample in batch if sampletype == SAMPLE_MIX ]
+        try:
+            dbconn.StartBatch()
+            dbconn.StoreGridDemandMany(demand)
+            dbconn.StoreGridMixMany(mix)
+            dbconn.CommitBatch()
+            self.stored += len(batch)
+            self.batches += 1
+            trc.Trace("stored %d National Grid samples", len(batch))
+        except Exception, err:
+            # the samples are lost, but we keep going so that later ones 
+            #  are stored
+            trc.Error("failed to store %d National Grid samples : %s", len(batch), err)
+            dbconn.connection.rollback()
+            dbconn.batching = False
@@ -224,7 +224,7 @@ class DatabaseUpdateThread(Thread):
                 # adding 'None' to the queue is how we signal a shutdown for 
                 #  the thread - this will cause us to drop out of the bottom
                 #  of the while loop
-                ccfuncs.ParseCurrentCostXML(dbconn, nextupdate)
+                ccfuncs.StoreHistoryUpdates(dbconn, [ nextupdate ])
 
         # cleanup
         dbconn.CloseDB()
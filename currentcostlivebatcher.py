@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import collections
+import datetime
+import threading
+import pytz
+
+# this class provides logging and diagnostics
+from tracer                 import CurrentCostTracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  Collects live readings as they are received, and passes them to the live
+#   graph in batches - one batch per frame - rather than redrawing the graph
+#   for every reading.
+# 
+#  Readings from MQTT can arrive much faster than the graph can be redrawn 
+#   (e.g. from a busy topic, or the backlog of messages received when first
+#   subscribing). Readings wait in a bounded queue until the next frame - if
+#   it fills up, the oldest readings are dropped. If more readings than can
+#   usefully be drawn arrive in a single frame, they are decimated.
+# 
+#  Each reading is timestamped when it is received, not when it is drawn.
+# 
+#  The live graph must provide:
+#    updateGraphBatch(readings, meterid) - readings is a list of 
+#                                           (timestamp, reading) pairs
+# 
+
+
+#
+# reduce a list of readings to at most 'limit' evenly spaced readings - the 
+#  most recent reading is always kept
+# 
+def decimate(readings, limit):
+    if len(readings) <= limit:
+        return readings
+    # integer arithmetic, so that the last index is always len(readings) - 1
+    return [ readings[((i + 1) * len(readings)) // limit - 1] for i in range(limit) ]
+
+
+class CurrentCostLiveBatcher():
+
+    # how often (seconds) batches of readings are passed to the graph
+    FRAME_INTERVAL = 0.5
+    # most readings held waiting for the next frame
+    QUEUE_SIZE = 1000
+    # most readings passed to the graph in a single frame
+    MAX_BATCH_SIZE = 50
+
+    def __init__(self, guicallback, meterid=None):
+        self.guicallback = guicallback
+        self.meterid = meterid
+        self.pending = collections.deque(maxlen=self.QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # counters
+        self.received = 0
+        self.dropped = 0
+        self.decimated = 0
+        self.batches = 0
+
+    #
+    # start passing batches of readings to the graph
+    # 
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="CurrentCostLiveBatcher")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    #
+    # stop passing readings to the graph - anything still waiting is discarded
+    # 
+    def stop(self):
+        self.stopped.set()
+        if self.thread != None and self.thread != threading.currentThread():
+            self.thread.join()
+
+    #
+    # called when a reading is received - this can be called on any thread
+    # 
+    def addReading(self, ccreading, timestamp=None):
+        if timestamp == None:
+            timestamp = datetime.datetime.now(pytz.utc)
+        self.lock.acquire()
+        if len(self.pending) == self.QUEUE_SIZE:
+            # the oldest reading will be pushed out of the queue
+            self.dropped += 1
+        self.pending.append((timestamp, ccreading))
+        self.received += 1
+        self.lock.release()
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.FRAME_INTERVAL)
+            if not self.stopped.isSet():
+                self.flush()
+
+    #
+    # pass any readings waiting to the graph
+    # 
+    def flush(self):
+        global trc
+        self.lock.acquire()
+        readings = list(self.pending)
+        self.pending.clear()
+        self.lock.release()
+
+        if len(readings) == 0:
+            return
+
+        batch = decimate(readings, self.MAX_BATCH_SIZE)
+        self.decimated += len(readings) - len(batch)
+        self.batches += 1
+        trc.Trace("passing batch of %d readings (from %d received) to the graph", len(batch), len(readings))
+        try:
+            self.guicallback.updateGraphBatch(batch, self.meterid)
+        except Exception, err:
+            trc.Error("failed to pass batch of live readings to the graph: %s", err)
@@ -25,6 +25,7 @@ import wx
 import csv
 import datetime
 import time
+import bisect
 import pytz
 
 from matplotlib.dates import DayLocator, HourLocator, MinuteLocator, DateFormatter, num2date
@@ -35,7 +36,9 @@ from threading import Thread, Lock
 from currentcostcomlive    import CurrentCostSerialLiveConnection
 from nationalgriddata      import NationalGridDataSource
 from electricitygeneration import CurrentCostElectricityGeneration
+from currentcostgridstore  import CurrentCostGridDataWriter
 from tracer                import CurrentCostTracer
+import tracer
 
 
 # this class provides logging and diagnostics
@@ -90,7 +93,14 @@ class CurrentCostLiveData():
     #       the third reading
     ccdates = []
     ccreadings = []
-    ccsplitreadings = []
+
+    #
+    # live data from each meter, when showing data from more than one meter
+    #  - dates and readings for each meter, indexed by meter id
+    meterdates = {}
+    meterreadings = {}
+    # colours used to draw the data from each meter
+    METER_COLOURS = [ 'r', 'b', 'g', 'm', 'c', 'k', 'y' ]
 
     #
     # National Grid data store - dates and the readings
@@ -100,6 +110,9 @@ class CurrentCostLiveData():
     ngdemandreadings = []
     ngfreqreadings = []
     ngfreqzeroline = []
+    # how long National Grid data is kept for the graph - older data is still
+    #  available from the database (see storeGridData)
+    NGDATA_WINDOW = datetime.timedelta(hours=24)
 
     # 
     # likely limits for National Grid frequency data
@@ -113,10 +126,14 @@ class CurrentCostLiveData():
     # background threads actually getting the live data
     mqttClient = None
     comClient  = None
+    comClients = []
     ngdClient  = None
 
     genClient  = CurrentCostElectricityGeneration()
 
+    # stores National Grid data in the database - see storeGridData
+    gridWriter = None
+
     # when did we start tracking live data?
     starttime = None
 
@@ -162,8 +179,7 @@ class CurrentCostLiveData():
             trc.FunctionExit("currentcostlivedata :: redrawGraph")
             return
 
-        trc.Trace(str(len(self.ccdates)) + " dates and " + 
-                  str(len(self.ccreadings)) + " data points")
+        trc.Trace("%d dates and %d data points", len(self.ccdates), len(self.ccreadings))
 
         trc.Trace("aquiring lock")
         self.lock.acquire()
@@ -195,6 +211,26 @@ class CurrentCostLiveData():
         else:
             trc.Trace("no dates to plot")
 
+        if len(self.meterdates) > 0:
+            try:
+                trc.Trace("plotting live data for %d meters", len(self.meterdates))
+                meterids = sorted(self.meterdates.keys())
+                lines = []
+                for i in range(len(meterids)):
+                    colour = self.METER_COLOURS[i % len(self.METER_COLOURS)]
+                    lines.extend(self.livegraph.plot_date(self.meterdates[meterids[i]], 
+                                                          self.meterreadings[meterids[i]],
+                                                          colour + '-'))
+                self.livegraph.legend(lines, meterids, loc='upper left')
+            except Exception, e:
+                if self.closing == False:
+                    trc.Error('Failed to plot meter data on livegraph')
+                    trc.Error(str(e))
+                trc.Trace("releasing lock")
+                self.lock.release()
+                trc.FunctionExit("currentcostlivedata :: redrawGraph")
+                return False
+
         
         if self.livegraphNGDemand != None and len(self.ngdatadates) > 0:
             try:
@@ -248,7 +284,7 @@ class CurrentCostLiveData():
         #    so we scale all x-axes manually
         # 
         trc.Trace("disabling auto-scaling")
-        if len(self.ccdates) > 0:
+        if len(self.ccdates) > 0 or len(self.meterdates) > 0:
             self.livegraph.set_autoscale_on = False
         if self.livegraphNGDemand != None:
             self.livegraphNGDemand.set_autoscale_on = False            
@@ -320,7 +356,7 @@ class CurrentCostLiveData():
         #    slightly thicker as drawn twice in the same place!
         try:
             # format the dates on the x-axis
-            if len(self.ccdates) > 0:
+            if len(self.ccdates) > 0 or len(self.meterdates) > 0:
                 trc.Trace("formatting x-axis labels")
                 self.livegraph.xaxis.set_major_formatter(self.stddatefmtter)
                 self.livegraph.xaxis.set_minor_formatter(self.stddatefmtter)
@@ -383,6 +419,20 @@ class CurrentCostLiveData():
                 self.lock.release()
                 trc.FunctionExit("currentcostlivedata :: redrawGraph")
                 return False
+
+        #
+        # Step 7:
+        #   update the generation graph, if one has been displayed
+        # 
+        if len(self.ccdates) > 0:
+            try:
+                self.genClient.updateGraph(list(self.ccdates), list(self.ccreadings))
+            except Exception, e:
+                # the generation graph isn't essential, so we stop updating 
+                #  it rather than failing the redraw
+                trc.Error('failed to update generation graph')
+                trc.Error(str(e))
+                self.genClient.closeGraph()
         
         #
         # graph redraw complete
@@ -397,24 +447,19 @@ class CurrentCostLiveData():
     # 
     #  the new reading is appended to the set, and the graph is refreshed
     # 
-    def updateGraph(self, ccreading):
+    #  when showing data from more than one meter, each reading is tagged 
+    #   with the id of the meter it came from, and each meter is drawn as a
+    #   separate series
+    # 
+    def updateGraph(self, ccreading, meterid=None):
         global trc
         trc.FunctionEntry("currentcostlivedata :: updateGraph")
 
-        trc.Trace("new data: " + str(ccreading))
+        trc.Trace("new data: %s from meter %s", ccreading, meterid)
 
         if ccreading > 0:
             # store the new reading
-            try:                
-                x = datetime.datetime.now(pytz.utc)
-                trc.Trace("timestamp : " + repr(x))
-                self.ccdates.append(x)
-                self.ccreadings.append(ccreading)
-                self.ccsplitreadings.append(self.genClient.splitBySource(ccreading))
-                trc.Trace("stored reading")
-            except Exception, err:
-                trc.Error("failed to store live reading")
-                trc.Error(str(err))
+            self.storeReading(datetime.datetime.now(pytz.utc), ccreading, meterid)
               
             # redraw the graph with the new reading
             self.redrawGraph()
@@ -423,6 +468,52 @@ class CurrentCostLiveData():
 
         trc.FunctionExit("currentcostlivedata :: updateGraph")
 
+    #
+    # called with a batch of CurrentCost readings - a list of (timestamp, 
+    #  reading) pairs
+    # 
+    #  the readings are appended to the set, and the graph is refreshed once
+    #   for the whole batch
+    # 
+    def updateGraphBatch(self, readings, meterid=None):
+        global trc
+        trc.FunctionEntry("currentcostlivedata :: updateGraphBatch")
+
+        trc.Trace("new data: %d readings from meter %s", len(readings), meterid)
+
+        stored = 0
+        for x, ccreading in readings:
+            if ccreading > 0:
+                self.storeReading(x, ccreading, meterid)
+                stored += 1
+
+        if stored > 0:
+            self.redrawGraph()
+        else:
+            trc.Trace("ignoring zero readings")
+
+        trc.FunctionExit("currentcostlivedata :: updateGraphBatch")
+
+    #
+    # add a reading to the live data store
+    # 
+    def storeReading(self, x, ccreading, meterid):
+        global trc
+        try:                
+            trc.Trace("timestamp : %r", x)
+            if meterid == None:
+                self.ccdates.append(x)
+                self.ccreadings.append(ccreading)
+            else:
+                self.lock.acquire()
+                self.meterdates.setdefault(meterid, []).append(x)
+                self.meterreadings.setdefault(meterid, []).append(ccreading)
+                self.lock.release()
+            trc.Trace("stored reading")
+        except Exception, err:
+            trc.Error("failed to store live reading")
+            trc.Error(str(err))
+
     #
     # prepare the graph used to display live CurrentCost data
     # 
@@ -489,14 +580,24 @@ class CurrentCostLiveData():
             backgroundThread.start()
         elif self.connectionType == self.CONNECTION_SERIAL:
             trc.Trace("connection type: serial")
-            self.comport = com
-
-            trc.Trace("creating serial connection for live data")
-            self.comClient = CurrentCostSerialLiveConnection()
-
-            trc.Trace("creating background thread for CurrentCost data")
-            backgroundThread = SerialUpdateThread(self.comClient, com, self)
-            backgroundThread.start()
+            # com can be a list of connections, to show data from more than 
+            #  one meter - each read by its own background thread
+            if isinstance(com, list):
+                comports = com
+            else:
+                comports = [ com ]
+            self.comport = comports[0]
+
+            self.comClients = []
+            for comport in comports:
+                trc.Trace("creating serial connection for live data from meter %s", comport.meterid)
+                comClient = CurrentCostSerialLiveConnection()
+                self.comClients.append(comClient)
+
+                trc.Trace("creating background thread for CurrentCost data")
+                backgroundThread = SerialUpdateThread(comClient, comport, self)
+                backgroundThread.start()
+            self.comClient = self.comClients[0]
         else:
             trc.Error("unsupported connection type : " + str(self.connectionType))
 
@@ -522,8 +623,8 @@ class CurrentCostLiveData():
             if self.mqttClient != None:
                 self.mqttClient.Disconnect()
         elif self.connectionType == self.CONNECTION_SERIAL:
-            if self.comClient != None:
-                self.comClient.Disconnect()
+            for comClient in self.comClients:
+                comClient.Disconnect()
 
         if self.ngdClient != None:
             self.ngdClient.stopUpdates()
@@ -560,10 +661,25 @@ class CurrentCostLiveData():
 
         # store the new National Grid data readings
         if ngdemand != None and ngfrequency != None:
-            self.ngdatadates.append(datetime.datetime.now(pytz.utc))
+            if self.gridWriter != None:
+                # stored in local time, like the history data it will be 
+                #  compared with
+                self.gridWriter.storeDemand(datetime.datetime.now(), ngdemand, ngfrequency)
+            now = datetime.datetime.now(pytz.utc)
+            # the lists are updated together, so that the graph is never 
+            #  drawn with some of them longer than others
+            self.lock.acquire()
+            self.ngdatadates.append(now)
             self.ngdemandreadings.append(ngdemand)
             self.ngfreqreadings.append(ngfrequency)
             self.ngfreqzeroline.append(self.NGFREQ_ZERO)
+            expired = bisect.bisect_left(self.ngdatadates, now - self.NGDATA_WINDOW)
+            if expired > 0:
+                del self.ngdatadates[:expired]
+                del self.ngdemandreadings[:expired]
+                del self.ngfreqreadings[:expired]
+                del self.ngfreqzeroline[:expired]
+            self.lock.release()
     
             # if we are also plotting live CurrentCost readings, we allow the 
             #  CurrentCost update function to redraw the graph (otherwise, 
@@ -576,6 +692,26 @@ class CurrentCostLiveData():
 
 
 
+    #
+    # keep National Grid data downloaded from now on in the database at 
+    #  dblocation, until closeGridData is called
+    # 
+    def storeGridData(self, dblocation):
+        if self.gridWriter == None:
+            self.gridWriter = CurrentCostGridDataWriter(dblocation)
+            self.gridWriter.start()
+            self.genClient.gridWriter = self.gridWriter
+
+    #
+    # stop storing National Grid data, once everything downloaded has been
+    #  written to the database
+    # 
+    def closeGridData(self):
+        if self.gridWriter != None:
+            self.genClient.gridWriter = None
+            self.gridWriter.shutdown()
+            self.gridWriter = None
+
     #
     # start the download and display of national electricity demand
     #  data from the National Grid
@@ -613,7 +749,7 @@ class CurrentCostLiveData():
             # create a background thread that will poll the National Grid
             #  website and return national electricity demand values
             if self.ngdClient == None:
-                self.ngdClient = NationalGridUpdateThread(self)
+                self.ngdClient = NationalGridUpdater(self)
                 self.ngdClient.start()
 
     #
@@ -683,7 +819,7 @@ class CurrentCostLiveData():
             # create a background thread that will poll the National Grid
             #  website and return national electricity demand values
             if self.ngdClient == None:
-                self.ngdClient = NationalGridUpdateThread(self)
+                self.ngdClient = NationalGridUpdater(self)
                 self.ngdClient.start()
 
     #
@@ -737,7 +873,7 @@ class CurrentCostLiveData():
         trc.FunctionEntry("prepareElectricitySourceGraph")
         # TODO - protect against empty data
         self.genClient.initialiseGraph(list(self.ccdates), 
-                                       list(self.ccsplitreadings),
+                                       list(self.ccreadings),
                                        targetTab, 
                                        self.stddatefmtter)
         trc.FunctionExit("prepareElectricitySourceGraph")
@@ -871,21 +1007,26 @@ class SerialUpdateThread(Thread):
         res = self.comClient.EstablishConnection(self.comport, 
                                                  self.graphhandle)
 
-# a background thread used to download National Grid data
-class NationalGridUpdateThread(Thread):
+# receives National Grid data from the shared web fetcher's thread (see 
+#  currentcostwebfetch.py) whenever it changes
+class NationalGridUpdater():
     disconnect = False
     ngdata = None
     def __init__(self, liveagent):
-        Thread.__init__(self)
         self.graphhandle = liveagent
         self.disconnect = False
         self.ngdata = NationalGridDataSource()
+    def start(self):
+        self.ngdata.startUpdates(self)
     def stopUpdates(self):
         self.disconnect = True
-    def run(self):
-        while self.disconnect == False:
-            nghtml = self.ngdata.DownloadRealtimeHTML()
-            demand, freq = self.ngdata.ParseRealtimeHTML(nghtml)
-            self.graphhandle.updateNationalGridGraph(demand, freq)
+        self.ngdata.stopUpdates(self)
+    def contentReceived(self, nghtml):
+        if self.disconnect:
+            return
+        demand, freq = self.ngdata.ParseRealtimeHTML(nghtml)
+        self.graphhandle.updateNationalGridGraph(demand, freq)
+    def fetchError(self, errmsg):
+        trc.Trace("unable to download HTML from National Grid: " + errmsg)
         
 
@@ -26,12 +26,9 @@ import sys
 import time
 import string
 import wx
-from datetime import datetime
-from string import atoi, atof
 
-from mqttClient import *
-
-from currentcostdata import CurrentCostUpdate
+from currentcostmqttsession import CurrentCostMQTTSession
+from currentcostdata import decodeMQTTHistory, MQTT_HISTORY_TYPES
 from tracer          import CurrentCostTracer
 
 
@@ -48,28 +45,28 @@ trc = CurrentCostTracer()
 # 
 # This class is used to provide the MQTT connection to download history data.
 # 
+# The connection is managed by a CurrentCostMQTTSession, which is stopped 
+#  once history data for hours, days and months has been received. If the 
+#  connection is lost before then, the session reconnects and subscribes again.
+# 
 # 
 #  Dale Lane (http://dalelane.co.uk/blog)
 
 
 
 
-receivedHours  = False
-receivedDays   = False
-receivedMonths = False
-workComplete   = False
-
-ccUpdate = CurrentCostUpdate()
-
-
 class CurrentCostMQTTConnection():
 
+    session = None
+
     #
     # Establish a connection to the MQTT broker
     # 
     # The function will prompt the user for the details required for the 
     #  connection
     # 
+    #  ipaddr can include a port - e.g. 'localhost:1884'
+    # 
     def EstablishConnection(self, gui, dialog, dlgend, ipaddr, topicString):
         global trc
         trc.FunctionEntry("currentcostmqtt :: EstablishConnection")
@@ -78,152 +75,92 @@ class CurrentCostMQTTConnection():
         # try and make the connection to the Broker
         # 
         
-        connection = None
-        try:
-            dialog.Update(1, "Defining a connection to the message broker")
-            connection = MqttConnection("pyccgui-" + datetime.now().strftime("%m%d%H%M%S"), 
-                                        ipaddr)
-
-            dialog.Update(2, "Connecting to the message broker")
-            connection.connect()
-        except ConnectFailedException, exception:
-            trc.Error("Unable to connect (" + str(exception) + ")")
-            dialog.Update(dlgend, "Unable to connect (" + str(exception) + ")")
-            trc.FunctionExit("currentcostmqtt :: EstablishConnection")
-            return False
-
-        dialog.Update(3, "Connected to message broker")
+        dialog.Update(1, "Defining a connection to the message broker")
+        subscriber = CurrentCostMQTTSubscriber()
+        self.session = CurrentCostMQTTSession("ccguionce", ipaddr, subscriber)
+        subscriber.registerGuiCallbacks(gui, self.session)
 
         #
-        # define a subscription with the Broker
+        # define a subscription with the Broker - this is made as soon as we
+        #  are connected
         # 
 
-        subscriber = None
-        try:
-            dialog.Update(4, "Subscribing to history feed")
-            subscriber = CurrentCostMQTTSubscriber(connection, str(topicString) + "/+")
-            subscriber.registerGuiCallbacks(gui, connection)
-            subscriber.subscribe()
-            dialog.Update(5, "Subscribed to history feed")
-        except SubscribeFailedException, exception:
-            trc.Error("Unable to subscribe to topic (" + str(exception) + ")")
-            dialog.Update(dlgend, "Unable to subscribe to topic (" + str(exception) + ")")
+        self.session.subscribe(str(topicString) + "/+")
+
+        dialog.Update(2, "Connecting to the message broker")
+        self.session.start()
+        if not self.session.waitUntilConnected(self.session.CONNECT_TIMEOUT):
+            self.session.stop()
+            trc.Error("Unable to connect (" + str(self.session.lastError) + ")")
+            dialog.Update(dlgend, "Unable to connect (" + str(self.session.lastError) + ")")
             trc.FunctionExit("currentcostmqtt :: EstablishConnection")
             return False
 
+        dialog.Update(3, "Connected to message broker")
+        dialog.Update(4, "Subscribing to history feed")
+        if not self.session.waitUntilSubscribed(self.session.CONNECT_TIMEOUT):
+            self.session.stop()
+            trc.Error("No response to subscribing to " + str(topicString) + "/+")
+            dialog.Update(dlgend, "Unable to subscribe to history feed")
+            trc.FunctionExit("currentcostmqtt :: EstablishConnection")
+            return False
+        dialog.Update(5, "Subscribed to history feed")
+
         trc.FunctionExit("currentcostmqtt :: EstablishConnection")
         return True
 
+    #
+    # Disconnect from the MQTT broker - e.g. if the user gives up waiting
+    # 
+    def Disconnect(self):
+        if self.session != None:
+            self.session.stop()
+
 
 
-class CurrentCostMQTTSubscriber(MqttSubscriber):
+class CurrentCostMQTTSubscriber():
 
     gui = None
-    mqttconnection = None
+    session = None
 
-    def registerGuiCallbacks(self, ccgui, connection):
+    # history data received so far - a CurrentCostHistoryUpdate for each type
+    #  of data in currentcostdata.MQTT_HISTORY_TYPES
+    ccUpdates = None
+    workComplete = False
+
+    def registerGuiCallbacks(self, ccgui, session):
         self.gui = ccgui
-        self.mqttconnection = connection
-
-    def messageReceived(self, message):
-        global receivedHours, receivedDays, receivedMonths, workComplete, ccUpdate
-        MqttSubscriber.messageReceived(self, message)
-
-        dataType = str(message.topicName[len(self.getTopic()) - 1:len(message.topicName)])
-
-        msgdata = str(message.data)
-        msgdataelems = string.split(msgdata)
-
-        if dataType == "hours":
-            ccUpdate.kWattsHour02 = atof(msgdataelems[0])
-            ccUpdate.kWattsHour04 = atof(msgdataelems[1])
-            ccUpdate.kWattsHour06 = atof(msgdataelems[2])
-            ccUpdate.kWattsHour08 = atof(msgdataelems[3])
-            ccUpdate.kWattsHour10 = atof(msgdataelems[4])
-            ccUpdate.kWattsHour12 = atof(msgdataelems[5])
-            ccUpdate.kWattsHour14 = atof(msgdataelems[6])
-            ccUpdate.kWattsHour16 = atof(msgdataelems[7])
-            ccUpdate.kWattsHour18 = atof(msgdataelems[8])
-            ccUpdate.kWattsHour20 = atof(msgdataelems[9])
-            ccUpdate.kWattsHour22 = atof(msgdataelems[10])
-            ccUpdate.kWattsHour24 = atof(msgdataelems[11])
-            ccUpdate.kWattsHour26 = atof(msgdataelems[12])
-            receivedHours = True
-        elif dataType == "days":
-            ccUpdate.WattsDay01 = atoi(msgdataelems[0])
-            ccUpdate.WattsDay02 = atoi(msgdataelems[1])
-            ccUpdate.WattsDay03 = atoi(msgdataelems[2])
-            ccUpdate.WattsDay04 = atoi(msgdataelems[3])
-            ccUpdate.WattsDay05 = atoi(msgdataelems[4])
-            ccUpdate.WattsDay06 = atoi(msgdataelems[5])
-            ccUpdate.WattsDay07 = atoi(msgdataelems[6])
-            ccUpdate.WattsDay08 = atoi(msgdataelems[7])
-            ccUpdate.WattsDay09 = atoi(msgdataelems[8])
-            ccUpdate.WattsDay10 = atoi(msgdataelems[9])
-            ccUpdate.WattsDay11 = atoi(msgdataelems[10])
-            ccUpdate.WattsDay12 = atoi(msgdataelems[11])
-            ccUpdate.WattsDay13 = atoi(msgdataelems[12])
-            ccUpdate.WattsDay14 = atoi(msgdataelems[13])
-            ccUpdate.WattsDay15 = atoi(msgdataelems[14])
-            ccUpdate.WattsDay16 = atoi(msgdataelems[15])
-            ccUpdate.WattsDay17 = atoi(msgdataelems[16])
-            ccUpdate.WattsDay18 = atoi(msgdataelems[17])
-            ccUpdate.WattsDay19 = atoi(msgdataelems[18])
-            ccUpdate.WattsDay20 = atoi(msgdataelems[19])
-            ccUpdate.WattsDay21 = atoi(msgdataelems[20])
-            ccUpdate.WattsDay22 = atoi(msgdataelems[21])
-            ccUpdate.WattsDay23 = atoi(msgdataelems[22])
-            ccUpdate.WattsDay24 = atoi(msgdataelems[23])
-            ccUpdate.WattsDay25 = atoi(msgdataelems[24])
-            ccUpdate.WattsDay26 = atoi(msgdataelems[25])
-            ccUpdate.WattsDay27 = atoi(msgdataelems[26])
-            ccUpdate.WattsDay28 = atoi(msgdataelems[27])
-            ccUpdate.WattsDay29 = atoi(msgdataelems[28])
-            ccUpdate.WattsDay30 = atoi(msgdataelems[29])
-            ccUpdate.WattsDay31 = atoi(msgdataelems[30])
-            receivedDays = True
-        elif dataType == "months":
-            ccUpdate.WattsMonth01 = atoi(msgdataelems[0])
-            ccUpdate.WattsMonth02 = atoi(msgdataelems[1])
-            ccUpdate.WattsMonth03 = atoi(msgdataelems[2])
-            ccUpdate.WattsMonth04 = atoi(msgdataelems[3])
-            ccUpdate.WattsMonth05 = atoi(msgdataelems[4])
-            ccUpdate.WattsMonth06 = atoi(msgdataelems[5])
-            ccUpdate.WattsMonth07 = atoi(msgdataelems[6])
-            ccUpdate.WattsMonth08 = atoi(msgdataelems[7])
-            ccUpdate.WattsMonth09 = atoi(msgdataelems[8])
-            ccUpdate.WattsMonth10 = atoi(msgdataelems[9])
-            ccUpdate.WattsMonth11 = atoi(msgdataelems[10])
-            ccUpdate.WattsMonth12 = atoi(msgdataelems[11])
-            receivedMonths = True
+        self.session = session
+        self.ccUpdates = {}
+
+    def messageReceived(self, topic, payload):
+        global trc
 
+        dataType = topic[topic.rfind('/') + 1:]
+
+        try:
+            ccUpdate = decodeMQTTHistory(dataType, payload)
+        except ValueError, exception:
+            trc.Error("Unable to decode " + dataType + " data (" + str(exception) + ")")
+            return
+        if ccUpdate == None:
+            return
+        self.ccUpdates[dataType] = ccUpdate
         
         #
         # check if we've received enough messages
         # 
 
-        if receivedHours == True and receivedDays == True and receivedMonths == True:
+        if self.workComplete == False and len(self.ccUpdates) == len(MQTT_HISTORY_TYPES):
 
-            workComplete = True
+            self.workComplete = True
             #
-            # we have enough now - unsubscribe and disconnect
+            # we have enough now - disconnect. we're called on the session's
+            #  thread, which finishes once we return
             #     
-            try:
-                self.unsubscribe()
-            except UnsubscribeFailedException, exception:
-                # print str(exception)
-                noop = 1
-
-            try:
-                self.mqttconnection.disconnect()
-            except DisconnectFailedException, exception:
-                # print str(exception)
-                noop = 1
+            self.session.stop()
 
             # 
             # try to update the GUI with the data we've received via MQTT
             # 
-            self.gui.onMQTTSubscribeCallback(ccUpdate)
-
-            # hack: seems to be some problem that this thread wont go away!
-            sys.exit()
+            self.gui.onMQTTSubscribeCallback(self.ccUpdates.values())
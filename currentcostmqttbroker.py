@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import sys
+import time
+import errno
+import random
+import socket
+import struct
+import getopt
+import signal
+import threading
+
+from currentcostmqttpackets import CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP
+from currentcostmqttpackets import SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT
+from currentcostmqttpackets import CONNACK_ACCEPTED, CONNACK_BAD_PROTOCOL, CONNACK_IDENTIFIER_REJECTED
+from currentcostmqttpackets import MAX_CLIENT_ID_LENGTH, DEFAULT_PORT
+from currentcostmqttpackets import encodeString, decodeString, encodePacket, encodePublish, readPacket, decodePublish
+
+# this class provides logging and diagnostics
+from tracer                 import CurrentCostTracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  A stand-in for an MQTT broker (such as RSMB - the Really Small Message 
+#   Broker) and a publisher of CurrentCost data, so that the MQTT connections
+#   can be tested and benchmarked without a real broker or meter.
+# 
+#  The broker implements enough of MQTT 3.1 for CurrentCost data: 
+#   connecting (with keepalive), publishing at QoS 0, 1 and 2, retained 
+#   publications, subscribing with + and # wildcards, and unsubscribing. It
+#   only listens on the local machine by default.
+# 
+#  The publisher publishes live readings (in kW) and history data for hours,
+#   days and months in the format used by the CurrentCost MQTT perl script 
+#   that the GUI expects - history data is published as retained messages.
+# 
+#  To run a broker and publisher, for example:
+# 
+#   python currentcostmqttbroker.py --port=1883 --topic=CurrentCost --live-interval=6
+# 
+#  and connect the GUI to 127.0.0.1, with the topic string CurrentCost/live
+#   for live data and CurrentCost/history for history data.
+# 
+
+
+###############################################################################
+#
+# topic matching
+# 
+###############################################################################
+
+#
+# does a topic match a subscription (which can include + and # wildcards)?
+# 
+def topicMatches(topicfilter, topic):
+    filterlevels = topicfilter.split('/')
+    topiclevels = topic.split('/')
+    for i in range(len(filterlevels)):
+        if filterlevels[i] == '#':
+            return True
+        if i >= len(topiclevels):
+            return False
+        if filterlevels[i] != '+' and filterlevels[i] != topiclevels[i]:
+            return False
+    return len(filterlevels) == len(topiclevels)
+
+
+###############################################################################
+#
+# broker
+# 
+###############################################################################
+
+class CurrentCostMQTTBroker():
+
+    # port that the broker is listening on - if 0 is given when the broker
+    #  is created, a free port is chosen when it is started
+    port = None
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.listener = None
+        self.clients = []
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+
+        # counters
+        self.connections = 0
+        self.received = 0
+        self.delivered = 0
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.run, name="CurrentCostMQTTBroker")
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.stopped = True
+        try:
+            # wake up the thread waiting in accept
+            socket.create_connection((self.host, self.port), 1).close()
+        except socket.error:
+            pass
+        self.listener.close()
+        self.dropClients()
+
+    #
+    # close the connection to every client, as if the network connection 
+    #  to the broker had been lost
+    # 
+    def dropClients(self):
+        self.lock.acquire()
+        clients = self.clients[:]
+        self.lock.release()
+        for client in clients:
+            client.close()
+
+    def getClientIds(self):
+        self.lock.acquire()
+        clientids = [ client.clientid for client in self.clients ]
+        self.lock.release()
+        return clientids
+
+    def run(self):
+        while not self.stopped:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                break
+            if self.stopped:
+                sock.close()
+                break
+            client = CurrentCostMQTTBrokerClient(self, sock)
+            thread = threading.Thread(target=client.run, name="CurrentCostMQTTBrokerClient")
+            thread.setDaemon(True)
+            thread.start()
+
+    #
+    # called when a client has connected - returns the CONNACK return code
+    # 
+    def addClient(self, client):
+        if len(client.clientid) == 0 or len(client.clientid) > MAX_CLIENT_ID_LENGTH:
+            return CONNACK_IDENTIFIER_REJECTED
+        self.lock.acquire()
+        # a client connecting with the same id as an existing client replaces
+        #  it - the existing client is disconnected
+        existing = [ other for other in self.clients if other.clientid == client.clientid ]
+        self.clients.append(client)
+        self.connections += 1
+        self.lock.release()
+        for other in existing:
+            trc.Trace("client %s connected again - disconnecting previous connection", client.clientid)
+            other.close()
+        return CONNACK_ACCEPTED
+
+    def removeClient(self, client):
+        self.lock.acquire()
+        if client in self.clients:
+            self.clients.remove(client)
+        self.lock.release()
+
+    #
+    # pass a publication to every client with a matching subscription, and 
+    #  keep it if it is retained
+    # 
+    def route(self, topic, payload, qos, retain):
+        self.lock.acquire()
+        self.received += 1
+        if retain:
+            if len(payload) == 0:
+                if topic in self.retained:
+                    del self.retained[topic]
+            else:
+                self.retained[topic] = (payload, qos)
+        clients = self.clients[:]
+        self.lock.release()
+
+        for client in clients:
+            grantedqos = client.getSubscribedQos(topic)
+            if grantedqos != None:
+                if client.publish(topic, payload, min(qos, grantedqos), False):
+                    self.lock.acquire()
+                    self.delivered += 1
+                    self.lock.release()
+
+    def getRetained(self, topicfilter):
+        self.lock.acquire()
+        retained = [ (topic, self.retained[topic][0], self.retained[topic][1]) 
+                     for topic in sorted(self.retained.keys()) 
+                     if topicMatches(topicfilter, topic) ]
+        self.lock.release()
+        return retained
+
+
+#
+# a connection from a client to the broker
+# 
+class CurrentCostMQTTBrokerClient():
+
+    clientid = None
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.clientid = ''
+        self.subscriptions = {}
+        self.sendlock = threading.Lock()
+        self.nextmsgid = 0
+        self.closed = False
+
+    def run(self):
+        try:
+            try:
+                if self.handleConnect():
+                    while not self.closed:
+                        packet = readPacket(self.sock)
+                        if packet == None:
+                            break
+                        if not self.handlePacket(packet):
+                            break
+            except socket.timeout:
+                trc.Trace("client %s keepalive expired", self.clientid)
+            except Exception, err:
+                if not self.closed:
+                    trc.Trace("client %s connection failed: %s", self.clientid, err)
+        finally:
+            self.close()
+
+    def handleConnect(self):
+        packet = readPacket(self.sock)
+        if packet == None or packet[0] != CONNECT:
+            return False
+        body = packet[2]
+        protocol, offset = decodeString(body, 0)
+        version = ord(body[offset])
+        keepalive = struct.unpack('!H', body[offset + 2 : offset + 4])[0]
+        self.clientid = decodeString(body, offset + 4)[0]
+
+        if (protocol, version) not in [ ('MQIsdp', 3), ('MQTT', 4) ]:
+            self.send(encodePacket(CONNACK, 0, '\x00' + chr(CONNACK_BAD_PROTOCOL)))
+            return False
+        returncode = self.broker.addClient(self)
+        self.send(encodePacket(CONNACK, 0, '\x00' + chr(returncode)))
+        if returncode != CONNACK_ACCEPTED:
+            return False
+
+        if keepalive > 0:
+            # the client is disconnected if nothing is received from it for 
+            #  one and a half times the keepalive interval
+            self.sock.settimeout(keepalive * 1.5)
+        return True
+
+    #
+    # handle a packet received from the client - returns False if the 
+    #  connection should be closed
+    # 
+    def handlePacket(self, packet):
+        msgtype, flags, body = packet
+        if msgtype == PUBLISH:
+            topic, payload, qos, retain, msgid = decodePublish(flags, body)
+            if qos == 1:
+                self.send(encodePacket(PUBACK, 0, struct.pack('!H', msgid)))
+            elif qos == 2:
+                self.send(encodePacket(PUBREC, 0, struct.pack('!H', msgid)))
+            self.broker.route(topic, payload, qos, retain)
+        elif msgtype == PUBREL:
+            self.send(encodePacket(PUBCOMP, 0, body[0:2]))
+        elif msgtype == PUBREC:
+            self.send(encodePacket(PUBREL, 0x02, body[0:2]))
+        elif msgtype == SUBSCRIBE:
+            msgid = body[0:2]
+            offset = 2
+            granted = ''
+            topicfilters = []
+            while offset < len(body):
+                topicfilter, offset = decodeString(body, offset)
+                # we only deliver at QoS 0 or 1
+                qos = min(ord(body[offset]) & 0x03, 1)
+                offset += 1
+                self.sendlock.acquire()
+                self.subscriptions[topicfilter] = qos
+                self.sendlock.release()
+                granted += chr(qos)
+                topicfilters.append(topicfilter)
+            self.send(encodePacket(SUBACK, 0, msgid + granted))
+            for topicfilter in topicfilters:
+                for topic, payload, qos in self.broker.getRetained(topicfilter):
+                    self.publish(topic, payload, min(qos, self.subscriptions[topicfilter]), True)
+        elif msgtype == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topicfilter, offset = decodeString(body, offset)
+                self.sendlock.acquire()
+                if topicfilter in self.subscriptions:
+                    del self.subscriptions[topicfilter]
+                self.sendlock.release()
+            self.send(encodePacket(UNSUBACK, 0, body[0:2]))
+        elif msgtype == PINGREQ:
+            self.send(encodePacket(PINGRESP, 0, ''))
+        elif msgtype == DISCONNECT:
+            return False
+        # acknowledgements of publications we have sent need no response
+        return True
+
+    #
+    # returns the QoS to deliver a publication on a topic at, or None if the
+    #  client isn't subscribed to it
+    # 
+    def getSubscribedQos(self, topic):
+        qos = None
+        self.sendlock.acquire()
+        for topicfilter in self.subscriptions:
+            if topicMatches(topicfilter, topic):
+                qos = max(qos, self.subscriptions[topicfilter])
+        self.sendlock.release()
+        return qos
+
+    def publish(self, topic, payload, qos, retain):
+        self.sendlock.acquire()
+        self.nextmsgid = (self.nextmsgid % 65535) + 1
+        msgid = self.nextmsgid
+        self.sendlock.release()
+        return self.send(encodePublish(topic, payload, qos, retain, msgid))
+
+    def send(self, data):
+        self.sendlock.acquire()
+        try:
+            try:
+                self.sock.sendall(data)
+                return True
+            except socket.error, err:
+                trc.Trace("failed to send to client %s: %s", self.clientid, err)
+                return False
+        finally:
+            self.sendlock.release()
+
+    def close(self):
+        self.closed = True
+        self.broker.removeClient(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+###############################################################################
+#
+# client
+# 
+###############################################################################
+
+#
+# a minimal MQTT client - used by the publisher, and to receive publications
+#  when benchmarking
+# 
+#  publications received are passed to messageCallback(topic, payload) on 
+#   the client's thread
+# 
+class CurrentCostMQTTTestClient():
+
+    def __init__(self, clientid, host='127.0.0.1', port=DEFAULT_PORT, keepalive=60):
+        self.clientid = clientid
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.sock = None
+        self.sendlock = threading.Lock()
+        self.nextmsgid = 0
+        self.messageCallback = None
+        self.thread = None
+        self.connected = False
+        self.subscribed = threading.Event()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), 10)
+        body = encodeString('MQIsdp') + chr(3) + chr(0x02) + struct.pack('!H', self.keepalive)
+        self.sock.sendall(encodePacket(CONNECT, 0, body + encodeString(self.clientid)))
+        packet = readPacket(self.sock)
+        if packet == None or packet[0] != CONNACK or ord(packet[2][1]) != CONNACK_ACCEPTED:
+            self.sock.close()
+            raise socket.error('connection to MQTT broker refused')
+        self.sock.settimeout(None)
+        self.connected = True
+        self.thread = threading.Thread(target=self.run, name="CurrentCostMQTTTestClient")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    #
+    # subscribe to a topic - returns once the broker has acknowledged it
+    # 
+    def subscribe(self, topicfilter, qos=0, timeout=10):
+        self.subscribed.clear()
+        self.send(encodePacket(SUBSCRIBE, 0x02, self.getMessageId() + encodeString(topicfilter) + chr(qos)))
+        self.subscribed.wait(timeout)
+        return self.subscribed.isSet()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        msgid = 0
+        if qos > 0:
+            msgid = struct.unpack('!H', self.getMessageId())[0]
+        self.send(encodePublish(topic, payload, qos, retain, msgid))
+
+    def ping(self):
+        self.send(encodePacket(PINGREQ, 0, ''))
+
+    def disconnect(self):
+        if self.connected:
+            try:
+                self.send(encodePacket(DISCONNECT, 0, ''))
+            except socket.error:
+                pass
+        self.close()
+
+    def close(self):
+        self.connected = False
+        if self.sock != None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+        if self.thread != None and self.thread != threading.currentThread():
+            self.thread.join()
+
+    def getMessageId(self):
+        self.sendlock.acquire()
+        self.nextmsgid = (self.nextmsgid % 65535) + 1
+        msgid = self.nextmsgid
+        self.sendlock.release()
+        return struct.pack('!H', msgid)
+
+    def send(self, data):
+        self.sendlock.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.sendlock.release()
+
+    def run(self):
+        try:
+            while self.connected:
+                packet = readPacket(self.sock)
+                if packet == None:
+                    break
+                msgtype, flags, body = packet
+                if msgtype == PUBLISH:
+                    topic, payload, qos, retain, msgid = decodePublish(flags, body)
+                    if qos == 1:
+                        self.send(encodePacket(PUBACK, 0, struct.pack('!H', msgid)))
+                    elif qos == 2:
+                        self.send(encodePacket(PUBREC, 0, struct.pack('!H', msgid)))
+                    if self.messageCallback != None:
+                        self.messageCallback(topic, payload)
+                elif msgtype == SUBACK:
+                    self.subscribed.set()
+                elif msgtype == PUBREL:
+                    self.send(encodePacket(PUBCOMP, 0, body[0:2]))
+                elif msgtype == PUBREC:
+                    self.send(encodePacket(PUBREL, 0x02, body[0:2]))
+        except socket.error:
+            pass
+        self.connected = False
+
+
+###############################################################################
+#
+# publisher
+# 
+###############################################################################
+
+#
+# publishes CurrentCost data to a broker at regular intervals
+# 
+#  live readings are published to <topic>/live and history data to 
+#   <topic>/history/hours, <topic>/history/days and <topic>/history/months
+# 
+class CurrentCostMQTTPublisher():
+
+    # seconds between live readings, and between updates to the history data
+    #  (0 to publish as quickly as possible, None not to publish)
+    liveInterval = 6
+    historyInterval = 7200
+
+    # QoS to publish with
+    qos = 0
+
+    def __init__(self, topic='CurrentCost', host='127.0.0.1', port=DEFAULT_PORT):
+        self.topic = topic
+        self.client = CurrentCostMQTTTestClient('ccpublisher-%d' % random.randint(0, 99999), host, port)
+        self.random = random.Random(0)
+        self.stopped = threading.Event()
+        self.threads = []
+
+        # time each live reading was published, indexed by the reading
+        #  (in watts) - used to measure latency
+        self.sendTimes = {}
+        self.sequence = 0
+        self.livePublished = 0
+        self.historyPublished = 0
+
+    def start(self):
+        self.client.connect()
+        for interval, function in [ (self.liveInterval, self.publishLive),
+                                    (self.historyInterval, self.publishHistory) ]:
+            if interval != None:
+                thread = threading.Thread(target=self.repeat, args=(interval, function))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.client.disconnect()
+
+    def repeat(self, interval, function):
+        while not self.stopped.isSet():
+            function()
+            if interval > 0:
+                self.stopped.wait(interval)
+
+    #
+    # publish a live reading - each reading is different, so that the time it
+    #  was published can be looked up when it is received
+    # 
+    def publishLive(self):
+        self.sequence += 1
+        watts = self.sequence % 100000
+        self.sendTimes[watts] = time.time()
+        self.client.publish(self.topic + '/live', self.getLivePayload(watts), self.qos)
+        self.livePublished += 1
+
+    # time a live reading (in kW) was published, or None if unknown
+    def getSendTime(self, ccreading):
+        return self.sendTimes.get(int(round(ccreading * 1000)))
+
+    def getLivePayload(self, watts):
+        return '%.3f' % (watts / 1000.0)
+
+    def publishHistory(self):
+        for datatype, payload in self.getHistoryPayloads():
+            self.client.publish(self.topic + '/history/' + datatype, payload, self.qos, True)
+            self.historyPublished += 1
+
+    #
+    # history data in the format published by the CurrentCost MQTT perl 
+    #  script - kWh for the last 13 two-hour periods, and watts for the last
+    #  31 days and 12 months
+    # 
+    def getHistoryPayloads(self):
+        hours  = ' '.join([ '%.3f' % self.random.uniform(0.1, 3.0) for i in range(13) ])
+        days   = ' '.join([ '%d' % self.random.randint(1, 30) for i in range(31) ])
+        months = ' '.join([ '%d' % self.random.randint(100, 900) for i in range(12) ])
+        return [ ('hours', hours), ('days', days), ('months', months) ]
+
+
+def usage():
+    print "usage: python currentcostmqttbroker.py [--port=PORT] [--host=ADDRESS] [--no-broker]"
+    print "                                       [--topic=TOPIC] [--live-interval=SECS]"
+    print "                                       [--history-interval=SECS] [--qos=QOS]"
+    print "runs an MQTT broker on the local machine (port 1883 by default) and publishes"
+    print "CurrentCost data to it. with --no-broker, data is published to the broker at"
+    print "host instead"
+    sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'h',
+                                      ['port=', 'host=', 'no-broker', 'topic=', 'live-interval=', 
+                                       'history-interval=', 'qos=', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+
+    port = DEFAULT_PORT
+    host = '127.0.0.1'
+    runbroker = True
+    topic = 'CurrentCost'
+    liveinterval = CurrentCostMQTTPublisher.liveInterval
+    historyinterval = CurrentCostMQTTPublisher.historyInterval
+    qos = 0
+    try:
+        for opt, arg in options:
+            if opt == '--port':
+                port = int(arg)
+            elif opt == '--host':
+                host = arg
+            elif opt == '--no-broker':
+                runbroker = False
+            elif opt == '--topic':
+                topic = arg
+            elif opt == '--live-interval':
+                liveinterval = float(arg)
+            elif opt == '--history-interval':
+                historyinterval = float(arg)
+            elif opt == '--qos':
+                qos = int(arg)
+            elif opt in ('-h', '--help'):
+                usage()
+    except ValueError, err:
+        print str(err)
+        usage()
+
+    broker = None
+    if runbroker:
+        broker = CurrentCostMQTTBroker(host, port)
+        broker.start()
+        print "broker listening on %s:%d" % (host, broker.port)
+
+    if broker != None:
+        port = broker.port
+    publisher = CurrentCostMQTTPublisher(topic, host, port)
+    publisher.liveInterval = liveinterval
+    publisher.historyInterval = historyinterval
+    publisher.qos = qos
+    publisher.start()
+    print "publishing live data to %s/live and history data to %s/history" % (topic, topic)
+    sys.stdout.flush()
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    while not stopped.isSet():
+        stopped.wait(1)
+
+    publisher.stop()
+    if broker != None:
+        broker.stop()
@@ -25,10 +25,9 @@ import os
 import sys
 import time
 import string
-from string import atoi, atof
 
-from mqttClient import *
-from currentcostdata import CurrentCostUpdate
+from currentcostmqttsession import CurrentCostMQTTSession
+from currentcostdata import decodeMQTTHistory
 
 #
 # Many CurrentCost users have their meters connected to a RSMB (Really Small
@@ -40,67 +39,59 @@ from currentcostdata import CurrentCostUpdate
 # 
 # This class is used to provide the MQTT connection to download historical data.
 # 
+# The connection to the broker is managed by a CurrentCostMQTTSession, which
+#  reconnects (and subscribes again) if the connection is lost. History data
+#  is published as retained messages, so we get the latest data again each
+#  time we subscribe.
+# 
 # 
 #  Dale Lane (http://dalelane.co.uk/blog)
 
 
 class CurrentCostMQTTHistoryConnection():
 
-    subscriber = None
+    session = None
     
     #
     # Establish a connection to the MQTT broker
     # 
+    #  ipaddr can include a port - e.g. 'localhost:1884'
+    # 
     def EstablishConnection(self, ipaddr, topicString, guihandle):
-        #
-        # try and make the connection to the Broker
-        # 
-
-        connection = None
-        try:
-            connection = MqttConnection("currentcostguihistory", ipaddr)
-            connection.connect()
-        except ConnectFailedException, exception:
-            guihandle.exitOnError("Unable to connect (" + str(exception) + ")")
-            return
+        subscriber = CurrentCostMQTTSubscriber()
+        subscriber.registerGuiCallbacks(guihandle)
 
         #
-        # define a subscription with the Broker
+        # try and make the connection to the Broker
         # 
 
-        subscriber = None
         topic = str(topicString) + '/+'
-        try:
-            self.subscriber = CurrentCostMQTTSubscriber(connection, topic)
-            self.subscriber.registerGuiCallbacks(guihandle, connection)
-            self.subscriber.subscribe()
-        except SubscribeFailedException, exception:
-            guihandle.exitOnError("Unable to subscribe to topic (" + str(exception) + ")")
-            return
+        self.session = CurrentCostMQTTSession("ccguihistory", ipaddr, subscriber)
+        self.session.subscribe(topic)
+        self.session.start()
+        if not self.session.waitUntilConnected(self.session.CONNECT_TIMEOUT):
+            guihandle.exitOnError("Unable to connect (" + str(self.session.lastError) + ")")
 
     #
     # Disconnect from the MQTT broker
     # 
     def Disconnect(self):
-        if self.subscriber != None:
-            self.subscriber.endconnection()
+        if self.session != None:
+            self.session.stop()
             
     
 
 #
-# Implements the actual MQTT subscriber
+# Receives publications from the MQTT session
 # 
-class CurrentCostMQTTSubscriber(MqttSubscriber):
+class CurrentCostMQTTSubscriber():
 
     # where to send the data received
     guicallback = None
-    # a handle to the MQTT client to use when disconnecting
-    mqttconnection = None
 
     # store handles to use for callbacks
-    def registerGuiCallbacks(self, ccgui, connection):
+    def registerGuiCallbacks(self, ccgui):
         self.guicallback = ccgui
-        self.mqttconnection = connection
 
     #
     # current version of the MQTT CurrentCost perl publishing script publishes
@@ -113,92 +104,15 @@ class CurrentCostMQTTSubscriber(MqttSubscriber):
     #  data will be received every couple of hours, daily data once a day, etc.
     # if we waited until we also got monthly data, we'd have a long wait!
     # 
-    def messageReceived(self, message):
-        MqttSubscriber.messageReceived(self, message)
-
-        dataType = str(message.topicName[len(self.getTopic()) - 1:len(message.topicName)])
+    def messageReceived(self, topic, payload):
+        dataType = topic[topic.rfind('/') + 1:]
 
-        msgdata = str(message.data)
-        msgdataelems = string.split(msgdata)
-
-        if dataType == "hours":
-            ccUpdate = CurrentCostUpdate()
-            ccUpdate.kWattsHour02 = atof(msgdataelems[0])
-            ccUpdate.kWattsHour04 = atof(msgdataelems[1])
-            ccUpdate.kWattsHour06 = atof(msgdataelems[2])
-            ccUpdate.kWattsHour08 = atof(msgdataelems[3])
-            ccUpdate.kWattsHour10 = atof(msgdataelems[4])
-            ccUpdate.kWattsHour12 = atof(msgdataelems[5])
-            ccUpdate.kWattsHour14 = atof(msgdataelems[6])
-            ccUpdate.kWattsHour16 = atof(msgdataelems[7])
-            ccUpdate.kWattsHour18 = atof(msgdataelems[8])
-            ccUpdate.kWattsHour20 = atof(msgdataelems[9])
-            ccUpdate.kWattsHour22 = atof(msgdataelems[10])
-            ccUpdate.kWattsHour24 = atof(msgdataelems[11])
-            ccUpdate.kWattsHour26 = atof(msgdataelems[12])
-            self.guicallback.updateData(ccUpdate)
-        elif dataType == "days":
-            ccUpdate = CurrentCostUpdate()
-            ccUpdate.WattsDay01 = atoi(msgdataelems[0])
-            ccUpdate.WattsDay02 = atoi(msgdataelems[1])
-            ccUpdate.WattsDay03 = atoi(msgdataelems[2])
-            ccUpdate.WattsDay04 = atoi(msgdataelems[3])
-            ccUpdate.WattsDay05 = atoi(msgdataelems[4])
-            ccUpdate.WattsDay06 = atoi(msgdataelems[5])
-            ccUpdate.WattsDay07 = atoi(msgdataelems[6])
-            ccUpdate.WattsDay08 = atoi(msgdataelems[7])
-            ccUpdate.WattsDay09 = atoi(msgdataelems[8])
-            ccUpdate.WattsDay10 = atoi(msgdataelems[9])
-            ccUpdate.WattsDay11 = atoi(msgdataelems[10])
-            ccUpdate.WattsDay12 = atoi(msgdataelems[11])
-            ccUpdate.WattsDay13 = atoi(msgdataelems[12])
-            ccUpdate.WattsDay14 = atoi(msgdataelems[13])
-            ccUpdate.WattsDay15 = atoi(msgdataelems[14])
-            ccUpdate.WattsDay16 = atoi(msgdataelems[15])
-            ccUpdate.WattsDay17 = atoi(msgdataelems[16])
-            ccUpdate.WattsDay18 = atoi(msgdataelems[17])
-            ccUpdate.WattsDay19 = atoi(msgdataelems[18])
-            ccUpdate.WattsDay20 = atoi(msgdataelems[19])
-            ccUpdate.WattsDay21 = atoi(msgdataelems[20])
-            ccUpdate.WattsDay22 = atoi(msgdataelems[21])
-            ccUpdate.WattsDay23 = atoi(msgdataelems[22])
-            ccUpdate.WattsDay24 = atoi(msgdataelems[23])
-            ccUpdate.WattsDay25 = atoi(msgdataelems[24])
-            ccUpdate.WattsDay26 = atoi(msgdataelems[25])
-            ccUpdate.WattsDay27 = atoi(msgdataelems[26])
-            ccUpdate.WattsDay28 = atoi(msgdataelems[27])
-            ccUpdate.WattsDay29 = atoi(msgdataelems[28])
-            ccUpdate.WattsDay30 = atoi(msgdataelems[29])
-            ccUpdate.WattsDay31 = atoi(msgdataelems[30])
-            self.guicallback.updateData(ccUpdate)
-        elif dataType == "months":
-            ccUpdate = CurrentCostUpdate()
-            ccUpdate.WattsMonth01 = atoi(msgdataelems[0])
-            ccUpdate.WattsMonth02 = atoi(msgdataelems[1])
-            ccUpdate.WattsMonth03 = atoi(msgdataelems[2])
-            ccUpdate.WattsMonth04 = atoi(msgdataelems[3])
-            ccUpdate.WattsMonth05 = atoi(msgdataelems[4])
-            ccUpdate.WattsMonth06 = atoi(msgdataelems[5])
-            ccUpdate.WattsMonth07 = atoi(msgdataelems[6])
-            ccUpdate.WattsMonth08 = atoi(msgdataelems[7])
-            ccUpdate.WattsMonth09 = atoi(msgdataelems[8])
-            ccUpdate.WattsMonth10 = atoi(msgdataelems[9])
-            ccUpdate.WattsMonth11 = atoi(msgdataelems[10])
-            ccUpdate.WattsMonth12 = atoi(msgdataelems[11])
-            self.guicallback.updateData(ccUpdate)
-
-
-
-    # disconnect when complete
-    def endconnection(self):
-        try:
-            self.unsubscribe()
-        except UnsubscribeFailedException, exception:
-            # print str(exception)
-            noop = 1
+        # the payload is decoded using the type of data as described in 
+        #  currentcostdata.MQTT_HISTORY_TYPES
         try:
-            self.mqttconnection.disconnect()
-        except DisconnectFailedException, exception:
-            # print str(exception)
-            noop = 1
-
+            ccUpdate = decodeMQTTHistory(dataType, payload)
+        except ValueError, exception:
+            # ignore garbled publications - the next one may be okay
+            return
+        if ccUpdate != None:
+            self.guicallback.updateData(ccUpdate)
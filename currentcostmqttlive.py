@@ -25,9 +25,9 @@ import os
 import sys
 import time
 import string
-from string import atoi, atof
 
-from mqttClient import *
+from currentcostmqttsession import CurrentCostMQTTSession
+from currentcostlivebatcher import CurrentCostLiveBatcher
 from tracer          import CurrentCostTracer
 
 
@@ -45,49 +45,48 @@ trc = CurrentCostTracer()
 # 
 # This class is used to provide the MQTT connection to download live data.
 # 
+# Readings are passed to the live graph in batches by a CurrentCostLiveBatcher
+#  so that a flood of messages doesn't result in the graph being redrawn for
+#  every one of them.
+# 
+# The connection to the broker is managed by a CurrentCostMQTTSession, which
+#  reconnects (and subscribes again) if the connection is lost. The GUI is 
+#  only told about an error if we can't connect in the first place.
+# 
 # 
 #  Dale Lane (http://dalelane.co.uk/blog)
 
 
 class CurrentCostMQTTLiveConnection():
 
-    subscriber = None
+    session = None
+    batcher = None
     
     #
     # Establish a connection to the MQTT broker
     # 
+    #  ipaddr can include a port - e.g. 'localhost:1884'
+    # 
     def EstablishConnection(self, ipaddr, topicString, guihandle):
         global trc
         trc.FunctionEntry("currentcostmqttlive :: EstablishConnection")
 
-        #
-        # try and make the connection to the Broker
-        # 
-        
-        connection = None
-        try:
-            connection = MqttConnection("currentcostguilive", ipaddr)
-            connection.connect()
-        except ConnectFailedException, exception:
-            guihandle.exitOnError("Unable to connect (" + str(exception) + ")")
-            trc.Error("Unable to connect (" + str(exception) + ")")
-            trc.FunctionExit("currentcostmqttlive :: EstablishConnection")
-            return
+        self.batcher = CurrentCostLiveBatcher(guihandle)
+        self.batcher.start()
+
+        subscriber = CurrentCostMQTTSubscriber()
+        subscriber.registerGuiCallbacks(guihandle, self.batcher)
 
         #
-        # define a subscription with the Broker
+        # try and make the connection to the Broker
         # 
 
-        subscriber = None
-        try:
-            self.subscriber = CurrentCostMQTTSubscriber(connection, str(topicString))
-            self.subscriber.registerGuiCallbacks(guihandle, connection)
-            self.subscriber.subscribe()
-        except SubscribeFailedException, exception:
-            guihandle.exitOnError("Unable to subscribe to topic (" + str(exception) + ")")
-            trc.Error("Unable to connect (" + str(exception) + ")")
-            trc.FunctionExit("currentcostmqttlive :: EstablishConnection")
-            return
+        self.session = CurrentCostMQTTSession("ccguilive", ipaddr, subscriber)
+        self.session.subscribe(str(topicString))
+        self.session.start()
+        if not self.session.waitUntilConnected(self.session.CONNECT_TIMEOUT):
+            trc.Error("Unable to connect (" + str(self.session.lastError) + ")")
+            guihandle.exitOnError("Unable to connect (" + str(self.session.lastError) + ")")
 
         trc.FunctionExit("currentcostmqttlive :: EstablishConnection")
 
@@ -95,56 +94,51 @@ class CurrentCostMQTTLiveConnection():
     # Disconnect from the MQTT broker
     # 
     def Disconnect(self):
-        if self.subscriber != None:
-            self.subscriber.endconnection()
+        if self.session != None:
+            self.session.stop()
+        if self.batcher != None:
+            self.batcher.stop()
             
     
 
 #
-# Implements the actual MQTT subscriber
+# Receives publications from the MQTT session
 # 
-class CurrentCostMQTTSubscriber(MqttSubscriber):
+class CurrentCostMQTTSubscriber():
 
     # where to send the data received
     guicallback = None
-    # a handle to the MQTT client to use when disconnecting
-    mqttconnection = None
+    # collects readings to pass to the GUI in batches - if None, each reading
+    #  is passed to the GUI as soon as it is received
+    batcher = None
 
     # store handles to use for callbacks
-    def registerGuiCallbacks(self, ccgui, connection):
+    def registerGuiCallbacks(self, ccgui, batcher=None):
         global trc
         trc.FunctionEntry("CurrentCostMQTTSubscriber :: registerGuiCallbacks")
         self.guicallback = ccgui
-        self.mqttconnection = connection
+        self.batcher = batcher
         trc.FunctionExit("CurrentCostMQTTSubscriber :: registerGuiCallbacks")
 
     # when a message is received, try and cast it to a float value for kwh
     #  and pass it back to the GUI for displaying
-    def messageReceived(self, message):
+    def messageReceived(self, topic, payload):
         global trc
         trc.FunctionEntry("CurrentCostMQTTSubscriber :: messageReceived")
-        MqttSubscriber.messageReceived(self, message)
         ccreading = None
         try:
-            ccreading = float(message.data)
+            ccreading = float(payload)
         except:
-            trc.Error("Unable to parse reading from meter : " + str(message.data))
-            self.guicallback.exitOnError('Unable to parse reading from meter: ' + str(message.data))
+            trc.Error("Unable to parse reading from meter : " + str(payload))
+            self.guicallback.exitOnError('Unable to parse reading from meter: ' + str(payload))
             trc.FunctionExit("CurrentCostMQTTSubscriber :: messageReceived")
             return
-        self.guicallback.updateGraph(ccreading)
+        if self.batcher != None:
+            self.batcher.addReading(ccreading)
+        else:
+            self.guicallback.updateGraph(ccreading)
         trc.FunctionExit("CurrentCostMQTTSubscriber :: messageReceived")
 
-    # disconnect when complete
-    def endconnection(self):
-        try:
-            self.unsubscribe()
-        except UnsubscribeFailedException, exception:
-            # print str(exception)
-            noop = 1
-        try:
-            self.mqttconnection.disconnect()
-        except DisconnectFailedException, exception:
-            # print str(exception)
-            noop = 1
-
+    # the connection was lost - the session will reconnect
+    def sessionLost(self, errmsg):
+        trc.Trace("lost connection to MQTT broker : " + str(errmsg))
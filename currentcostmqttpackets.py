@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import struct
+
+
+#
+#  Encoding and decoding of MQTT 3.1 packets - used by the MQTT session that
+#   the GUI connects to brokers with (see currentcostmqttsession.py), and by
+#   the stand-in broker and publisher used to test it (see 
+#   currentcostmqttbroker.py).
+# 
+
+
+# MQTT message types
+CONNECT     = 1
+CONNACK     = 2
+PUBLISH     = 3
+PUBACK      = 4
+PUBREC      = 5
+PUBREL      = 6
+PUBCOMP     = 7
+SUBSCRIBE   = 8
+SUBACK      = 9
+UNSUBSCRIBE = 10
+UNSUBACK    = 11
+PINGREQ     = 12
+PINGRESP    = 13
+DISCONNECT  = 14
+
+# CONNACK return codes
+CONNACK_ACCEPTED           = 0
+CONNACK_BAD_PROTOCOL       = 1
+CONNACK_IDENTIFIER_REJECTED = 2
+
+# longest client identifier allowed by MQTT 3.1
+MAX_CLIENT_ID_LENGTH = 23
+
+DEFAULT_PORT = 1883
+
+
+def encodeString(value):
+    return struct.pack('!H', len(value)) + value
+
+def decodeString(data, offset):
+    length = struct.unpack('!H', data[offset : offset + 2])[0]
+    return data[offset + 2 : offset + 2 + length], offset + 2 + length
+
+#
+# build a packet from its type, flags (the low four bits of the first byte),
+#  and the variable header and payload
+# 
+def encodePacket(msgtype, flags, body):
+    remaining = len(body)
+    length = ''
+    while True:
+        digit = remaining % 128
+        remaining = remaining / 128
+        if remaining > 0:
+            digit = digit | 0x80
+        length += chr(digit)
+        if remaining == 0:
+            break
+    return chr((msgtype << 4) | flags) + length + body
+
+def encodePublish(topic, payload, qos=0, retain=False, msgid=0, dup=False):
+    flags = (qos << 1)
+    if retain:
+        flags = flags | 0x01
+    if dup:
+        flags = flags | 0x08
+    body = encodeString(topic)
+    if qos > 0:
+        body += struct.pack('!H', msgid)
+    return encodePacket(PUBLISH, flags, body + payload)
+
+#
+# read exactly 'length' bytes from a socket - returns None if the connection 
+#  is closed
+# 
+def readBytes(sock, length):
+    data = ''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+#
+# read a packet from a socket - returns (type, flags, body) or None if the 
+#  connection is closed
+# 
+def readPacket(sock):
+    header = readBytes(sock, 1)
+    if header == None:
+        return None
+    remaining = 0
+    multiplier = 1
+    while True:
+        digit = readBytes(sock, 1)
+        if digit == None:
+            return None
+        remaining += (ord(digit) & 0x7f) * multiplier
+        multiplier *= 128
+        if ord(digit) & 0x80 == 0:
+            break
+    body = readBytes(sock, remaining)
+    if body == None:
+        return None
+    return (ord(header) >> 4, ord(header) & 0x0f, body)
+
+#
+# decode the body of a PUBLISH packet - returns (topic, payload, qos, retain,
+#  msgid)
+# 
+def decodePublish(flags, body):
+    qos = (flags >> 1) & 0x03
+    retain = (flags & 0x01) == 1
+    topic, offset = decodeString(body, 0)
+    msgid = 0
+    if qos > 0:
+        msgid = struct.unpack('!H', body[offset : offset + 2])[0]
+        offset += 2
+    return topic, body[offset:], qos, retain, msgid
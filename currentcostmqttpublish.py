@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import time
+import datetime
+import threading
+
+from currentcostmqttsession   import CurrentCostMQTTSession
+from currentcostparser        import CurrentCostDataParser
+from currentcostdatafunctions import CurrentCostDataFunctions
+
+# this class provides logging and diagnostics
+from tracer                 import CurrentCostTracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  Republishes data from a CurrentCost meter to an MQTT broker, so that one
+#   machine with the meter connected can provide data for any number of
+#   copies of the GUI (or anything else) connected via MQTT - without needing
+#   the CurrentCost MQTT perl script.
+# 
+#  A republisher is a subscriber of a CurrentCostSerialReader (see 
+#   currentcostserialreader.py), or can be given data directly, e.g. by the
+#   import-data-envir.py daemon. It publishes:
+# 
+#   <topic>/live                   - live readings in kW (the total for the 
+#                                     meter, as shown on the live graph)
+#   <topic>/live/<sensor>          - watts for each sensor
+#   <topic>/live/<sensor>/ch<n>    - watts for each channel of a sensor
+#   <topic>/history/hours          - retained history data, in the format 
+#   <topic>/history/days              used by the CurrentCost MQTT perl 
+#   <topic>/history/months            script (see currentcostmqtthistory.py)
+# 
+#  Nothing is published on the thread which gives us data. Publications are
+#   queued, and sent to the broker together by the republisher's own thread
+#   every BATCH_INTERVAL seconds. Only the latest data for each topic is kept
+#   - so at most one publication is made for each topic in a batch, and a
+#   topic isn't published to again until its rate limit (liveInterval or 
+#   historyInterval) has passed. History data is only published when it
+#   has changed.
+# 
+#  If the connection to the broker is lost, the data is kept until the 
+#   session has reconnected.
+# 
+
+
+#
+# collects the history data from CurrentCost updates - it is given data by
+#  CurrentCostDataParser.storeTimedCurrentCostData in the same way as the db
+# 
+class CurrentCostHistoryCollector():
+
+    def __init__(self):
+        self.hours = {}
+        self.days = {}
+        self.months = {}
+
+    def StoreHourData(self, timestamp, ccvalue):
+        self.hours[timestamp] = ccvalue
+    def StoreDayData(self, timestamp, ccvalue):
+        self.days[timestamp] = ccvalue
+    def StoreMonthData(self, timestamp, ccvalue):
+        self.months[timestamp] = ccvalue
+
+
+class CurrentCostMQTTRepublisher():
+
+    # seconds between batches of publications sent to the broker
+    BATCH_INTERVAL = 1.0
+
+    # number of values in each type of history data - the number sent by a 
+    #  CurrentCost meter
+    HISTORY_LENGTHS = { 'hours'  : 13,
+                        'days'   : 31,
+                        'months' : 12 }
+
+    # least time (seconds) between publications to each live topic, and each
+    #  history topic
+    liveInterval = 0
+    historyInterval = 60
+
+    # QoS to publish with
+    qos = 0
+
+    def __init__(self, address, topic='CurrentCost', qos=0):
+        self.topic = topic
+        self.qos = qos
+        self.session = CurrentCostMQTTSession("ccrepublish", address)
+        self.parser = CurrentCostDataParser()
+        self.ccfuncs = CurrentCostDataFunctions()
+        self.history = CurrentCostHistoryCollector()
+
+        self.lock = threading.Lock()
+        # latest data waiting to be published - (payload, retain, interval) 
+        #  by topic
+        self.pending = {}
+        # time each topic was last published to
+        self.lastSent = {}
+        # history payloads last published, by topic
+        self.lastHistory = {}
+
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+        # counters
+        self.liveReadings = 0
+        self.historyUpdates = 0
+        self.published = 0
+        self.batches = 0
+        # data replaced by newer data for the same topic before it was sent
+        self.coalesced = 0
+
+    def start(self):
+        global trc
+        trc.FunctionEntry("currentcostmqttpublish :: start")
+        self.session.start()
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="CurrentCostMQTTRepublisher")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        trc.FunctionExit("currentcostmqttpublish :: start")
+
+    #
+    # stop publishing - anything waiting to be published is sent first
+    # 
+    def stop(self):
+        global trc
+        trc.FunctionEntry("currentcostmqttpublish :: stop")
+        self.stopEvent.set()
+        if self.thread != None and self.thread != threading.currentThread():
+            self.thread.join()
+        self.flush(True)
+        self.session.stop()
+        trc.FunctionExit("currentcostmqttpublish :: stop")
+
+
+    #
+    # called with data from the meter - on the serial reader's thread
+    # 
+    def liveReadingReceived(self, ccreading):
+        self.liveReadings += 1
+        self.queue(self.topic + '/live', '%.3f' % ccreading, False, self.liveInterval)
+
+    def liveChannelsReceived(self, sensor, watts):
+        sensortopic = self.topic + '/live/' + sensor
+        self.queue(sensortopic, str(sum(watts)), False, self.liveInterval)
+        for i in range(len(watts)):
+            self.queue(sensortopic + '/ch' + str(i + 1), str(watts[i]), False, self.liveInterval)
+
+    def historyReceived(self, currentcoststruct):
+        self.historyUpdates += 1
+        self.parser.storeTimedCurrentCostData(self.history, currentcoststruct)
+        for datatype, payload in self.getHistoryPayloads():
+            topic = self.topic + '/history/' + datatype
+            if payload != self.lastHistory.get(topic):
+                self.queue(topic, payload, True, self.historyInterval)
+
+
+    #
+    # history data in the format used by the CurrentCost MQTT perl script -
+    #  the most recent first, with 0 for anything we haven't received. 
+    #  timestamps are calculated in the same way as when the data is stored
+    #  by the GUI (CurrentCostDataFunctions.StoreHistoryUpdates)
+    # 
+    def getHistoryPayloads(self, currtime=None):
+        if currtime == None:
+            currtime = datetime.datetime.now()
+        payloads = []
+        for datatype, store, timefn, format in [ ('hours',  self.history.hours,  self.ccfuncs.GetHistoryHour,  '%.3f'),
+                                                 ('days',   self.history.days,   self.ccfuncs.GetHistoryDay,   '%d'),
+                                                 ('months', self.history.months, self.ccfuncs.GetHistoryMonth, '%d') ]:
+            timestamps = [ timefn(currtime, i) for i in range(self.HISTORY_LENGTHS[datatype]) ]
+            payloads.append((datatype, ' '.join([ format % store.get(timestamp, 0) for timestamp in timestamps ])))
+            # forget data too old to be published again
+            for timestamp in store.keys():
+                if timestamp < timestamps[-1]:
+                    del store[timestamp]
+        return payloads
+
+    #
+    # keep the latest data for a topic until it is time to publish it
+    # 
+    def queue(self, topic, payload, retain, interval):
+        self.lock.acquire()
+        if topic in self.pending:
+            self.coalesced += 1
+        self.pending[topic] = (payload, retain, interval)
+        self.lock.release()
+
+    def run(self):
+        while not self.stopEvent.isSet():
+            self.stopEvent.wait(self.BATCH_INTERVAL)
+            if self.session.isConnected():
+                self.flush()
+
+    #
+    # publish everything which is due to be published - or everything 
+    #  waiting if 'everything' is True
+    # 
+    def flush(self, everything=False):
+        now = time.time()
+        self.lock.acquire()
+        due = sorted([ (topic, self.pending[topic]) for topic in self.pending.keys()
+                       if everything or now - self.lastSent.get(topic, 0) >= self.pending[topic][2] ])
+        for topic, data in due:
+            del self.pending[topic]
+        self.lock.release()
+        if len(due) == 0:
+            return
+
+        if self.session.publishMany([ (topic, payload, self.qos, retain) for topic, (payload, retain, interval) in due ]):
+            self.published += len(due)
+            self.batches += 1
+            for topic, (payload, retain, interval) in due:
+                self.lastSent[topic] = now
+                if retain:
+                    self.lastHistory[topic] = payload
+        else:
+            # not connected - keep the data for when we are, unless newer 
+            #  data has been received since
+            self.lock.acquire()
+            for topic, data in due:
+                if topic not in self.pending:
+                    self.pending[topic] = data
+            self.lock.release()
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import os
+import time
+import errno
+import random
+import select
+import socket
+import struct
+import threading
+
+from currentcostmqttpackets import CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP
+from currentcostmqttpackets import SUBSCRIBE, SUBACK, UNSUBSCRIBE, PINGREQ, DISCONNECT
+from currentcostmqttpackets import CONNACK_ACCEPTED, MAX_CLIENT_ID_LENGTH, DEFAULT_PORT
+from currentcostmqttpackets import encodeString, encodePacket, encodePublish, readPacket, decodePublish
+
+# this class provides logging and diagnostics
+from tracer                 import CurrentCostTracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  A connection to an MQTT broker which looks after itself - used by the live
+#   and history MQTT connections.
+# 
+#  The MQTT connections used to each connect once with a fixed client id, and
+#   had no way of noticing that the connection had been lost. If the broker 
+#   was restarted they stopped receiving data without saying so, and as a 
+#   broker disconnects a client when another connects with the same id, two
+#   copies of the GUI kept disconnecting each other.
+# 
+#  A session:
+#   - connects with a client id unique to the session (see makeClientId),
+#      which it keeps when it reconnects
+#   - sends a ping when nothing has been sent, or nothing received since 
+#      the last ping, for half of the keepalive interval, and treats the 
+#      connection as lost if nothing is received from the broker for one and
+#      a half times the interval. A session which only publishes at QoS 0 
+#      gets nothing back from the broker but the responses to its pings
+#   - reconnects if the connection is lost, waiting longer between each 
+#      attempt, and subscribes again to everything it was subscribed to
+#   - runs on its own thread until it is stopped. stop can be called from 
+#      any thread, including from a listener's callback
+#   - keeps publications made with QoS 1 or 2 until the broker acknowledges
+#      them, and sends them again after reconnecting
+#   - keeps track of which subscribe requests the broker has acknowledged, 
+#      so that callers can wait until they have been (waitUntilSubscribed)
+# 
+#  The listener is given whichever of these it provides - they are called on 
+#   the session's thread:
+#    messageReceived(topic, payload) - a publication has been received
+#    sessionConnected(reconnected)   - connected (reconnected is False for 
+#                                       the first connection)
+#    sessionLost(errmsg)             - the connection was lost - the session
+#                                       will try to reconnect
+# 
+#  The MQTT 3.1 packets are encoded and decoded using the functions from 
+#   currentcostmqttbroker.
+# 
+
+
+#
+# a client id for a connection to a broker - 'prefix' identifies what the 
+#  connection is for, and the rest makes it unique to this process and session
+# 
+#  MQTT 3.1 brokers reject client ids longer than 23 characters, so the prefix
+#   is shortened if necessary
+# 
+def makeClientId(prefix):
+    suffix = '-%x-%04x' % (os.getpid() & 0xffff, random.randint(0, 0xffff))
+    return prefix[:MAX_CLIENT_ID_LENGTH - len(suffix)] + suffix
+
+#
+# the host and port of a broker from an address given by the user - either
+#  'host' (using the default port) or 'host:port'
+# 
+def parseBrokerAddress(address):
+    address = str(address).strip()
+    if address.count(':') == 1:
+        host, port = address.split(':')
+        return host, int(port)
+    return address, DEFAULT_PORT
+
+
+class CurrentCostMQTTSession():
+
+    # seconds between messages that the broker should expect from us
+    KEEPALIVE = 30
+
+    # time to wait (seconds) before trying to reconnect - doubled after each 
+    #  failed attempt up to RECONNECT_MAX_DELAY
+    RECONNECT_DELAY     = 1
+    RECONNECT_MAX_DELAY = 60
+
+    # seconds to wait for the broker when connecting
+    CONNECT_TIMEOUT = 10
+
+    # most publications made with QoS 1 or 2 that can be waiting for the 
+    #  broker to acknowledge them - if there are more, the oldest are dropped
+    MAX_INFLIGHT = 1000
+
+    def __init__(self, clientprefix, address, listener=None, keepalive=KEEPALIVE):
+        self.clientid = makeClientId(clientprefix)
+        self.host, self.port = parseBrokerAddress(address)
+        self.listener = listener
+        self.keepalive = keepalive
+
+        self.sock = None
+        self.sendlock = threading.Lock()
+        self.nextmsgid = 0
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.connected = threading.Event()
+        self.reconnectDelay = self.RECONNECT_DELAY
+        self.lastSent = 0
+        self.lastReceived = 0
+        self.lastPing = 0
+        # error from the last failed attempt to connect, or the last lost
+        #  connection
+        self.lastError = None
+
+        # topic filters to subscribe to, and the QoS for each - subscribed to
+        #  again after reconnecting
+        self.subscriptions = {}
+        # message ids of subscribe requests the broker hasn't acknowledged, 
+        #  and an event which is set when there are none
+        self.pendingSubscribes = set()
+        self.subscribed = threading.Event()
+        self.subscribed.set()
+
+        # publications made with QoS 1 or 2 which the broker hasn't 
+        #  acknowledged yet - (topic, payload, qos, retain) by message id
+        self.inflight = {}
+
+        # counters
+        self.connects = 0
+        self.reconnects = 0
+        self.received = 0
+        self.published = 0
+        self.redelivered = 0
+
+    #
+    # start connecting on the session's thread - use waitUntilConnected to 
+    #  wait for the first connection
+    # 
+    def start(self):
+        global trc
+        trc.FunctionEntry("currentcostmqttsession :: start")
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="CurrentCostMQTTSession " + self.clientid)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        trc.FunctionExit("currentcostmqttsession :: start")
+
+    # returns True if the session is connected within 'timeout' seconds
+    def waitUntilConnected(self, timeout):
+        self.connected.wait(timeout)
+        return self.connected.isSet()
+
+    def isConnected(self):
+        return self.connected.isSet()
+
+    # returns True if the broker acknowledges everything we have subscribed 
+    #  to within 'timeout' seconds
+    def waitUntilSubscribed(self, timeout):
+        self.subscribed.wait(timeout)
+        return self.subscribed.isSet()
+
+    #
+    # disconnect from the broker and stop the session's thread
+    # 
+    def stop(self):
+        global trc
+        trc.FunctionEntry("currentcostmqttsession :: stop")
+        self.stopEvent.set()
+        if self.connected.isSet():
+            try:
+                self.send(encodePacket(DISCONNECT, 0, ''))
+            except socket.error:
+                pass
+        self.shutdownSocket()
+        if self.thread != None and self.thread != threading.currentThread():
+            self.thread.join()
+        trc.FunctionExit("currentcostmqttsession :: stop")
+
+    #
+    # subscribe to a topic filter - now if we're connected, and whenever we 
+    #  (re)connect
+    # 
+    def subscribe(self, topicfilter, qos=0):
+        self.subscriptions[topicfilter] = qos
+        if self.connected.isSet():
+            try:
+                self.sendSubscribe([ topicfilter ])
+            except socket.error, err:
+                # we will subscribe again once we've reconnected
+                trc.Trace("unable to subscribe to %s : %s", topicfilter, err)
+
+    def unsubscribe(self, topicfilter):
+        if topicfilter in self.subscriptions:
+            del self.subscriptions[topicfilter]
+            if self.connected.isSet():
+                try:
+                    self.send(encodePacket(UNSUBSCRIBE, 0x02, self.getMessageId() + encodeString(topicfilter)))
+                except socket.error, err:
+                    trc.Trace("unable to unsubscribe from %s : %s", topicfilter, err)
+
+    #
+    # publish a message - returns False if we're not connected
+    # 
+    def publish(self, topic, payload, qos=0, retain=False):
+        return self.publishMany([ (topic, payload, qos, retain) ])
+
+    #
+    # publish a list of messages - (topic, payload, qos, retain) - which are 
+    #  sent to the broker together
+    # 
+    #  returns False if we're not connected. messages published with QoS 1 or
+    #   2 are sent again after reconnecting if the connection is lost before
+    #   the broker acknowledges them
+    # 
+    def publishMany(self, messages):
+        if not self.connected.isSet():
+            return False
+        packets = []
+        for topic, payload, qos, retain in messages:
+            msgid = 0
+            if qos > 0:
+                msgid = struct.unpack('!H', self.getMessageId())[0]
+                self.addInflight(msgid, (topic, payload, qos, retain))
+            packets.append(encodePublish(topic, payload, qos, retain, msgid))
+        try:
+            self.send(''.join(packets))
+        except socket.error, err:
+            trc.Trace("unable to publish %d messages : %s", len(messages), err)
+            return False
+        self.published += len(messages)
+        return True
+
+
+    def run(self):
+        global trc
+        trc.FunctionEntry("currentcostmqttsession :: run")
+        while not self.stopEvent.isSet():
+            try:
+                self.connect()
+            except Exception, err:
+                self.lastError = str(err)
+                trc.Trace("unable to connect to %s:%d as %s : %s", self.host, self.port, self.clientid, err)
+                self.closeSocket()
+                self.waitToReconnect()
+                continue
+
+            try:
+                self.notify('sessionConnected', self.connects > 1)
+                self.receive()
+            except Exception, err:
+                self.lastError = str(err)
+            self.connected.clear()
+            self.closeSocket()
+            # we subscribe again once we've reconnected
+            if len(self.subscriptions) > 0:
+                self.subscribed.clear()
+
+            if not self.stopEvent.isSet():
+                trc.Trace("lost connection to %s:%d : %s", self.host, self.port, self.lastError)
+                self.notify('sessionLost', self.lastError)
+                self.waitToReconnect()
+        trc.FunctionExit("currentcostmqttsession :: run")
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.CONNECT_TIMEOUT)
+        self.sock.settimeout(self.CONNECT_TIMEOUT)
+        # clean session - everything we're subscribed to is subscribed to 
+        #  again after connecting
+        body = encodeString('MQIsdp') + chr(3) + chr(0x02) + struct.pack('!H', self.keepalive)
+        self.send(encodePacket(CONNECT, 0, body + encodeString(self.clientid)))
+        packet = readPacket(self.sock)
+        if packet == None or packet[0] != CONNACK:
+            raise socket.error('no response from MQTT broker')
+        if ord(packet[2][1]) != CONNACK_ACCEPTED:
+            raise socket.error('connection refused by MQTT broker (return code %d)' % ord(packet[2][1]))
+        self.lastReceived = time.time()
+
+        self.connects += 1
+        if self.connects > 1:
+            self.reconnects += 1
+        self.reconnectDelay = self.RECONNECT_DELAY
+        trc.Trace("connected to %s:%d as %s", self.host, self.port, self.clientid)
+
+        # subscribe requests made on the last connection will never be
+        #  acknowledged
+        self.sendlock.acquire()
+        self.pendingSubscribes.clear()
+        self.subscribed.set()
+        self.sendlock.release()
+        if len(self.subscriptions) > 0:
+            self.sendSubscribe(self.subscriptions.keys())
+        self.resendInflight()
+        self.connected.set()
+
+    #
+    # handle packets from the broker until the connection is lost or the 
+    #  session is stopped
+    # 
+    #  we wait for data using select, so that we can send pings when the 
+    #   connection is quiet. once a packet starts to arrive it is read with 
+    #   a timeout, in case the rest of it never does
+    # 
+    def receive(self):
+        while not self.stopEvent.isSet():
+            now = time.time()
+            if now - self.lastReceived > self.keepalive * 1.5:
+                raise socket.error('no response from MQTT broker for %d seconds' % (now - self.lastReceived))
+            if (now - self.lastSent >= self.keepalive / 2.0 or 
+                (now - self.lastReceived >= self.keepalive / 2.0 and now - self.lastPing >= self.keepalive / 2.0)):
+                self.send(encodePacket(PINGREQ, 0, ''))
+                self.lastPing = now
+
+            # woken often enough to send a ping in time for the response to
+            #  arrive before the connection is treated as lost
+            readable = select.select([ self.sock ], [], [], self.keepalive / 4.0)[0]
+            if len(readable) == 0:
+                continue
+            packet = readPacket(self.sock)
+            if packet == None:
+                if self.stopEvent.isSet():
+                    break
+                raise socket.error('connection closed by MQTT broker')
+            self.lastReceived = time.time()
+            self.handlePacket(packet)
+
+    def handlePacket(self, packet):
+        msgtype, flags, body = packet
+        if msgtype == PUBLISH:
+            topic, payload, qos, retain, msgid = decodePublish(flags, body)
+            if qos == 1:
+                self.send(encodePacket(PUBACK, 0, struct.pack('!H', msgid)))
+            elif qos == 2:
+                self.send(encodePacket(PUBREC, 0, struct.pack('!H', msgid)))
+            self.received += 1
+            self.notify('messageReceived', topic, payload)
+        elif msgtype == PUBREL:
+            self.send(encodePacket(PUBCOMP, 0, body[0:2]))
+        elif msgtype == PUBREC:
+            self.send(encodePacket(PUBREL, 0x02, body[0:2]))
+        elif msgtype == PUBACK or msgtype == PUBCOMP:
+            self.removeInflight(struct.unpack('!H', body[0:2])[0])
+        elif msgtype == SUBACK:
+            self.sendlock.acquire()
+            self.pendingSubscribes.discard(body[0:2])
+            if len(self.pendingSubscribes) == 0:
+                self.subscribed.set()
+            self.sendlock.release()
+        # other acknowledgements (UNSUBACK, PINGRESP etc.) need no response
+
+    #
+    # call a function provided by the listener, if it has one
+    # 
+    def notify(self, event, *args):
+        callback = getattr(self.listener, event, None)
+        if callback != None:
+            try:
+                callback(*args)
+            except Exception, err:
+                trc.Error("MQTT listener failed handling %s : %s", event, err)
+
+    def waitToReconnect(self):
+        self.stopEvent.wait(self.reconnectDelay)
+        self.reconnectDelay = min(self.reconnectDelay * 2, self.RECONNECT_MAX_DELAY)
+
+    def addInflight(self, msgid, message):
+        self.sendlock.acquire()
+        self.inflight[msgid] = message
+        if len(self.inflight) > self.MAX_INFLIGHT:
+            # message ids are allocated in order, so the smallest is the 
+            #  oldest - unless they have wrapped around
+            oldest = min(self.inflight.keys(), key=lambda inflightid: (inflightid - msgid - 1) % 65535)
+            del self.inflight[oldest]
+        self.sendlock.release()
+
+    def removeInflight(self, msgid):
+        self.sendlock.acquire()
+        if msgid in self.inflight:
+            del self.inflight[msgid]
+        self.sendlock.release()
+
+    #
+    # send publications which weren't acknowledged before the connection was
+    #  lost again - the broker may have seen them already, so they are marked
+    #  as duplicates
+    # 
+    def resendInflight(self):
+        self.sendlock.acquire()
+        inflight = sorted(self.inflight.items())
+        self.sendlock.release()
+        if len(inflight) > 0:
+            trc.Trace("sending %d unacknowledged publications again", len(inflight))
+            self.send(''.join([ encodePublish(topic, payload, qos, retain, msgid, True) 
+                                for msgid, (topic, payload, qos, retain) in inflight ]))
+            self.redelivered += len(inflight)
+
+    def sendSubscribe(self, topicfilters):
+        msgid = self.getMessageId()
+        self.sendlock.acquire()
+        self.pendingSubscribes.add(msgid)
+        self.subscribed.clear()
+        self.sendlock.release()
+        body = msgid
+        for topicfilter in topicfilters:
+            body += encodeString(topicfilter) + chr(self.subscriptions.get(topicfilter, 0))
+        self.send(encodePacket(SUBSCRIBE, 0x02, body))
+
+    def getMessageId(self):
+        self.sendlock.acquire()
+        self.nextmsgid = (self.nextmsgid % 65535) + 1
+        msgid = self.nextmsgid
+        self.sendlock.release()
+        return struct.pack('!H', msgid)
+
+    def send(self, data):
+        self.sendlock.acquire()
+        try:
+            if self.sock == None:
+                raise socket.error('not connected to MQTT broker')
+            self.sock.sendall(data)
+            self.lastSent = time.time()
+        finally:
+            self.sendlock.release()
+
+    # wake up the session's thread if it is waiting for data
+    def shutdownSocket(self):
+        self.sendlock.acquire()
+        if self.sock != None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.sendlock.release()
+
+    def closeSocket(self):
+        self.sendlock.acquire()
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+        self.sendlock.release()
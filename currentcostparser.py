@@ -31,6 +31,7 @@ from currentcostdataconvert import CurrentCostDataConverter
 
 # this class provides logging and diagnostics
 from tracer                 import CurrentCostTracer
+import tracer
 
 
 trc = CurrentCostTracer()
@@ -201,7 +202,7 @@ class CurrentCostDataParser:
             #print("Received incomplete or invalid data from CurrentCost meter.")            
             # reset the internal stores
             trc.Trace("XML parsing error")
-            trc.Trace("ExpatError : " + str(err))
+            trc.Trace("ExpatError : %s", err)
             trc.Trace("resetting parser stores (again)")
             self.currentcoststruct = {}
             self.currentpointer = []
@@ -209,7 +210,7 @@ class CurrentCostDataParser:
             #print 'Unknown error: ' + str(msg)
             # reset the internal stores
             trc.Trace("unknown error during XML parsing")
-            trc.Trace("Exception : " + str(msg))
+            trc.Trace("Exception : %s", msg)
             trc.Trace("resetting parser stores (again)")
             self.currentcoststruct = {}
             self.currentpointer = []
@@ -235,14 +236,20 @@ class CurrentCostDataParser:
     # 
     # Inputs:
     #   ccdb - class where data should be stored
+    #   currentcoststruct - (optional) CurrentCost data returned by an earlier
+    #     call to parseCurrentCostXML. If not provided, the data from the most
+    #     recent call is stored
     # 
     # Outputs:
     #   None
     # 
-    def storeTimedCurrentCostData(self, ccdb):
+    def storeTimedCurrentCostData(self, ccdb, currentcoststruct=None):
         global trc
         trc.FunctionEntry("storeTimedCurrentCostData")
 
+        if currentcoststruct == None:
+            currentcoststruct = self.currentcoststruct
+
         # prepare a reference timestamp
         today = datetime.datetime.now()
 
@@ -253,33 +260,34 @@ class CurrentCostDataParser:
 
         # different versions of the CurrentCost meter stored the version number
         #  in different places - so this if...else sequence is a little over-complex
-        trc.Trace("self.currentcoststruct['msg'] == " + str(self.currentcoststruct['msg']))
-        if 'src' in self.currentcoststruct['msg']:
-            trc.Trace("found 'src' in self.currentcoststruct['msg']")
-            trc.Trace("self.currentcoststruct['msg']['src'] == " + str(self.currentcoststruct['msg']['src']))
-            if 'sver' in self.currentcoststruct['msg']['src']:
+        trc.Trace("currentcoststruct['msg'] == %s", currentcoststruct['msg'])
+        if 'src' in currentcoststruct['msg']:
+            trc.Trace("found 'src' in currentcoststruct['msg']")
+            trc.Trace("currentcoststruct['msg']['src'] == %s", currentcoststruct['msg']['src'])
+            if 'sver' in currentcoststruct['msg']['src']:
                 # version 2  ('classic') CurrentCost meters
-                trc.Trace("found 'sver' in self.currentcoststruct['msg']['src']")
-                if 'hist' in self.currentcoststruct['msg']:
-                    trc.Trace("found 'hist' in self.currentcoststruct['msg']")
-                    self.converter.storeTimedCurrentCostDatav2(today, ccdb, self.currentcoststruct['msg']['hist'])
+                trc.Trace("found 'sver' in currentcoststruct['msg']['src']")
+                if 'hist' in currentcoststruct['msg']:
+                    trc.Trace("found 'hist' in currentcoststruct['msg']")
+                    self.converter.storeTimedCurrentCostDatav2(today, ccdb, currentcoststruct['msg']['hist'])
                     updatesremaining = 0
-            elif self.currentcoststruct['msg']['src'].startswith('CC128-v'):                
+            elif currentcoststruct['msg']['src'].startswith('CC128-v'):                
                 # version CC128 ('envi') CurrentCost meters
-                trc.Trace("CC128 version : " + str(self.currentcoststruct['msg']['src']))
-                if 'hist' in self.currentcoststruct['msg']:
+                trc.Trace("CC128 version : %s", currentcoststruct['msg']['src'])
+                if 'hist' in currentcoststruct['msg']:
                     # for now, only looking at data on sensor 0 - the 'whole house' sensor
                     #  to get different sensor data, change the 'if' statement below
-                    trc.Trace("found 'hist' in self.currentcoststruct['msg']")
-                    for dataobj in self.currentcoststruct['msg']['hist']:
-                        trc.Trace("next data object in self.currentcoststruct['msg']['hist']:")
-                        trc.Trace(str(dataobj))
+                    trc.Trace("found 'hist' in currentcoststruct['msg']")
+                    for dataobj in currentcoststruct['msg']['hist']:
+                        if tracer.enableTrace:
+                            trc.Trace("next data object in currentcoststruct['msg']['hist']:")
+                            trc.Trace(dataobj)
                         if dataobj.startswith('data'):
                             trc.Trace("found data in history")
-                            if self.currentcoststruct['msg']['hist'][dataobj]['sensor'] == '0':
+                            if currentcoststruct['msg']['hist'][dataobj]['sensor'] == '0':
                                 trc.Trace("storing data for sensor 0")
-                                self.converter.storeTimedCurrentCostDatavcc128(today, ccdb, self.currentcoststruct['msg']['hist'][dataobj])                            
-                                keys = (self.currentcoststruct['msg']['hist'][dataobj]).keys()
+                                self.converter.storeTimedCurrentCostDatavcc128(today, ccdb, currentcoststruct['msg']['hist'][dataobj])                            
+                                keys = (currentcoststruct['msg']['hist'][dataobj]).keys()
                                 keys.sort()
                                 for key in keys:
                                     keynumchk = key[0]
@@ -306,16 +314,16 @@ class CurrentCostDataParser:
                                         updatesremaining = 1
                                         break
                                     else:
-                                        trc.Trace("Uknown data in history", keynumchk, self.currentcoststruct['msg']['hist'][dataobj])
+                                        trc.Trace("Uknown data in history %s %s", keynumchk, currentcoststruct['msg']['hist'][dataobj])
                             else:
-                                trc.Trace("Got data for sensor %s, sensors others than 0 are not supported yet" % self.currentcoststruct['msg']['hist'][dataobj]['sensor'] + str( self.currentcoststruct['msg']['hist'][dataobj]))
+                                trc.Trace("Got data for sensor %s, sensors others than 0 are not supported yet%s", currentcoststruct['msg']['hist'][dataobj]['sensor'], currentcoststruct['msg']['hist'][dataobj])
 
                 else:
-                    trc.Trace("This is not a history packet, ignoring: " + str( self.currentcoststruct))
+                    trc.Trace("This is not a history packet, ignoring: %s", currentcoststruct)
             else:
-                trc.Trace("Unknow currentcost hardware version for xmldata: " + str( self.currentcoststruct))
+                trc.Trace("Unknow currentcost hardware version for xmldata: %s", currentcoststruct)
         else:
-            trc.Trace("<src> not found in <msg>, Unknow xml format: " + str( self.currentcoststruct))
+            trc.Trace("<src> not found in <msg>, Unknow xml format: %s", currentcoststruct)
 
 
         trc.FunctionExit("storeTimedCurrentCostData")
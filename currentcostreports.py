@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+
+import os
+import sys
+import getopt
+import datetime
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')
+
+from matplotlib.figure import Figure
+from matplotlib.dates import AutoDateLocator, AutoDateFormatter
+from matplotlib.ticker import NullLocator, NullFormatter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from currentcostdb             import CurrentCostDB
+from currentcostdatafunctions  import CurrentCostDataFunctions
+from currentcostvisualisations import CurrentCostVisualisations
+from tracer                    import CurrentCostTracer
+
+
+#
+# Renders graphs of CurrentCost data to image files, without a GUI
+# 
+#  Uses the same Plot* functions as the GUI tabs, drawn onto figures using 
+#   the Agg backend - so neither wx nor a display is needed. 
+# 
+#  Each graph is rendered by a separate worker process, so that reports for 
+#   a large number of CurrentCost data files can use every core available.
+# 
+#  usage: 
+#    python currentcostreports.py [options] <file.ccd> [<file.ccd> ...]
+# 
+#  options:
+#    --start=YYYY-MM-DD   - only include data from this date
+#    --end=YYYY-MM-DD     - only include data up to this date
+#    --format=png         - png, svg or pdf
+#    --outdir=DIR         - where to write images (default: current dir)
+#    --graphs=LIST        - comma-separated list of graphs to draw from 
+#                            hourly,daily,monthly,averageday,averageweek 
+#                            (default: all of them)
+#    --units=kWh          - kWh, or GBP using the cost per kWh stored in 
+#                            each data file
+#    --processes=N        - number of worker processes (default: one per core)
+#    --debug              - write diagnostics to currentcostdiagnostics.log
+# 
+
+
+# class for logging diagnostics
+trc = CurrentCostTracer()
+
+
+REPORT_GRAPHS  = [ 'hourly', 'daily', 'monthly', 'averageday', 'averageweek' ]
+REPORT_FORMATS = [ 'png', 'svg', 'pdf' ]
+
+# size of the images to render (inches and dots-per-inch)
+REPORT_FIGSIZE = (10, 6)
+REPORT_DPI     = 100
+
+
+#
+# render a single graph to an image file
+# 
+#  this is run in a worker process, so it opens its own connection to the 
+#   database. 
+# 
+#  returns the name of the file written, or None if there was no data to draw
+# 
+def renderGraph(dbfile, graphname, outputfile, startdate, enddate, units):
+    global trc
+    trc.FunctionEntry("renderGraph")
+
+    ccdb = CurrentCostDB()
+    ccdb.InitialiseDB(dbfile)
+
+    ccvis = CurrentCostVisualisations()
+    ccdata = CurrentCostDataFunctions()
+
+    # what unit are we using to plot?
+    kwhfactor = 1
+    ccvis.graphunitslabel = ccvis.GRAPHUNIT_LABEL_KWH
+    if units == ccvis.GRAPHUNIT_KEY_GBP:
+        kwhcost = ccdb.RetrieveSetting("kwhcost")
+        if kwhcost != None:
+            kwhfactor = float(kwhcost)
+            ccvis.graphunitslabel = 'GBP'
+
+    figure = Figure(figsize=REPORT_FIGSIZE, dpi=REPORT_DPI)
+    FigureCanvasAgg(figure)
+    axes = figure.gca()
+    # leave room for the rotated date labels
+    figure.subplots_adjust(bottom=0.2)
+
+    plotted = False
+    if graphname == 'hourly':
+        hourData = ccdb.GetHourDataCollection(startdate, enddate)
+        if len(hourData) > 0:
+            ccvis.PlotHourlyData(axes, hourData, kwhfactor)
+            setDateRange(axes, hourData, startdate, enddate)
+            plotted = True
+    elif graphname == 'daily':
+        dayData = ccdb.GetDayDataCollection(startdate, enddate)
+        if len(dayData) > 0:
+            ccvis.PlotDailyData(axes, dayData, kwhfactor)
+            setDateRange(axes, dayData, startdate, enddate)
+            plotted = True
+    elif graphname == 'monthly':
+        monthData = ccdb.GetMonthDataCollection(startdate, enddate)
+        if len(monthData) > 0:
+            ccvis.PlotMonthlyData(axes, monthData, kwhfactor)
+            plotted = True
+    elif graphname == 'averageday':
+        averageDay = ccdata.CalculateAverageDay(ccdb.GetHourDataCollection(startdate, enddate))
+        if averageDay:
+            ccvis.PlotAverageDay(averageDay, axes, None, kwhfactor)
+            plotted = True
+    elif graphname == 'averageweek':
+        averageWeek = ccdata.CalculateAverageWeek(ccdb.GetDayDataCollection(startdate, enddate))
+        if averageWeek:
+            ccvis.PlotAverageWeek(averageWeek, axes, None, kwhfactor)
+            plotted = True
+
+    ccdb.CloseDB()
+
+    if plotted == False:
+        trc.Trace("no " + graphname + " data in " + dbfile)
+        trc.FunctionExit("renderGraph")
+        return None
+
+    figure.savefig(outputfile)
+
+    trc.FunctionExit("renderGraph")
+    return outputfile
+
+#
+# the Plot* functions zoom the hourly and daily graphs to show the last week 
+#  or month before today - for a report, we want to show the requested range
+#  of dates, or all of the data if no range was given
+# 
+#  the tick locators used by the GUI are chosen for its default zoom, so we 
+#   let matplotlib choose ticks to suit the range being shown instead
+# 
+def setDateRange(axes, graphData, startdate, enddate):
+    if startdate == None:
+        startdate = min(graphData.keys())
+    if enddate == None:
+        enddate = max(graphData.keys())
+    axes.set_xlim(xmin=datetime.date(startdate.year, startdate.month, startdate.day), 
+                  xmax=datetime.date(enddate.year, enddate.month, enddate.day) + datetime.timedelta(days=1))
+
+    locator = AutoDateLocator()
+    axes.xaxis.set_major_locator(locator)
+    axes.xaxis.set_major_formatter(AutoDateFormatter(locator))
+    axes.xaxis.set_minor_locator(NullLocator())
+    axes.xaxis.set_minor_formatter(NullFormatter())
+
+#
+# entry point for worker processes - the arguments for each graph are passed 
+#  as a single tuple by the pool
+# 
+def renderGraphTask(task):
+    try:
+        return renderGraph(*task)
+    except Exception, exc:
+        trc.Error("failed to render " + task[1] + " graph for " + task[0] + " : " + str(exc))
+        return None
+
+
+#
+# render the requested graphs for a set of CurrentCost data files
+# 
+#  returns a list of the files that were written
+# 
+def renderReports(dbfiles, outdir, fileformat, graphs, startdate, enddate, units, processes):
+    global trc
+    trc.FunctionEntry("renderReports")
+
+    tasks = []
+    for dbfile in dbfiles:
+        household = os.path.splitext(os.path.basename(dbfile))[0]
+        for graphname in graphs:
+            outputfile = os.path.join(outdir, household + "-" + graphname + "." + fileformat)
+            tasks.append((dbfile, graphname, outputfile, startdate, enddate, units))
+
+    if processes == 1:
+        results = map(renderGraphTask, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(renderGraphTask, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    trc.FunctionExit("renderReports")
+    return [ result for result in results if result != None ]
+
+
+def usage():
+    print "usage: python currentcostreports.py [--start=YYYY-MM-DD] [--end=YYYY-MM-DD]"
+    print "                [--format=png|svg|pdf] [--outdir=DIR] [--graphs=hourly,daily,...]"
+    print "                [--units=kWh|GBP] [--processes=N] [--debug] <file.ccd> [<file.ccd> ...]"
+
+def parseDate(datestring):
+    return datetime.datetime.strptime(datestring, "%Y-%m-%d").date()
+
+
+if __name__ == "__main__":
+    try:
+        options, dbfiles = getopt.getopt(sys.argv[1:], 'h', 
+                                         ['start=', 'end=', 'format=', 'outdir=', 'graphs=', 
+                                          'units=', 'processes=', 'debug', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    startdate  = None
+    enddate    = None
+    fileformat = 'png'
+    outdir     = '.'
+    graphs     = REPORT_GRAPHS
+    units      = CurrentCostVisualisations.GRAPHUNIT_KEY_KWH
+    processes  = None
+    debug      = False
+
+    try:
+        for opt, arg in options:
+            if opt == '--start':
+                startdate = parseDate(arg)
+            elif opt == '--end':
+                enddate = parseDate(arg)
+            elif opt == '--format':
+                fileformat = arg.lower()
+            elif opt == '--outdir':
+                outdir = arg
+            elif opt == '--graphs':
+                graphs = arg.split(',')
+            elif opt == '--units':
+                units = arg
+            elif opt == '--processes':
+                processes = int(arg)
+            elif opt == '--debug':
+                debug = True
+            elif opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+    except ValueError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    if len(dbfiles) == 0 or fileformat not in REPORT_FORMATS or \
+       len([ g for g in graphs if g not in REPORT_GRAPHS ]) > 0:
+        usage()
+        sys.exit(2)
+
+    trc.EnableTrace(debug)
+    trc.InitialiseTraceFile()
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    for outputfile in renderReports(dbfiles, outdir, fileformat, graphs, startdate, enddate, units, processes):
+        print outputfile
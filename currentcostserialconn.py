@@ -23,8 +23,10 @@
 #
 
 from tracer import CurrentCostTracer 
+import tracer
 
 import serial
+import time
 import threading       # this class needs to be thread-safe
 
 #
@@ -37,12 +39,79 @@ import threading       # this class needs to be thread-safe
 trc = CurrentCostTracer()
 
 
+# most bytes read in a single sample when detecting a meter's baud rate
+DETECT_SAMPLE_BYTES = 512
+
+# possible results of looking at a sample of data received from a meter
+SAMPLE_EMPTY   = 'empty'
+SAMPLE_VALID   = 'valid'
+SAMPLE_GARBAGE = 'garbage'
+
+#
+# decide whether a sample of data received from a meter looks like the XML 
+#  that CurrentCost meters send
+# 
+#  data received at the wrong baud rate is mostly non-printable bytes
+# 
+def classifySample(sample):
+    if len(sample) == 0:
+        return SAMPLE_EMPTY
+    printable = 0
+    for ch in sample:
+        if (' ' <= ch <= '~') or ch in '\r\n\t':
+            printable += 1
+    # a few bad bytes are expected if we start listening part way through 
+    #  a character, so we only need the data to be mostly printable
+    if printable < len(sample) * 0.9:
+        return SAMPLE_GARBAGE
+    if sample.find('<') != -1:
+        return SAMPLE_VALID
+    # not enough data to tell
+    return SAMPLE_EMPTY
+
+
 class CurrentCostConnection:
 
     connection = None
     connerr = None
 
-    lock = threading.Lock()
+    lock = None
+
+    # identifies the meter this connection reads from - used to tag readings
+    #  when reading from more than one meter at a time
+    meterid = None
+
+    # reads data from the meter for the live and history connections - see 
+    #  currentcostserialreader
+    reader = None
+
+    #
+    # each instance has its own connection and lock, so that several meters
+    #  (on different ports) can be read at the same time
+    # 
+    def __init__(self, meterid=None):
+        self.connection = None
+        self.lock = threading.Lock()
+        self.meterid = meterid
+
+
+    # the port and baud rate of the last successful connection
+    port = None
+    baudrate = None
+
+    # baud rates used by known models of CurrentCost meter - CC128 ('envi')
+    #  and 'classic' meters
+    BAUD_RATE_CC128   = 57600
+    BAUD_RATE_CLASSIC = 9600
+    BAUD_RATES = [ BAUD_RATE_CC128, BAUD_RATE_CLASSIC ]
+
+    # how long (seconds) to listen at each baud rate when detecting the type 
+    #  of meter, and how long to keep trying before giving up
+    DETECT_SAMPLE_TIME = 0.3
+    DETECT_TIMEOUT     = 15
+
+    # timeout (seconds) for reading a line of data once connected
+    READ_TIMEOUT = 3
 
 
     #
@@ -54,7 +123,12 @@ class CurrentCostConnection:
     #  Input: 'portdet' - the serial device details
     #    (e.g. for Windows, this will be something like 'COM9' and on Linux, it
     #      will be something like '/dev/ttyUSB')
-    def connect(self, portdet):
+    #         'baudrate' - (optional) baud rate that worked last time. If the 
+    #    meter still seems to be sending data at this rate, detection is skipped
+    # 
+    #  after connecting, the baud rate used is available from self.baudrate so
+    #   that it can be remembered for next time
+    def connect(self, portdet, baudrate=None):
         global trc
         trc.FunctionEntry("currentcostserialconn :: connect")
 
@@ -64,6 +138,27 @@ class CurrentCostConnection:
             trc.FunctionExit("currentcostserialconn :: connect")
             return True
 
+        # try to work out which type of meter is connected from a short sample
+        #  of the data it sends at each baud rate, rather than waiting for a 
+        #  whole line of data at each
+        try:
+            detected = self.detectBaudRate(portdet, baudrate)
+            if detected != None:
+                self.connection = self.openPort(portdet, detected, self.READ_TIMEOUT)
+                self.port = portdet
+                self.baudrate = detected
+                trc.FunctionExit("currentcostserialconn :: connect")
+                return True
+        except serial.SerialException, msg:
+            trc.Trace("SerialException - failed to detect meter type")
+            trc.Trace(str(msg))
+            self.connerr = msg
+            trc.FunctionExit("currentcostserialconn :: connect")
+            raise msg
+
+        # if we couldn't tell from a sample, fall back to trying the settings 
+        #  for each type of meter in turn
+
         # the 'classic' meters are still the most common, so we try that first
         try:
             # connect to the CurrentCost meter
@@ -83,6 +178,8 @@ class CurrentCostConnection:
             xmlsearch = testdata.find('<')
             if xmlsearch != -1:
                 trc.Trace("think we connected successfully")
+                self.port = portdet
+                self.baudrate = self.BAUD_RATE_CLASSIC
                 trc.FunctionExit("currentcostserialconn :: connect")
                 return True
             else:
@@ -113,6 +210,9 @@ class CurrentCostConnection:
                                             stopbits=serial.STOPBITS_ONE,
                                             timeout=3)
             # if we are here, we connected successfully
+            self.port = portdet
+            self.baudrate = self.BAUD_RATE_CC128
+            trc.FunctionExit("currentcostserialconn :: connect")
             return True
         except serial.SerialException, msg:
             # we won't report a failure yet 
@@ -130,6 +230,67 @@ class CurrentCostConnection:
         # if we are here, we failed to connect on both attempts
         raise self.connerr
 
+    #
+    # reconnect using the port and baud rate of the last successful connection
+    # 
+    def reconnect(self):
+        self.disconnect()
+        return self.connect(self.port, self.baudrate)
+
+    def openPort(self, portdet, baudrate, timeout):
+        return serial.Serial(port=portdet,
+                             baudrate=baudrate,
+                             bytesize=serial.EIGHTBITS,
+                             parity=serial.PARITY_NONE,
+                             stopbits=serial.STOPBITS_ONE,
+                             timeout=timeout)
+
+    #
+    # identify the baud rate the meter is using
+    # 
+    #  listens at each candidate baud rate for DETECT_SAMPLE_TIME. meters only
+    #   send data every few seconds, so most samples will be empty - but data
+    #   received at the wrong baud rate is garbage, so each sample either 
+    #   confirms a baud rate, rules it out, or tells us nothing
+    # 
+    #  the preferred baud rate (e.g. the one that worked last time) is tried
+    #   first. returns None if nothing could be identified by DETECT_TIMEOUT
+    # 
+    def detectBaudRate(self, portdet, preferred=None):
+        global trc
+        trc.FunctionEntry("currentcostserialconn :: detectBaudRate")
+
+        candidates = list(self.BAUD_RATES)
+        if preferred in candidates:
+            candidates.remove(preferred)
+            candidates.insert(0, preferred)
+
+        detected = None
+        deadline = time.time() + self.DETECT_TIMEOUT
+        while detected == None and time.time() < deadline:
+            for baudrate in candidates[:]:
+                port = self.openPort(portdet, baudrate, self.DETECT_SAMPLE_TIME)
+                try:
+                    sample = port.read(DETECT_SAMPLE_BYTES)
+                finally:
+                    port.close()
+                verdict = classifySample(sample)
+                trc.Trace("sampled %d bytes at %d baud : %s", len(sample), baudrate, verdict)
+                if verdict == SAMPLE_VALID:
+                    detected = baudrate
+                    break
+                elif verdict == SAMPLE_GARBAGE:
+                    candidates.remove(baudrate)
+            if detected == None and len(candidates) == 1 and len(self.BAUD_RATES) > 1:
+                # every other baud rate has been ruled out
+                detected = candidates[0]
+            elif len(candidates) == 0:
+                break
+
+        trc.Trace("detected baud rate : %s", detected)
+        trc.FunctionExit("currentcostserialconn :: detectBaudRate")
+        return detected
+
     #
     # closes any active serial connection
     def disconnect(self):
@@ -156,19 +317,20 @@ class CurrentCostConnection:
                 self.lock.acquire()
                 line = self.connection.readline()
                 line = line.rstrip('\r\n')
-                trc.Trace("read a line from currentcost meter:")
-                trc.Trace(line)
+                if tracer.enableTrace:
+                    trc.Trace("read a line from currentcost meter:")
+                    trc.Trace(line)
                 trc.FunctionExit("currentcostserialconn :: readUpdate")
                 return line
             except serial.SerialException, err:
                 trc.Error("encountered error while trying to read from CurrentCost meter")
-                trc.Error("SerialException " + str(err))
+                trc.Error("SerialException %s", err)
                 self.disconnect()
                 trc.FunctionExit("currentcostserialconn :: readUpdate")
                 raise err
             except Exception, msg:
                 trc.Error("encountered error while trying to read from CurrentCost meter")
-                trc.Error("Exception " + str(msg))
+                trc.Error("Exception %s", msg)
                 self.disconnect()
                 trc.FunctionExit("currentcostserialconn :: readUpdate")
                 raise msg
@@ -182,5 +344,5 @@ class CurrentCostConnection:
     # 
     def isConnected(self):
         global trc
-        trc.Trace("currentcostserialconn :: isConnected - returning " + str((self.connection != None)))
+        trc.Trace("currentcostserialconn :: isConnected - returning %s", (self.connection != None))
         return (self.connection != None)
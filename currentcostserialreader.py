@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import os
+import select
+import serial
+import threading
+
+from currentcostparser      import CurrentCostDataParser
+
+# this class provides logging and diagnostics
+from tracer                 import CurrentCostTracer
+import tracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  Reads data from a CurrentCost meter on a background thread, parses each
+#   update received, and passes the data to everything that is interested in
+#   it.
+# 
+#  The live and history connections used to each call readUpdate in a loop 
+#   on their own thread - so when both were using the same meter, each line
+#   was only seen by whichever of them happened to read it - and each parsed 
+#   the data separately. A reader owns the serial port, parses each update 
+#   once, and gives the results to all of its subscribers.
+# 
+#  The reader waits for data using select, on both the serial port and a pipe
+#   which is written to when the reader is stopped. This means that stopping
+#   takes effect immediately, rather than after the next line or read timeout,
+#   and the port is never closed while a read is in progress.
+# 
+#  Where the serial port cannot be used with select (e.g. on Windows) it falls
+#   back to reading a line at a time with a timeout, checking whether it has
+#   been stopped between lines.
+# 
+#  Subscribers provide whichever of these they are interested in - they are
+#   called on the reader thread:
+#    liveReadingReceived(ccreading)    - a live reading (in kW)
+#    liveChannelsReceived(sensor, watts) - the watts for each channel of a
+#                                          sensor in a live reading
+#    historyReceived(currentcoststruct) - an update containing history data,
+#                                          as returned by CurrentCostDataParser
+#    historyFinished()                  - an update without history data has 
+#                                          been received after some with it
+#    frameError(line, err)              - live data couldn't be parsed
+#    readerError(errmsg)                - the reader has given up on the meter
+# 
+#  History data and channels are only parsed if a subscriber is interested 
+#   in them. Updates
+#   from 'classic' meters include both a live reading and history data.
+# 
+#  If reading from the meter fails (e.g. because the USB cable is briefly 
+#   disconnected) the reader tries to reconnect, waiting longer between each 
+#   attempt. Subscribers are only told about the error if it can't reconnect.
+# 
+
+
+#
+# Parse live XML
+# 
+# Read a line of XML, identify the three live channel watts values, and 
+#  return the sum of them (in kW) - or -1 if there is no live reading in the 
+#  line
+# 
+#  this is much quicker than parsing the whole update as XML
+# 
+def parseLiveXML(line):
+
+    START_TAG_LENGTH = 12    # 12 is the length of the "<chX><watts>" string
+    END_TAG_LENGTH = 14    # 14 is the length of the "</watts></chX>" string
+
+    ccreading = 0
+
+    idx = line.find('<ch1><watts>')
+    if idx <= 0:
+        # raise Exception('Unable to find an opening ch1 tag')
+        return -1
+    idx += START_TAG_LENGTH
+
+    endidx = line.find('</watts></ch1>', idx)
+    if endidx <= 0:
+        # raise Exception('Unable to find a closing ch1 tag')
+        return -1
+
+    substr = line[idx : endidx]
+
+    ccreading += float(float(substr) / 1000)
+
+    idx = line.find('<ch2><watts>', endidx)
+    if idx <= 0:
+        return ccreading
+    idx += START_TAG_LENGTH
+
+    endidx = line.find('</watts></ch2>', idx)
+    if endidx <= 0:
+        return ccreading
+
+    substr = line[idx : endidx]
+
+    ccreading += float(float(substr) / 1000)
+
+    idx = line.find('<ch3><watts>', endidx)
+    if idx <= 0:
+        return ccreading
+    idx += START_TAG_LENGTH
+
+    endidx = line.find('</watts></ch3>', idx)
+    if endidx <= 0:
+        return ccreading
+
+    substr = line[idx : endidx]
+
+    ccreading += float(float(substr) / 1000)
+
+    return ccreading
+
+
+#
+# Parse the channels in live XML
+# 
+#  returns (sensor, watts) where watts is a list of the watts for each 
+#   channel, or None if there is no live reading in the line. 'classic' 
+#   meters don't identify a sensor, so their readings are for sensor '0'
+# 
+def parseLiveChannels(line):
+    idx = line.find('<ch1><watts>')
+    if idx <= 0:
+        return None
+
+    sensor = '0'
+    start = line.rfind('<sensor>', 0, idx)
+    if start != -1:
+        end = line.find('</sensor>', start)
+        if end != -1:
+            sensor = line[start + len('<sensor>') : end]
+
+    watts = []
+    channel = 1
+    while idx > 0:
+        idx += len('<chX><watts>')
+        endidx = line.find('</watts>', idx)
+        if endidx <= 0:
+            break
+        # parseLiveXML accepts fractional watts, so we do too
+        watts.append(int(float(line[idx : endidx])))
+        channel += 1
+        idx = line.find('<ch%d><watts>' % channel, endidx)
+    return sensor, watts
+
+
+# used when creating readers, so that a connection only ever has one
+readersLock = threading.Lock()
+
+#
+# get the reader for a serial connection - creating one if necessary
+# 
+def getSerialReader(serialconn):
+    readersLock.acquire()
+    try:
+        if serialconn.reader == None or serialconn.reader.stopped:
+            serialconn.reader = CurrentCostSerialReader(serialconn)
+        return serialconn.reader
+    finally:
+        readersLock.release()
+
+
+class CurrentCostSerialReader():
+
+    # time to wait (seconds) before trying to reconnect, doubled after each 
+    #  failed attempt up to RECONNECT_MAX_DELAY
+    RECONNECT_DELAY     = 1
+    RECONNECT_MAX_DELAY = 30
+    # number of attempts before giving up
+    RECONNECT_ATTEMPTS  = 10
+
+    # longest time (seconds) to wait for data before checking that the serial
+    #  port hasn't been closed by something else
+    SELECT_TIMEOUT = 1
+
+    # number of times we have reconnected to the meter
+    reconnects = 0
+
+    def __init__(self, serialconn):
+        self.serialconn = serialconn
+        self.subscribers = []
+        self.parser = CurrentCostDataParser()
+        # True if the last update received included history data
+        self.receivingHistory = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+        self.stopEvent = threading.Event()
+        self.reconnects = 0
+        # written to when the reader is stopped, to wake it from select
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+
+    #
+    # start passing data from the meter to a subscriber - the reader thread is
+    #  started when the first subscriber is added
+    # 
+    def addSubscriber(self, subscriber):
+        self.lock.acquire()
+        try:
+            self.subscribers.append(subscriber)
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, name="CurrentCostSerialReader")
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    #
+    # stop passing data to a subscriber - the reader is stopped (and the 
+    #  serial port closed) when there are no subscribers left
+    # 
+    def removeSubscriber(self, subscriber):
+        self.lock.acquire()
+        try:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            lastsubscriber = (len(self.subscribers) == 0)
+        finally:
+            self.lock.release()
+        if lastsubscriber:
+            self.stop()
+
+    #
+    # stop reading - this can be called on any thread, including by a 
+    #  subscriber when it is passed data
+    # 
+    def stop(self):
+        global trc
+        trc.FunctionEntry("currentcostserialreader :: stop")
+        self.lock.acquire()
+        try:
+            if self.stopped:
+                trc.FunctionExit("currentcostserialreader :: stop")
+                return
+            self.stopped = True
+            thread = self.thread
+            # the pipe is closed by the reader thread once it has stopped,
+            #  which it can't do until we release the lock
+            if self.wakeupWrite != None:
+                os.write(self.wakeupWrite, 'x')
+        finally:
+            self.lock.release()
+        self.stopEvent.set()
+
+        if thread == None:
+            self.close()
+        elif thread != threading.currentThread():
+            thread.join()
+        # otherwise we are on the reader thread, which closes the connection
+        #  once the subscriber returns
+        trc.FunctionExit("currentcostserialreader :: stop")
+
+    def run(self):
+        global trc
+        trc.FunctionEntry("currentcostserialreader :: run")
+
+        # data received after the last complete line
+        partial = ''
+        while not self.stopped:
+            try:
+                if self.canSelect():
+                    data = self.readAvailable()
+                else:
+                    data = self.readLine()
+            except Exception, err:
+                trc.Error("error reading from CurrentCost meter: %s", err)
+                partial = ''
+                if self.stopped:
+                    break
+                if self.reconnect() == False:
+                    if not self.stopped:
+                        self.notifyError('Error reading from COM port: ' + str(err))
+                    break
+                continue
+
+            if data:
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    self.processLine(line.rstrip('\r'))
+
+        self.close()
+        trc.FunctionExit("currentcostserialreader :: run")
+
+    #
+    # returns True if we can wait for data from the serial port using select
+    # 
+    def canSelect(self):
+        return hasattr(self.serialconn.connection, 'fileno')
+
+    #
+    # wait until data is available from the meter (or we are stopped) and 
+    #  return whatever has been received
+    # 
+    def readAvailable(self):
+        port = self.serialconn.connection
+        if port == None:
+            raise serial.SerialException('not connected to CurrentCost meter')
+
+        readable = select.select([ port.fileno(), self.wakeupRead ], [], [], self.SELECT_TIMEOUT)[0]
+        if len(readable) == 0 or self.wakeupRead in readable:
+            return ''
+
+        self.serialconn.lock.acquire()
+        try:
+            # the port is readable, so this won't block - if the device has 
+            #  been disconnected, pyserial raises an exception here
+            data = port.read(max(port.inWaiting(), 1))
+        finally:
+            self.serialconn.lock.release()
+        if tracer.enableTrace:
+            trc.Trace("read %d bytes from CurrentCost meter", len(data))
+        return data
+
+    #
+    # read a line of data with a timeout - used where select can't be
+    # 
+    def readLine(self):
+        line = self.serialconn.readUpdate()
+        if line == None:
+            # the connection was closed by another thread
+            raise serial.SerialException('not connected to CurrentCost meter')
+        if len(line) == 0:
+            return ''
+        return line + '\n'
+
+    #
+    # parse a line of data from the meter, and pass whatever it contains to 
+    #  the subscribers interested in it
+    # 
+    def processLine(self, line):
+        global trc
+
+        if line.find('<hist>') != -1:
+            self.receivingHistory = True
+            if self.hasSubscribers('historyReceived'):
+                currentcoststruct = self.parser.parseCurrentCostXML(line)
+                if currentcoststruct != None and 'hist' in currentcoststruct['msg']:
+                    self.publish('historyReceived', currentcoststruct)
+        elif self.receivingHistory:
+            self.receivingHistory = False
+            self.publish('historyFinished')
+
+        channels = None
+        try:
+            ccreading = parseLiveXML(line)
+            if ccreading >= 0 and self.hasSubscribers('liveChannelsReceived'):
+                channels = parseLiveChannels(line)
+        except Exception, err:
+            trc.Trace("error encountered parsing XML: %s", err)
+            self.publish('frameError', line, err)
+            return
+        if ccreading >= 0:
+            self.publish('liveReadingReceived', ccreading)
+            if channels != None:
+                self.publish('liveChannelsReceived', channels[0], channels[1])
+
+    def hasSubscribers(self, event):
+        for subscriber in self.subscribers[:]:
+            if hasattr(subscriber, event):
+                return True
+        return False
+
+    #
+    # call the named method of every subscriber that has it
+    # 
+    def publish(self, event, *args):
+        global trc
+        self.lock.acquire()
+        subscribers = self.subscribers[:]
+        self.lock.release()
+        for subscriber in subscribers:
+            if self.stopped:
+                return
+            handler = getattr(subscriber, event, None)
+            if handler != None:
+                try:
+                    handler(*args)
+                except Exception, err:
+                    trc.Error("subscriber failed to handle %s from CurrentCost meter: %s", event, err)
+
+    def notifyError(self, errmsg):
+        self.publish('readerError', errmsg)
+
+    #
+    # Try to reconnect to the meter after an error
+    # 
+    #  returns True if we reconnected, or False if we gave up or were 
+    #   stopped while trying
+    # 
+    def reconnect(self):
+        global trc
+        trc.FunctionEntry("currentcostserialreader :: reconnect")
+
+        self.serialconn.disconnect()
+        delay = self.RECONNECT_DELAY
+        for attempt in range(self.RECONNECT_ATTEMPTS):
+            # returns early if we are stopped while waiting
+            self.stopEvent.wait(delay)
+            if self.stopped:
+                break
+            try:
+                trc.Trace("reconnect attempt %d", attempt + 1)
+                self.serialconn.reconnect()
+                self.reconnects += 1
+                trc.FunctionExit("currentcostserialreader :: reconnect")
+                return True
+            except Exception, exception:
+                trc.Trace("failed to reconnect: %s", exception)
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+        trc.FunctionExit("currentcostserialreader :: reconnect")
+        return False
+
+    #
+    # close the serial port - unless a new reader has already been created to
+    #  use it
+    # 
+    #  the reader can't be restarted once it has been closed, so it is marked 
+    #   as stopped - if it gave up trying to reconnect, subscribers may not 
+    #   call stop until after this
+    # 
+    def close(self):
+        readersLock.acquire()
+        try:
+            if self.serialconn.reader == self:
+                self.serialconn.reader = None
+                self.serialconn.disconnect()
+        finally:
+            readersLock.release()
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            if self.wakeupWrite != None:
+                os.close(self.wakeupRead)
+                os.close(self.wakeupWrite)
+                self.wakeupRead = None
+                self.wakeupWrite = None
+        finally:
+            self.lock.release()
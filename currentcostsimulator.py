@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+
+import os
+import re
+import sys
+import pty
+import tty
+import time
+import random
+import errno
+import fcntl
+import getopt
+import select
+import signal
+import datetime
+import threading
+
+from tracer import CurrentCostTracer
+
+
+#
+# Simulates a CurrentCost meter connected to a serial port, so that the code 
+#  which reads from meters can be run and load tested without any hardware
+# 
+#  A pseudo-terminal pair is opened, and the simulator writes XML to one end 
+#   of it. The other end (given by 'portname') can be used anywhere that a 
+#   serial port name is expected - e.g. by CurrentCostConnection.connect
+# 
+#  The simulator can write:
+#    live updates from a CC128 ('envi') or 'classic' meter, at a chosen rate
+#    garbage between updates, and updates split into two writes with a pause
+#     between them - as seen from real meters on a noisy serial connection
+#    bursts of CC128 history updates (classic meters include history data 
+#     in every update)
+#    updates captured from a real meter, replayed at N times their original 
+#     speed
+# 
+#  Only available on platforms with pseudo-terminals (e.g. Linux, Mac OS X).
+# 
+#  usage: 
+#    python currentcostsimulator.py [options]
+# 
+#  options:
+#    --meter=cc128        - cc128 or classic
+#    --interval=SECS      - time between live updates (default: 6 seconds)
+#    --garbage=P          - probability of writing garbage before an update
+#    --split=P            - probability of splitting an update into two writes
+#    --history=N          - send a burst of history after every N live updates
+#    --replay=FILE        - replay updates captured from a meter (one per line)
+#    --speed=N            - replay N times faster than the updates were captured
+#                            (0 to replay as fast as possible)
+#    --repeat=N           - replay the captured updates N times
+#    --link=PATH          - create a symlink to the simulated serial port
+# 
+
+
+# class for logging diagnostics
+trc = CurrentCostTracer()
+
+
+METER_CC128   = 'cc128'
+METER_CLASSIC = 'classic'
+
+
+class CurrentCostSimulator():
+
+    # type of meter to simulate
+    meterType = METER_CC128
+    # seconds between live updates - 0 to write them as fast as possible
+    interval = 6.0
+    # probability of writing garbage before an update
+    garbageRate = 0.0
+    # probability of writing an update in two parts with a pause between them
+    splitRate = 0.0
+    # seconds to pause between the two parts of a split update
+    splitDelay = 0.01
+    # send a burst of history after every N live updates - 0 for never
+    historyEvery = 0
+
+    def __init__(self):
+        self.masterfd, self.slavefd = pty.openpty()
+        # no echo or line processing - the port should behave like a serial 
+        #  device which just passes bytes through
+        tty.setraw(self.slavefd)
+        self.portname = os.ttyname(self.slavefd)
+        # writes shouldn't block when the buffer is full, so that the 
+        #  simulator can be stopped even if nothing is reading from it
+        flags = fcntl.fcntl(self.masterfd, fcntl.F_GETFL)
+        fcntl.fcntl(self.masterfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.random = random.Random(0)
+        self.stopped = threading.Event()
+        self.thread = None
+        # number of live updates written, and the time each was written - 
+        #  indexed by the watts value it contained
+        self.sequence = 0
+        self.sendTimes = {}
+        self.historyUpdates = 0
+        self.bytesWritten = 0
+
+    #
+    # start writing live updates in a background thread
+    # 
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='CurrentCostSimulator')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    #
+    # start replaying updates captured from a meter in a background thread
+    # 
+    def startReplay(self, lines, speed=1.0, repeat=1):
+        self.thread = threading.Thread(target=self.replay, args=(lines, speed, repeat), 
+                                       name='CurrentCostSimulator')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.masterfd)
+        os.close(self.slavefd)
+
+    #
+    # time that the live update containing a watts value was written 
+    # 
+    #  the watts value in each live update is its sequence number, so that 
+    #   the code receiving it can work out how long it took to arrive
+    # 
+    def getSendTime(self, watts):
+        return self.sendTimes.get(int(watts))
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.sequence += 1
+            watts = self.sequence % 100000
+            self.sendTimes[watts] = time.time()
+            self.writeUpdate(self.liveXML(watts))
+            if self.historyEvery > 0 and self.sequence % self.historyEvery == 0 and \
+               self.meterType == METER_CC128:
+                for update in self.historyXML():
+                    self.writeUpdate(update)
+                    self.historyUpdates += 1
+            if self.interval > 0:
+                self.stopped.wait(self.interval)
+
+    #
+    # replay updates captured from a meter
+    # 
+    #  the time between updates is taken from the time included in the 
+    #   updates (or the simulator's interval if there isn't one), divided by
+    #   speed
+    # 
+    def replay(self, lines, speed=1.0, repeat=1):
+        for iteration in range(repeat):
+            previous = None
+            for line in lines:
+                if self.stopped.isSet():
+                    return
+                line = line.strip()
+                if not line:
+                    continue
+                timestamp = getUpdateTime(line)
+                if speed > 0:
+                    delay = self.interval
+                    if timestamp != None and previous != None:
+                        # allow for updates either side of midnight
+                        delay = (timestamp - previous) % 86400
+                    if previous != None:
+                        self.stopped.wait(delay / float(speed))
+                previous = timestamp
+                self.writeUpdate(line)
+
+    def writeUpdate(self, xml):
+        if self.garbageRate > 0 and self.random.random() < self.garbageRate:
+            self.write(self.garbage())
+        data = xml + "\r\n"
+        if self.splitRate > 0 and self.random.random() < self.splitRate:
+            split = self.random.randint(1, len(data) - 1)
+            self.write(data[:split])
+            time.sleep(self.splitDelay)
+            self.write(data[split:])
+        else:
+            self.write(data)
+
+    #
+    # write to the pseudo-terminal - if nothing is reading from the other end
+    #  this waits for space in its buffer, giving up if the simulator is 
+    #  stopped
+    # 
+    def write(self, data):
+        while data and not self.stopped.isSet():
+            readable, writable, errored = select.select([], [ self.masterfd ], [], 0.1)
+            if len(writable) > 0:
+                try:
+                    written = os.write(self.masterfd, data)
+                except OSError, err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+                    written = 0
+                self.bytesWritten += written
+                data = data[written:]
+
+    # random bytes, as received from a meter with a poor connection
+    def garbage(self):
+        return "".join([ chr(self.random.randint(0, 255)) for i in range(self.random.randint(1, 40)) ])
+
+    def liveXML(self, watts):
+        now = datetime.datetime.now()
+        if self.meterType == METER_CLASSIC:
+            return "<msg><date><dsb>00014</dsb><hr>%02d</hr><min>%02d</min><sec>%02d</sec></date>" % (now.hour, now.minute, now.second) + \
+                   "<src><name>CC02</name><id>03280</id><type>1</type><sver>1.06</sver></src>" + \
+                   "<ch1><watts>%05d</watts></ch1><ch2><watts>00000</watts></ch2><ch3><watts>00000</watts></ch3>" % watts + \
+                   "<tmpr>18.7</tmpr>" + self.classicHistoryXML() + "</msg>"
+        return "<msg><src>CC128-v0.11</src><dsb>00089</dsb><time>%02d:%02d:%02d</time>" % (now.hour, now.minute, now.second) + \
+               "<tmpr>18.7</tmpr><sensor>0</sensor><id>01234</id><type>1</type>" + \
+               "<ch1><watts>%05d</watts></ch1></msg>" % watts
+
+    # every update from a classic meter includes a summary of its history
+    def classicHistoryXML(self):
+        return "<hist>" + \
+               "<hrs>" + "".join([ "<h%02d>%06.3f</h%02d>" % (i, 0.5 + (i % 5) * 0.25, i) for i in range(2, 27, 2) ]) + "</hrs>" + \
+               "<days>" + "".join([ "<d%02d>%05d</d%02d>" % (i, 10 + i % 7, i) for i in range(1, 32) ]) + "</days>" + \
+               "<mths>" + "".join([ "<m%02d>%05d</m%02d>" % (i, 300 + i * 5, i) for i in range(1, 13) ]) + "</mths>" + \
+               "<yrs>" + "".join([ "<y%d>%07d</y%d>" % (i, 3600 + i * 10, i) for i in range(1, 5) ]) + "</yrs>" + \
+               "</hist>"
+
+    #
+    # the series of updates a CC128 meter sends with its history data - 
+    #  2-hourly data for 31 days, then daily data for 90 days, then monthly 
+    #  data for 7 years
+    # 
+    def historyXML(self):
+        now = datetime.datetime.now()
+        updates = []
+        for prefix, numbers, perupdate in [ ('h', range(2, 745, 2), 12), 
+                                            ('d', range(1, 91),     15), 
+                                            ('m', range(1, 85),     12) ]:
+            for start in range(0, len(numbers), perupdate):
+                values = "".join([ "<%s%03d>%06.3f</%s%03d>" % (prefix, i, 0.5 + (i % 7) * 0.2, prefix, i) 
+                                   for i in numbers[start:start + perupdate] ])
+                updates.append("<msg><src>CC128-v0.11</src><dsb>00089</dsb>" + 
+                               "<time>%02d:%02d:%02d</time>" % (now.hour, now.minute, now.second) + 
+                               "<hist><dsw>00032</dsw><type>1</type><units>kwhr</units>" + 
+                               "<data><sensor>0</sensor>" + values + "</data></hist></msg>")
+        return updates
+
+
+CC128_TIME_PATTERN   = re.compile(r'<time>(\d\d):(\d\d):(\d\d)</time>')
+CLASSIC_TIME_PATTERN = re.compile(r'<hr>(\d\d)</hr><min>(\d\d)</min><sec>(\d\d)</sec>')
+
+#
+# the time (seconds since midnight) a meter included in an update, or None 
+#  if it doesn't include one
+# 
+def getUpdateTime(line):
+    match = CC128_TIME_PATTERN.search(line)
+    if match == None:
+        match = CLASSIC_TIME_PATTERN.search(line)
+    if match == None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def usage():
+    print "usage: python currentcostsimulator.py [--meter=cc128|classic] [--interval=SECS]"
+    print "                [--garbage=P] [--split=P] [--history=N]"
+    print "                [--replay=FILE] [--speed=N] [--repeat=N] [--link=PATH]"
+
+
+if __name__ == "__main__":
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'h', 
+                                      ['meter=', 'interval=', 'garbage=', 'split=', 'history=', 
+                                       'replay=', 'speed=', 'repeat=', 'link=', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    simulator = CurrentCostSimulator()
+    replayfile = None
+    speed = 1.0
+    repeat = 1
+    link = None
+
+    try:
+        for opt, arg in options:
+            if opt == '--meter':
+                if arg not in (METER_CC128, METER_CLASSIC):
+                    raise ValueError("unsupported meter type " + arg)
+                simulator.meterType = arg
+            elif opt == '--interval':
+                simulator.interval = float(arg)
+            elif opt == '--garbage':
+                simulator.garbageRate = float(arg)
+            elif opt == '--split':
+                simulator.splitRate = float(arg)
+            elif opt == '--history':
+                simulator.historyEvery = int(arg)
+            elif opt == '--replay':
+                replayfile = arg
+            elif opt == '--speed':
+                speed = float(arg)
+            elif opt == '--repeat':
+                repeat = int(arg)
+            elif opt == '--link':
+                link = arg
+            elif opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+    except ValueError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    if link != None:
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(simulator.portname, link)
+
+    print "simulating a CurrentCost meter on", simulator.portname
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: simulator.stopped.set())
+    if replayfile != None:
+        f = open(replayfile)
+        lines = f.readlines()
+        f.close()
+        simulator.startReplay(lines, speed, repeat)
+    else:
+        simulator.start()
+
+    try:
+        while simulator.thread.isAlive():
+            simulator.thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.close()
+    if link != None and os.path.islink(link):
+        os.remove(link)
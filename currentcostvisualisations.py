@@ -22,10 +22,12 @@
 #    Any contact about this application is warmly welcomed.
 #
 import datetime
+import numpy as np
 from tracer import CurrentCostTracer 
 
 
 from dateutil.relativedelta import relativedelta
+from matplotlib.text import Annotation
 from matplotlib.dates import DayLocator, HourLocator, MonthLocator, YearLocator, WeekdayLocator, DateFormatter, date2num, drange
 
 
@@ -61,11 +63,30 @@ class CurrentCostVisualisations:
     # key stored in database. label stored here
     graphunitslabel = GRAPHUNIT_KEY_KWH
 
+    # the kwhfactor used for each of the axes that have been drawn on
+    plottedfactors = None
+
+    # the kWh value of each bar and line drawn on each of the axes, so that 
+    #  they can be redrawn in other units without rounding errors building up
+    plottedvalues = None
+
+    # the most recently identified trends, and the key that identifies the 
+    #  data they were identified from
+    trendscache = None
+
+    def __init__(self):
+        self.plottedfactors = {}
+        self.plottedvalues = {}
+        self.trendscache = {}
+
 
     #
     # add a note to the graph
     # 
-    def AddNote(self, notetext, clickedaxes, clickeddatetime, dtfraction, clickedkwh, kwhfactor, clickedaxestype):
+    #  redraw can be set to False when adding several notes to a graph which 
+    #   will be redrawn afterwards
+    # 
+    def AddNote(self, notetext, clickedaxes, clickeddatetime, dtfraction, clickedkwh, kwhfactor, clickedaxestype, redraw=True):
 
         wdth = None
         ctr = None
@@ -94,7 +115,8 @@ class CurrentCostVisualisations:
                              xytext=(ctr, (clickedkwh * kwhfactor) + arrowlength),
                              horizontalalignment='center',
                              picker=True)
-        clickedaxes.figure.canvas.draw()
+        if redraw:
+            clickedaxes.figure.canvas.draw()
 
 
     #
@@ -115,11 +137,11 @@ class CurrentCostVisualisations:
         #  to be (2/24) wide
         barwidth = 0.083333333333333333333333333333333
 
-        trc.Trace("found " + str(len(hourData)) + " hour data items")
+        trc.Trace("found %d hour data items", len(hourData))
 
         # plot each hour data item
         for k, v in hourData.iteritems():
-            trc.Trace(str(k) + " : " + str(v))
+            trc.Trace("%s : %s", k, v)
             # we don't plot 0 items - matplotlib doesn't handle it very well, 
             # often throwing an exception if we try!
             if v > 0:
@@ -139,6 +161,14 @@ class CurrentCostVisualisations:
         maxdate = today + endoftoday
         axes.set_xlim(xmin=mindate, xmax=maxdate)
 
+        # format the axes
+        axes.xaxis.set_minor_formatter(DateFormatter('%I%p'))
+        axes.xaxis.set_major_formatter(DateFormatter('%d %b'))
+        axes.xaxis.set_major_locator(DayLocator()) 
+        axes.xaxis.set_minor_locator(HourLocator(range(12,24,12)))
+
+        self.rememberPlottedValues(axes, kwhfactor)
+
         trc.FunctionExit("PlotHourlyData")
 
 
@@ -155,11 +185,11 @@ class CurrentCostVisualisations:
         axes.set_ylabel(self.graphunitslabel)
         axes.set_title('Power usage by day')
 
-        trc.Trace("found " + str(len(dayData)) + " day data items")
+        trc.Trace("found %d day data items", len(dayData))
 
         # plot each day data item
         for k, v in dayData.iteritems():
-            trc.Trace(str(k) + " : " + str(v))
+            trc.Trace("%s : %s", k, v)
 
             # we don't plot 0 items - matplotlib doesn't handle it very well, 
             # often throwing an exception if we try!
@@ -182,6 +212,14 @@ class CurrentCostVisualisations:
         mindate = today - aweek
         axes.set_xlim(xmin=mindate, xmax=today)
 
+        # format the axes
+        axes.xaxis.set_major_formatter(DateFormatter('%b %y'))
+        axes.xaxis.set_major_locator(MonthLocator())
+        axes.xaxis.set_minor_formatter(DateFormatter('%d'))
+        axes.xaxis.set_minor_locator(DayLocator(range(2,31,2)))
+
+        self.rememberPlottedValues(axes, kwhfactor)
+
         trc.FunctionExit("PlotDailyData")
 
     #
@@ -197,11 +235,11 @@ class CurrentCostVisualisations:
         axes.set_ylabel(self.graphunitslabel)
         axes.set_title('Power usage by month')
 
-        trc.Trace("found " + str(len(monthData)) + " month data items")
+        trc.Trace("found %d month data items", len(monthData))
 
         # plot each hour data item
         for k, v in monthData.iteritems():
-            trc.Trace(str(k) + " : " + str(v))
+            trc.Trace("%s : %s", k, v)
 
             # we don't plot 0 items - matplotlib doesn't handle it very well, 
             # often throwing an exception if we try!
@@ -219,11 +257,22 @@ class CurrentCostVisualisations:
             label.set_picker(True)
             label.set_rotation(90)
 
+        # format the axes
+        axes.xaxis.set_minor_formatter(DateFormatter('%b'))
+        axes.xaxis.set_major_locator(YearLocator())
+        axes.xaxis.set_minor_locator(MonthLocator(range(2,13,1)))
+        axes.xaxis.set_major_formatter(DateFormatter('%Y'))
+
+        self.rememberPlottedValues(axes, kwhfactor)
+
         trc.FunctionExit("PlotMonthlyData")
 
     #
     # plot a graph of an average day
     # 
+    #  trendstxt can be None if a message about the average day should not be 
+    #   written to the 'trends' page
+    # 
     def PlotAverageDay(self, averageDay, axes, trendstxt, kwhfactor):
         global trc
         trc.FunctionEntry("PlotAverageDay")
@@ -239,23 +288,40 @@ class CurrentCostVisualisations:
         #  to be (2/24) wide
         barwidth = 0.083333333333333333333333333333333
 
+        # plot each hour data item
+        for avtime in averageDay:
+            avval = averageDay[avtime]
+            # we don't plot 0 items - matplotlib doesn't handle it very well, 
+            # often throwing an exception if we try!
+            if avval > 0:
+                axes.bar(avtime, (avval * kwhfactor), width=barwidth, color='g', picker=True)
+
+        # format the axes
+        axes.xaxis.set_major_locator(HourLocator(range(1, 24, 2)))
+        axes.xaxis.set_major_formatter(DateFormatter('%H00'))
+
         # as well as drawing an average day, we want to write a message on the
         #  'trends' page, which states what the highest average hour is
-        # 
-        # so while drawing the graph, we store the highest value
+        if trendstxt != None:
+            self.DescribeAverageDay(averageDay, trendstxt)
+
+        self.rememberPlottedValues(axes, kwhfactor)
+
+        trc.FunctionExit("PlotAverageDay")
+
+    #
+    # write a message on the 'trends' page, which states what the highest 
+    #  average hour is
+    # 
+    def DescribeAverageDay(self, averageDay, trendstxt):
         highesthour = -1
         highesthourval = -1
 
-        # plot each hour data item
         for avtime in averageDay:
             avval = averageDay[avtime]
             if avval > highesthourval:
                 highesthourval = avval
                 highesthour = avtime.hour
-            # we don't plot 0 items - matplotlib doesn't handle it very well, 
-            # often throwing an exception if we try!
-            if avval > 0:
-                axes.bar(avtime, (avval * kwhfactor), width=barwidth, color='g', picker=True)
 
         # if we have successfully identified which average hour typically has 
         #  the highest usage, we write a message about this to the 'trends' page
@@ -266,11 +332,12 @@ class CurrentCostVisualisations:
             trendstxt.UpdateTrendText(5, 
                                       "You typically use the most electricity between " + ("%d" % highesthour) + ":00 and " + ("%d" % endtimehr) + ":00")
 
-        trc.FunctionExit("PlotAverageDay")
-
     #
     # plot a graph of an average week
     # 
+    #  trendstxt can be None if a message about the average week should not be 
+    #   written to the 'trends' page
+    # 
     def PlotAverageWeek(self, averageWeek, axes, trendstxt, kwhfactor):
         global trc
         trc.FunctionEntry("PlotAverageWeek")
@@ -281,23 +348,40 @@ class CurrentCostVisualisations:
         axes.set_ylabel(self.graphunitslabel)
         axes.set_title('Power usage in an average week')
     
-        # as well as drawing an average day, we want to write a message on the
-        #  'trends' page, which states what the highest average hour is
-        # 
-        # so while drawing the graph, we store the highest value
+        # plot each day data item
+        for avday in averageWeek:
+            avval = averageWeek[avday]
+            # we don't plot 0 items - matplotlib doesn't handle it very well, 
+            # often throwing an exception if we try!
+            if avval != 0:
+                axes.bar(avday, (avval * kwhfactor), width=1, color='g', picker=True)
+
+        # format the axes
+        axes.xaxis.set_major_locator(DayLocator(range(0,8,1)))
+        axes.xaxis.set_major_formatter(DateFormatter('%a'))
+
+        # as well as drawing an average week, we want to write a message on 
+        #  the 'trends' page, which states what the highest average day is
+        if trendstxt != None:
+            self.DescribeAverageWeek(averageWeek, trendstxt)
+
+        self.rememberPlottedValues(axes, kwhfactor)
+
+        trc.FunctionExit("PlotAverageWeek")
+
+    #
+    # write a message on the 'trends' page, which states what the highest 
+    #  average day is
+    # 
+    def DescribeAverageWeek(self, averageWeek, trendstxt):
         highestday = -1
         highestdayval = -1
     
-        # plot each day data item
         for avday in averageWeek:
             avval = averageWeek[avday]
             if avval > highestdayval:
                 highestdayval = avval
                 highestday = avday.weekday()
-            # we don't plot 0 items - matplotlib doesn't handle it very well, 
-            # often throwing an exception if we try!
-            if avval != 0:
-                axes.bar(avday, (avval * kwhfactor), width=1, color='g', picker=True)
 
         # if we have successfully identified which average day typically has 
         #  the highest usage, we write a message about this to the 'trends' page
@@ -307,7 +391,80 @@ class CurrentCostVisualisations:
         except:
             trc.Error(str(highestday))
 
-        trc.FunctionExit("PlotAverageWeek")
+    #
+    # change the units used on a graph that has already been drawn by one of 
+    #  the Plot* functions above
+    # 
+    # rather than replotting the graph, the bars and lines already drawn are
+    #  redrawn in place from their kWh values. notes are removed, and should 
+    #  be added again by the caller using the new kwhfactor
+    # 
+    # returns False if the graph cannot be rescaled, and needs to be replotted
+    # 
+    def RescaleGraph(self, axes, kwhfactor):
+        global trc
+        trc.FunctionEntry("RescaleGraph")
+
+        oldfactor = self.plottedfactors.get(axes)
+        if oldfactor == None:
+            # graph not drawn yet
+            trc.FunctionExit("RescaleGraph")
+            return False
+        # lines (e.g. targets) drawn after the graph was plotted are added 
+        #  using the units they were drawn in
+        if self.rememberPlottedValues(axes, oldfactor) == False:
+            trc.FunctionExit("RescaleGraph")
+            return False
+
+        values = self.plottedvalues[axes]
+        for bar in axes.patches:
+            bar.set_height(values[bar] * kwhfactor)
+        for line in axes.lines:
+            line.set_ydata(values[line] * kwhfactor)
+        for note in [t for t in axes.texts if isinstance(t, Annotation)]:
+            note.remove()
+
+        if oldfactor != 0:
+            scale = float(kwhfactor) / oldfactor
+            ymin, ymax = axes.get_ylim()
+            axes.set_ylim(ymin * scale, ymax * scale)
+        else:
+            axes.relim()
+            axes.autoscale_view(scalex=False)
+        axes.set_ylabel(self.graphunitslabel)
+
+        self.plottedfactors[axes] = kwhfactor
+
+        trc.FunctionExit("RescaleGraph")
+        return True
+
+    #
+    # store the kWh value of each bar and line drawn on the axes that we 
+    #  don't already know, given the kwhfactor they were drawn with
+    # 
+    # returns False if there were new bars or lines drawn with a factor we 
+    #  can't get kWh values back from
+    # 
+    def rememberPlottedValues(self, axes, kwhfactor):
+        # forget bars and lines that have been removed (e.g. by replotting)
+        drawn = set(axes.patches) | set(axes.lines)
+        values = dict([ (artist, value) for artist, value in self.plottedvalues.get(axes, {}).iteritems() 
+                        if artist in drawn ])
+        self.plottedvalues[axes] = values
+
+        newbars  = [ bar for bar in axes.patches if bar not in values ]
+        newlines = [ line for line in axes.lines if line not in values ]
+        if len(newbars) + len(newlines) > 0 and kwhfactor == 0:
+            # the graph will have to be replotted to change units
+            if axes in self.plottedfactors:
+                del self.plottedfactors[axes]
+            return False
+        for bar in newbars:
+            values[bar] = bar.get_height() / float(kwhfactor)
+        for line in newlines:
+            values[line] = np.asarray(line.get_ydata(), dtype=float) / kwhfactor
+        self.plottedfactors[axes] = kwhfactor
+        return True
 
     #
     # plot the user's usage compared with the average usage of the group that 
@@ -597,9 +754,10 @@ class CurrentCostVisualisations:
     #  we have a method to add this line, and a method to delete it once drawn
     # 
 
-    def DrawTargetLine(self, targetvalue, axes, kwhfactor):
+    def DrawTargetLine(self, targetvalue, axes, kwhfactor, redraw=True):
         line = axes.axhline(y=(targetvalue * kwhfactor), color='y', linewidth=2)  
-        axes.figure.canvas.draw()
+        if redraw:
+            axes.figure.canvas.draw()
         return line
 
     def DeleteTargetLine(self, targetvalue, axes):
@@ -609,154 +767,111 @@ class CurrentCostVisualisations:
     #
     # identify some textual descriptions of trends in the CurrentCost data
     # 
+    #  lookback is the number of months to compare when looking for a trend 
+    #   in monthly usage
     # 
-    def IdentifyTrends(self, trends, hourData, dayData, monthData):
-        lowesthour   = 99999999
-        highesthour  = 0
-        lowestday    = 99999999
-        highestday   = 0
-        lowestmonth  = 99999999
-        highestmonth = 0
-        dayyesterday = 0
-        dayweekago   = 0
-        yesterday    = datetime.date.today() - datetime.timedelta(days=1)
-        oneweekago   = datetime.date.today() - datetime.timedelta(days=8)
-        thismonth    = datetime.date(datetime.date.today().year,
-                                     datetime.date.today().month,
-                                     1)
-        onemonthago   = thismonth - relativedelta(months=1)
-        twomonthsago  = thismonth - relativedelta(months=2)
-        threemonthsago= thismonth - relativedelta(months=3)
-        fourmonthsago = thismonth - relativedelta(months=4)
-        fivemonthsago = thismonth - relativedelta(months=5)
-        sixmonthsago  = thismonth - relativedelta(months=6)
-        sevenmonthsago= thismonth - relativedelta(months=7)
-        eightmonthsago= thismonth - relativedelta(months=8)
-        ninemonthsago = thismonth - relativedelta(months=9)
-        tenmonthsago  = thismonth - relativedelta(months=10)
-        month0        = 0
-        month1        = 0
-        month2        = 0
-        month3        = 0
-        month4        = 0
-        month5        = 0
-        month6        = 0
-        month7        = 0
-        month8        = 0
-        month9        = 0
-        month10       = 0
-    
-        for k, v in hourData.iteritems():
-            if v > 0:
-                if v < lowesthour:
-                    lowesthour = v
-                elif v > highesthour:
-                    highesthour = v                 
-        for k, v in dayData.iteritems():
-            if v > 0:
-                if v < lowestday:
-                    lowestday = v
-                elif v > highestday:
-                    highestday = v
-                if k == yesterday:
-                    dayyesterday = v
-                elif k == oneweekago:
-                    dayweekago = v
-        for k, v in monthData.iteritems():
-            if v > 0:
-                if k == thismonth:
-                    month0 = v
-                elif k == onemonthago:
-                    month1 = v
-                elif k == twomonthsago:
-                    month2 = v
-                elif k == threemonthsago:
-                    month3 = v
-                elif k == fourmonthsago:
-                    month4 = v
-                elif k == fivemonthsago:
-                    month5 = v
-                elif k == sixmonthsago:
-                    month6 = v
-                elif k == sevenmonthsago:
-                    month7 = v
-                elif k == eightmonthsago:
-                    month8 = v
-                elif k == ninemonthsago:
-                    month9 = v
-                elif k == tenmonthsago:
-                    month10 = v
-
-        if lowesthour != 99999999:
+    def IdentifyTrends(self, trends, ccdb, lookback=10):
+        self.DescribeTrends(trends, self.CalculateTrends(ccdb, lookback))
+
+    #
+    # identify trends in the CurrentCost data stored in the database
+    # 
+    #  uses aggregate queries rather than retrieving every row, and the 
+    #   results are cached - they are only recalculated if the data in the 
+    #   database has changed (or the day has changed, as trends are relative 
+    #   to today)
+    # 
+    def CalculateTrends(self, ccdb, lookback=10):
+        global trc
+        trc.FunctionEntry("CalculateTrends")
+
+        today = datetime.date.today()
+        cachekey = (ccdb.dbLocation, ccdb.GetDataVersion(), today, lookback)
+        if self.trendscache.get('key') == cachekey:
+            trc.FunctionExit("CalculateTrends")
+            return self.trendscache['trends']
+
+        trenddata = {}
+
+        # lowest and highest usage
+        trenddata['lowesthour'], trenddata['highesthour'] = ccdb.GetHourDataRange()
+        trenddata['lowestday'],  trenddata['highestday']  = ccdb.GetDayDataRange()
+
+        # yesterday compared with the same day a week before
+        trenddata['oneweekago']   = today - datetime.timedelta(days=8)
+        trenddata['dayyesterday'] = ccdb.GetDayData(today - datetime.timedelta(days=1))
+        trenddata['dayweekago']   = ccdb.GetDayData(trenddata['oneweekago'])
+
+        # monthly usage for each of the previous months, most recent first
+        #  (months with no usage recorded are treated as zero)
+        thismonth = datetime.date(today.year, today.month, 1)
+        monthData = ccdb.GetMonthDataCollection(thismonth - relativedelta(months=lookback))
+        months = []
+        for i in range(1, lookback + 1):
+            months.append(monthData.get(thismonth - relativedelta(months=i), 0))
+        trenddata['monthtrend'], trenddata['monthtrendlength'] = runLength(months)
+
+        self.trendscache['key'] = cachekey
+        self.trendscache['trends'] = trenddata
+
+        trc.FunctionExit("CalculateTrends")
+        return trenddata
+
+    #
+    # write descriptions of trends identified by CalculateTrends to the 
+    #  'trends' page
+    # 
+    def DescribeTrends(self, trends, trenddata):
+        lowesthour  = trenddata['lowesthour']
+        highesthour = trenddata['highesthour']
+        lowestday   = trenddata['lowestday']
+        highestday  = trenddata['highestday']
+        dayyesterday = trenddata['dayyesterday']
+        dayweekago   = trenddata['dayweekago']
+        oneweekago   = trenddata['oneweekago']
+        if dayweekago == None:
+            dayweekago = 0
+        mth = trenddata['monthtrendlength']
+
+        if lowesthour != None:
             trends.UpdateTrendText(1, "Lowest recorded electricity usage over a two-hour period is " + ("%.3f" % lowesthour) + " kWh.   Highest is " + ("%.3f" % highesthour) + " kWh")
-        if lowestday != 99999999:
+        if lowestday != None:
             trends.UpdateTrendText(2, "Lowest recorded daily electricity usage is " + ("%.2f" % lowestday) + " kWh.   Highest is " + ("%.2f" % highestday) + " kWh")
-        if dayyesterday > 0:
+        if dayyesterday != None and dayyesterday > 0:
             if dayyesterday < dayweekago:
                 trends.UpdateTrendText(3, "Yesterday, your daily recorded electricity usage (" + ("%.2f" % dayyesterday) + "kWh) was lower than last " + oneweekago.strftime("%A") + " (" + ("%.2f" % dayweekago) + " kWh)")
             elif dayyesterday > dayweekago:
                 trends.UpdateTrendText(3, "Yesterday, your daily recorded electricity usage (" + ("%.2f" % dayyesterday) + "kWh) was higher than last " + oneweekago.strftime("%A") + " (" + ("%.2f" % dayweekago) + " kWh)")
             else:
                 trends.UpdateTrendText(3, "Your daily recorded electricity usage yesterday (" + ("%.2f" % dayyesterday) + "kWh) was the same as last " + oneweekago.strftime("%A") + " (" + ("%.2f" % dayweekago) + "kWh)")
-        if month1 < month2:
-            mth = 1
-            if month2 < month3:
-                mth += 1
-                if month3 < month4:
-                    mth += 1
-                    if month4 < month5:
-                        mth += 1
-                        if month5 < month6:
-                            mth += 1
-                            if month6 < month7:
-                                mth += 1
-                                if month7 < month8:
-                                    mth += 1
-                                    if month8 < month9:
-                                        mth += 1
-                                        if month9 < month10:
-                                            mth += 1
+        if trenddata['monthtrend'] < 0:
             trends.UpdateTrendText(4, "Your monthly electricity usage has decreased every month for the last " + ("%d" % mth) + " months")
-        elif month1 > month2:
-            mth = 1
-            if month2 > month3:
-                mth += 1
-                if month3 > month4:
-                    mth += 1
-                    if month4 > month5:
-                        mth += 1
-                        if month5 > month6:
-                            mth += 1
-                            if month6 > month7:
-                                mth += 1
-                                if month7 > month8:
-                                    mth += 1
-                                    if month8 > month9:
-                                        mth += 1
-                                        if month9 > month10:
-                                            mth += 1
+        elif trenddata['monthtrend'] > 0:
             trends.UpdateTrendText(4, "Your monthly electricity usage has increased every month for the last " + ("%d" % mth) + " months")
-        else:
-            mth = 1
-            if month2 == month3:
-                mth += 1
-                if month3 == month4:
-                    mth += 1
-                    if month4 == month5:
-                        mth += 1
-                        if month5 == month6:
-                            mth += 1
-                            if month6 == month7:
-                                mth += 1
-                                if month7 == month8:
-                                    mth += 1
-                                    if month8 == month9:
-                                        mth += 1
-                                        if month9 == month10:
-                                            mth += 1
+        elif mth > 0:
             trends.UpdateTrendText(4, "Your monthly electricity usage has remained consistent for the last " + ("%d" % mth) + " months")
 
 
+#
+# utility function to find a trend at the start of a sequence of values
+# 
+#  values should be ordered from most recent to oldest. returns a tuple:
+#    trend  - 1 if values were increasing, -1 if decreasing, 0 if unchanged
+#    length - the number of consecutive changes that followed that trend
+# 
+def runLength(values):
+    trend = 0
+    length = 0
+    for i in range(0, len(values) - 1):
+        change = cmp(values[i], values[i + 1])
+        if i == 0:
+            trend = change
+        elif change != trend:
+            break
+        length += 1
+    return trend, length
+
+
 #
 # utility function to get the number of days in a month
 # 
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+import hashlib
+import threading
+import time
+import urllib2
+
+# this class provides logging and diagnostics
+from tracer                 import CurrentCostTracer
+
+
+trc = CurrentCostTracer()
+
+
+#
+#  Downloads data from a website on a schedule, on behalf of the classes 
+#   which get National Grid data (nationalgriddata.py and gridsourcedata.py).
+# 
+#  There is one fetcher for each URL, shared by everything that needs data 
+#   from it. It makes conditional requests, so that a website which supports 
+#   them doesn't have to send data we already have, and compares what it 
+#   does download with the last response so that subscribers are only told
+#   about data which has changed.
+# 
+#  The last data downloaded is kept, and given straight to new subscribers. 
+#   Errors don't replace it - instead, the fetcher waits longer before each 
+#   retry, so that a website which is down isn't polled constantly.
+# 
+#  Subscribers are passed data on the fetcher's thread, by calling:
+#    contentReceived(content) - with new data from the website
+#    fetchError(errmsg)       - if the website couldn't be reached
+# 
+#  Dale Lane (http://dalelane.co.uk/blog)
+
+
+# used when creating fetchers, so that a URL only ever has one
+fetchersLock = threading.Lock()
+fetchers = {}
+
+#
+# get the fetcher for a URL - creating one if necessary
+# 
+#  if an interval is given, it replaces the fetcher's current schedule
+# 
+def getWebFetcher(url, interval=None):
+    fetchersLock.acquire()
+    try:
+        if url not in fetchers:
+            fetchers[url] = CurrentCostWebFetcher(url)
+        fetcher = fetchers[url]
+    finally:
+        fetchersLock.release()
+    if interval != None:
+        fetcher.setInterval(interval)
+    return fetcher
+
+
+class CurrentCostWebFetcher():
+
+    # time to wait (seconds) between requests, if not set by setInterval
+    DEFAULT_INTERVAL = 60
+    # the wait after an error is doubled for each error in a row, up to 
+    #  ERROR_MAX_DELAY (or the normal interval if that is longer)
+    ERROR_MAX_DELAY = 900
+    # longest time (seconds) to wait for the website to respond
+    TIMEOUT = 30
+
+    # number of requests made, and what came of them
+    requests    = 0
+    notModified = 0
+    duplicates  = 0
+    changes     = 0
+    errors      = 0
+
+    def __init__(self, url):
+        self.url = url
+        self.interval = self.DEFAULT_INTERVAL
+        self.subscribers = []
+        # subscribers who haven't been given the last data downloaded yet
+        self.pending = []
+        # protects the subscribers, and wakes the fetcher's thread
+        self.lock = threading.Condition()
+        # only one request is made at a time
+        self.fetchLock = threading.Lock()
+        self.thread = None
+
+        # the last data downloaded, and what is needed to check whether the 
+        #  website has anything newer
+        self.content = None
+        self.digest = None
+        self.etag = None
+        self.lastModified = None
+
+        # when the next request is due, and the number of errors since the 
+        #  last successful request
+        self.lastPoll = None
+        self.nextPoll = 0
+        self.failures = 0
+
+        self.requests    = 0
+        self.notModified = 0
+        self.duplicates  = 0
+        self.changes     = 0
+        self.errors      = 0
+
+    #
+    # change the time (seconds) between requests
+    # 
+    def setInterval(self, interval):
+        self.lock.acquire()
+        try:
+            self.interval = interval
+            if self.lastPoll != None and self.failures == 0:
+                self.nextPoll = self.lastPoll + interval
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    #
+    # start passing data from the website to a subscriber - the fetcher's 
+    #  thread is started if it isn't already running
+    # 
+    def addSubscriber(self, subscriber):
+        self.lock.acquire()
+        try:
+            self.subscribers.append(subscriber)
+            if self.content != None:
+                self.pending.append(subscriber)
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, name="CurrentCostWebFetcher")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    #
+    # stop passing data to a subscriber - the fetcher's thread stops when 
+    #  there are no subscribers left, but the last data downloaded is kept
+    # 
+    #  this doesn't wait for the thread, as it may be waiting for the website
+    # 
+    def removeSubscriber(self, subscriber):
+        self.lock.acquire()
+        try:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            if subscriber in self.pending:
+                self.pending.remove(subscriber)
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    #
+    # get the latest data from the website - this only makes a request if 
+    #  one is due, otherwise the last data downloaded is returned
+    # 
+    #  returns None if nothing has been downloaded yet
+    # 
+    def getContent(self):
+        self.poll()
+        return self.content
+
+    def run(self):
+        global trc
+        trc.FunctionEntry("currentcostwebfetch :: run")
+        while True:
+            self.lock.acquire()
+            try:
+                while len(self.subscribers) > 0 and len(self.pending) == 0 and time.time() < self.nextPoll:
+                    self.lock.wait(self.nextPoll - time.time())
+                if len(self.subscribers) == 0:
+                    self.thread = None
+                    break
+                pending = self.pending
+                self.pending = []
+            finally:
+                self.lock.release()
+
+            if len(pending) > 0:
+                self.notify(pending, 'contentReceived', self.content)
+            self.poll()
+        trc.FunctionExit("currentcostwebfetch :: run")
+
+    #
+    # make a request if one is due, and tell subscribers what came of it
+    # 
+    def poll(self):
+        global trc
+        self.fetchLock.acquire()
+        try:
+            if time.time() < self.nextPoll:
+                return
+            try:
+                changed = self.fetch()
+                errmsg = None
+                self.failures = 0
+                delay = self.interval
+            except Exception, err:
+                changed = False
+                errmsg = str(err)
+                self.errors += 1
+                self.failures += 1
+                delay = min(self.interval * (2 ** self.failures), 
+                            max(self.ERROR_MAX_DELAY, self.interval))
+                trc.Error("failed to download %s : %s - retrying in %d seconds", self.url, errmsg, delay)
+            self.lastPoll = time.time()
+            self.nextPoll = self.lastPoll + delay
+        finally:
+            self.fetchLock.release()
+
+        if errmsg != None:
+            self.publish('fetchError', errmsg)
+        elif changed:
+            self.publish('contentReceived', self.content)
+
+    #
+    # request the URL, passing what we know about the last response so that 
+    #  the website can tell us if nothing has changed
+    # 
+    #  returns True if new data was downloaded. errors (including empty 
+    #   responses) are raised, and don't replace the last data downloaded
+    # 
+    def fetch(self):
+        global trc
+        request = urllib2.Request(self.url)
+        if self.etag != None:
+            request.add_header('If-None-Match', self.etag)
+        if self.lastModified != None:
+            request.add_header('If-Modified-Since', self.lastModified)
+
+        self.requests += 1
+        try:
+            response = urllib2.urlopen(request, timeout=self.TIMEOUT)
+        except urllib2.HTTPError, err:
+            if err.code == 304:
+                trc.Trace("%s not modified", self.url)
+                self.notModified += 1
+                return False
+            raise
+        try:
+            body = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        if len(body) == 0:
+            raise IOError('empty response from ' + self.url)
+
+        self.etag = headers.getheader('ETag')
+        self.lastModified = headers.getheader('Last-Modified')
+
+        # websites which don't support conditional requests will send the 
+        #  same data again until it is updated
+        digest = hashlib.md5(body).digest()
+        if digest == self.digest:
+            trc.Trace("%s unchanged", self.url)
+            self.duplicates += 1
+            return False
+
+        trc.Trace("downloaded %d bytes from %s", len(body), self.url)
+        self.digest = digest
+        self.content = body
+        self.changes += 1
+        return True
+
+    #
+    # call the named method of every subscriber that has it
+    # 
+    def publish(self, event, *args):
+        self.lock.acquire()
+        subscribers = self.subscribers[:]
+        self.lock.release()
+        self.notify(subscribers, event, *args)
+
+    def notify(self, subscribers, event, *args):
+        global trc
+        for subscriber in subscribers:
+            # skip subscribers removed while we were passing data to others
+            if subscriber not in self.subscribers:
+                continue
+            handler = getattr(subscriber, event, None)
+            if handler != None:
+                try:
+                    handler(*args)
+                except Exception, err:
+                    trc.Error("subscriber failed to handle %s from %s: %s", event, self.url, err)
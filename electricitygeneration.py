@@ -24,16 +24,71 @@
 
 import numpy as np
 import time
-from threading import Thread, Lock, Condition
-
-
-from gridsourcedata     import ElectricityGenerationDataSource
+import datetime
+import bisect
+import calendar
+import pytz
+
+from matplotlib.dates   import date2num
+from gridsourcedata     import ElectricityGenerationDataSource, INST_TIMEZONE
+from gridfueltypes      import FUEL_TYPES
 from tracer             import CurrentCostTracer
 
 # this class provides logging and diagnostics
 trc = CurrentCostTracer()
 
 
+# the sources that readings are divided between, in the order they are drawn
+SOURCES = FUEL_TYPES + [ 'UNKNOWN' ]
+
+# the energy mix used until generation data has been downloaded
+DEFAULT_ENERGY_MIX = { 'CCGT'     : 0.0000000000000000000000000001,
+                       'OCGT'     : 0.0000000000000000000000000001,
+                       'OIL'      : 0.0000000000000000000000000001,
+                       'COAL'     : 0.0000000000000000000000000001,
+                       'NUCLEAR'  : 0.0000000000000000000000000001,
+                       'WIND'     : 0.0000000000000000000000000001,
+                       'PS'       : 0.0000000000000000000000000001,
+                       'NPSHYD'   : 0.0000000000000000000000000001,
+                       'OTHER'    : 0.0000000000000000000000000001,
+                       'INTFR'    : 0.0000000000000000000000000001,
+                       'INTIRL'   : 0.0000000000000000000000000001,
+                       'UNKNOWN'  : 100 }
+
+#
+# the fraction of electricity from each source (in the order of SOURCES) for
+#  an energy mix of percentages
+# 
+def mixVector(energymix):
+    return np.array([ energymix[source] for source in SOURCES ]) / 100
+
+#
+# work out where each stream of a stacked graph is drawn
+# 
+#  streams are stacked alternately above and below zero - the first above, 
+#   the second below, the third above the first, and so on - and the whole 
+#   graph is then shifted up so that the lowest stream starts at zero
+# 
+#  streams is an array with a row for each stream. returns arrays of the 
+#   bottom and top of each stream, in the same shape
+# 
+def stackBounds(streams):
+    streams = np.asarray(streams, dtype=float)
+    bottoms = np.empty(streams.shape)
+    tops    = np.empty(streams.shape)
+
+    above = np.cumsum(streams[0::2], axis=0)
+    tops[0::2]    = above
+    bottoms[0::2] = above - streams[0::2]
+
+    below = -np.cumsum(streams[1::2], axis=0)
+    bottoms[1::2] = below
+    tops[1::2]    = below + streams[1::2]
+
+    baseline = np.minimum(bottoms.min(axis=0), 0)
+    return bottoms - baseline, tops - baseline
+
+
 #
 # Displays a graph showing live CurrentCost data divided by the way the 
 #   electricity was generated. 
@@ -44,47 +99,67 @@ class CurrentCostElectricityGeneration():
 
     livegraph = None
 
-    energyMix = { 'CCGT'     : 0.0000000000000000000000000001,
-                  'OCGT'     : 0.0000000000000000000000000001,
-                  'OIL'      : 0.0000000000000000000000000001,
-                  'COAL'     : 0.0000000000000000000000000001,
-                  'NUCLEAR'  : 0.0000000000000000000000000001,
-                  'WIND'     : 0.0000000000000000000000000001,
-                  'PS'       : 0.0000000000000000000000000001,
-                  'NPSHYD'   : 0.0000000000000000000000000001,
-                  'OTHER'    : 0.0000000000000000000000000001,
-                  'INTFR'    : 0.0000000000000000000000000001,
-                  'INTIRL'   : 0.0000000000000000000000000001,
-                  'UNKNOWN'  : 100 }
+    energyMix = DEFAULT_ENERGY_MIX
+
+    # the time (as given by the National Grid) of the figures in energyMix
+    energyMixTime = None
+
+    # every change to the energy mix, as (time received, mixVector) pairs - 
+    #  live readings are divided between sources using the mix at the time
+    #  of the reading when the graph is drawn, so a mix is only stored once
+    #  rather than for every reading
+    mixChanges = None
+
+    # stores each new energy mix in the database, if set - see 
+    #  currentcostgridstore
+    gridWriter = None
+
+    # the polygon drawn for each source - updated with new readings rather 
+    #  than drawn again
+    polygons = None
+
+    # x-axis values for the dates of readings already on the graph, and the
+    #  first and last of those dates, so that only new dates are converted
+    xvalues = None
+    xfirst  = None
+    xlast   = None
 
     emxClient = None
 
+    def __init__(self):
+        self.energyMix = DEFAULT_ENERGY_MIX
+        self.mixChanges = []
+        self.xvalues = np.zeros(0)
+
     def startBackgroundThread(self):
         if self.emxClient != None:
             self.stopBackgroundThread()
-        self.emxClient = GridGenerationUpdateThread(self)
+        self.emxClient = GridGenerationUpdater(self)
         self.emxClient.start()
 
     def stopBackgroundThread(self):
         global trc
         if self.emxClient != None:
             self.emxClient.stopUpdates()
-            self.energyMix = { 'CCGT'     : 0.0000000000000000000000000001,
-                               'OCGT'     : 0.0000000000000000000000000001,
-                               'OIL'      : 0.0000000000000000000000000001,
-                               'COAL'     : 0.0000000000000000000000000001,
-                               'NUCLEAR'  : 0.0000000000000000000000000001,
-                               'WIND'     : 0.0000000000000000000000000001,
-                               'PS'       : 0.0000000000000000000000000001,
-                               'NPSHYD'   : 0.0000000000000000000000000001,
-                               'OTHER'    : 0.0000000000000000000000000001,
-                               'INTFR'    : 0.0000000000000000000000000001,
-                               'INTIRL'   : 0.0000000000000000000000000001,
-                               'UNKNOWN'  : 100 }
-
-
-
-    def initialiseGraph(self, dates, data, targetPage, formatter):
+            self.setEnergyMix(None, DEFAULT_ENERGY_MIX)
+
+    #
+    # called with new generation data - readings from now on are divided 
+    #  between sources using this mix
+    # 
+    def setEnergyMix(self, mixtime, energymix):
+        self.energyMixTime = mixtime
+        self.energyMix = energymix
+        # a single append, so that readers on other threads never see a 
+        #  time without its mix
+        self.mixChanges.append((datetime.datetime.now(pytz.utc), mixVector(energymix)))
+
+
+    #
+    # draw a graph of live readings (kW) taken at the given dates, divided 
+    #  between the sources of electricity at the time of each reading
+    # 
+    def initialiseGraph(self, dates, readings, targetPage, formatter):
         global trc
         trc.FunctionEntry("electricitygeneration :: initialiseGraph")
 
@@ -92,142 +167,166 @@ class CurrentCostElectricityGeneration():
 
         # prepare graph for drawing
         self.livegraph = targetPage
+        self.polygons = None
         self.livegraph.set_ylabel('kW')
         self.livegraph.grid(True)
         self.livegraph.set_title('Where did your electricity come from?')
         self.livegraph.set_autoscale_on = False
         colormap = [ '#0000FF', '#00FF00', '#FF0000', '#00FFFF', '#2277AA', '#9911BB', '#FFFF00', '#FF00FF', '#550011', '#110066', '#CCCCCC', '#F0F0F0' ]
-        self.stacked_graph(dates, data, colormap)
+        self.stacked_graph(dates, self.splitBySource(dates, readings), colormap)
         for label in self.livegraph.get_xticklabels():
             label.set_rotation(90)
         self.livegraph.xaxis.set_major_formatter(formatter)
         self.livegraph.xaxis.set_minor_formatter(formatter)
         self.livegraph.legend(loc='upper left', fancybox=True, shadow=True, ncol=2)
         trc.FunctionExit("electricitygeneration :: initialiseGraph")
+
+    #
+    # redraw the graph with readings collected since it was prepared by
+    #  initialiseGraph
+    # 
+    def updateGraph(self, dates, readings):
+        global trc
+        trc.FunctionEntry("electricitygeneration :: updateGraph")
+        if self.livegraph != None and self.polygons != None:
+            self.stacked_graph(dates, self.splitBySource(dates, readings), None)
+            self.livegraph.relim()
+            self.livegraph.autoscale_view()
+            self.livegraph.figure.canvas.draw()
+        trc.FunctionExit("electricitygeneration :: updateGraph")
+
+    #
+    # stop updating the graph - e.g. because it has been closed
+    # 
+    def closeGraph(self):
+        self.livegraph = None
+        self.polygons = None
     
 
-    def splitBySource(self, reading):        
-        split = { 'CCGT'     : (self.energyMix['CCGT'] / 100) * reading, 
-                  'OCGT'     : (self.energyMix['OCGT'] / 100) * reading, 
-                  'OIL'      : (self.energyMix['OIL'] / 100) * reading, 
-                  'COAL'     : (self.energyMix['COAL'] / 100) * reading, 
-                  'NUCLEAR'  : (self.energyMix['NUCLEAR'] / 100) * reading, 
-                  'WIND'     : (self.energyMix['WIND'] / 100) * reading, 
-                  'PS'       : (self.energyMix['PS'] / 100) * reading, 
-                  'NPSHYD'   : (self.energyMix['NPSHYD'] / 100) * reading, 
-                  'OTHER'    : (self.energyMix['OTHER'] / 100) * reading, 
-                  'INTFR'    : (self.energyMix['INTFR'] / 100) * reading, 
-                  'INTIRL'   : (self.energyMix['INTIRL'] / 100) * reading, 
-                  'UNKNOWN'  : (self.energyMix['UNKNOWN'] / 100) * reading }
-        return split
-
-
-    def stacked_graph(self, timeset, graphdata, colormap):
+    #
+    # divide live readings between sources of electricity 
+    # 
+    #  each reading uses the last mix received before it was taken (or the
+    #   default mix if it was taken before any were received). the dates 
+    #   must be in order. returns an array with a row for each source (in 
+    #   the order of SOURCES) and a column for each reading
+    # 
+    def splitBySource(self, dates, readings):
+        if len(readings) == 0:
+            return np.zeros((len(SOURCES), 0))
+
+        changes = self.mixChanges[:]
+        mixes = np.vstack([ mixVector(DEFAULT_ENERGY_MIX) ] + [ mix for changetime, mix in changes ])
+
+        # each mix applies from the first reading taken after it was received
+        #  until the next one - there are only a few changes, so it is 
+        #  quicker to find each in the dates than to compare every date 
+        mixindexes = np.zeros(len(readings), dtype=int)
+        for i in range(len(changes)):
+            mixindexes[bisect.bisect_left(dates, changes[i][0]):] = i + 1
+        return mixes[mixindexes].T * np.asarray(readings, dtype=float)
+
+
+    #
+    # streams is an array with a row of values for each source (see 
+    #  splitBySource)
+    # 
+    #  the polygons for each source are drawn the first time, and moved to 
+    #   fit the new data after that
+    # 
+    def stacked_graph(self, timeset, streams, colormap):
         global trc
         trc.FunctionEntry("stacked_graph")
 
-        CCGT = []
-        OCGT = []
-        OIL  = []
-        COAL = []
-        NUCLEAR = [] 
-        WIND = []
-        PS = [] 
-        NPSHYD = [] 
-        OTHER = [] 
-        INTFR = [] 
-        INTIRL = []
-        UNKNOWN = []
-
-        for ccread in graphdata:
-            CCGT.append(ccread['CCGT'])
-            OCGT.append(ccread['OCGT'])
-            OIL.append(ccread['OIL'])
-            COAL.append(ccread['COAL'])
-            NUCLEAR.append(ccread['NUCLEAR'])
-            WIND.append(ccread['WIND'])
-            PS.append(ccread['PS'])
-            NPSHYD.append(ccread['NPSHYD']) 
-            OTHER.append(ccread['OTHER']) 
-            INTFR.append(ccread['INTFR']) 
-            INTIRL.append(ccread['INTIRL'])
-            UNKNOWN.append(ccread['UNKNOWN'])
-        
-        streams = np.asarray([ CCGT,   OCGT,   OIL,   COAL,   NUCLEAR,   WIND,   PS,   NPSHYD,   OTHER,   INTFR,   INTIRL,   UNKNOWN ])
-        labels  =            [ "CCGT", "OCGT", "OIL", "COAL", "NUCLEAR", "WIND", "PS", "NPSHYD", "OTHER", "INTFR", "INTIRL", "UNKNOWN" ]
-
-        numentries = len(timeset)
-        for i in range(numentries - 1, -1, -1):
-            timeset.append(timeset[i])
-
-        zeroline         = np.zeros(numentries)
-        firststream      = streams[0]
-        secondstream     = -streams[1]
-        remainingstreams = streams[2:]
-
-        lowerbounds = np.vstack( (zeroline, firststream)  )
-        nextbounds  = np.vstack( (secondstream, zeroline) )
-
-        stream_bounds = [ lowerbounds, nextbounds ]
-
-        side = -1
-        for stream in remainingstreams:
-            side *= -1
-            if side == 1:
-                prevstream = stream_bounds[-2][1]
-                nextstream = prevstream + stream
-                nextbounds = np.vstack( (prevstream, nextstream) )
-            else:
-                prevstream = stream_bounds[-2][0]
-                nextstream = prevstream - stream
-                nextbounds = np.vstack( (nextstream, prevstream) )
-            stream_bounds.append(nextbounds)
-
-        stream_bounds = np.array(stream_bounds)
-        baseline      = np.min(stream_bounds[:,0,:], axis=0)
-
-        for i in range(len(stream_bounds)):
-            bound = stream_bounds[i]
-            xvalues = timeset
-            yvalues = np.hstack(( bound[0] - baseline, (bound[1] - baseline)[::-1] ))
-            self.livegraph.fill(xvalues, yvalues, 
-                                label     = labels[i],
-                                facecolor = colormap[i], 
-                                edgecolor = 'black',
-                                linewidth = 0.1)
+        labels = SOURCES
+
+        # each polygon goes along the bottom of the stream, and back along 
+        #  the top of it
+        xvalues = self.dateValues(timeset)
+        xvalues = np.hstack((xvalues, xvalues[::-1]))
+        bottoms, tops = stackBounds(streams)
+
+        if self.polygons == None:
+            self.polygons = []
+            for i in range(len(streams)):
+                yvalues = np.hstack((bottoms[i], tops[i][::-1]))
+                self.polygons.extend(self.livegraph.fill(xvalues, yvalues, 
+                                                         label     = labels[i],
+                                                         facecolor = colormap[i], 
+                                                         edgecolor = 'black',
+                                                         linewidth = 0.1))
+            self.livegraph.xaxis_date()
+        else:
+            for i in range(len(streams)):
+                yvalues = np.hstack((bottoms[i], tops[i][::-1]))
+                self.polygons[i].set_xy(np.column_stack((xvalues, yvalues)))
 
         trc.FunctionExit("stacked_graph")
 
+    #
+    # x-axis values for a list of dates 
+    # 
+    #  readings are added to the end of the list, so the values for dates 
+    #   converted last time are reused
+    # 
+    def dateValues(self, dates):
+        numknown = len(self.xvalues)
+        if numknown == 0 or numknown > len(dates) or dates[0] != self.xfirst or dates[numknown - 1] != self.xlast:
+            # not the dates we converted last time
+            self.xvalues = np.zeros(0)
+            numknown = 0
+        if numknown < len(dates):
+            self.xvalues = np.hstack((self.xvalues, date2num(dates[numknown:])))
+            self.xfirst = dates[0]
+            self.xlast  = dates[-1]
+        return self.xvalues
 
 
-# a background thread
-class GridGenerationUpdateThread(Thread):
+
+#
+# the time of a generation mix as a local time, like the history data it is 
+#  compared with - or the current time if the XML didn't give one
+# 
+def localMixTime(mixtime):
+    if mixtime == None:
+        return datetime.datetime.now()
+    utctime = pytz.timezone(INST_TIMEZONE).localize(mixtime).astimezone(pytz.utc)
+    return datetime.datetime.fromtimestamp(calendar.timegm(utctime.timetuple()))
+
+
+# receives generation data from the shared web fetcher's thread (see 
+#  currentcostwebfetch.py) whenever it changes
+class GridGenerationUpdater():
     disconnect = False
     elecgen    = None
-    sleeper    = None
+    # time (as given by the National Grid) of the last mix stored
+    storedMixTime = None
     def __init__(self, parent):
-        Thread.__init__(self)
         self.disconnect = False
         self.elecgen = parent
         self.ngdata  = ElectricityGenerationDataSource()
-        self.sleeper = Condition()
+        self.storedMixTime = None
+    def start(self):
+        self.ngdata.startUpdates(self)
     def stopUpdates(self):
         self.disconnect = True
-        self.sleeper.acquire()
-        self.sleeper.notify()
-        self.sleeper.release()
-    def run(self):
-        while self.disconnect == False:
-            emxml = self.ngdata.DownloadRealtimeXML()
-            try: 
-                self.elecgen.energyMix = self.ngdata.ParseRealtimeXML(emxml)
-            except Exception, exc:
-                trc.Error("failed to parse realtime xml")
-                trc.Error(str(emxml))
-                trc.Error(repr(exc))
-                trc.Error(repr(exc.message))
-            # go to sleep for a while - the realtime data doesn't update very
-            #  often, so no need to download it constantly!
-            self.sleeper.acquire()
-            self.sleeper.wait(180)
-            self.sleeper.release()
+        self.ngdata.stopUpdates(self)
+    def contentReceived(self, emxml):
+        if self.disconnect:
+            return
+        try: 
+            mixtime, energymix = self.ngdata.ParseGenerationMix(emxml)
+            self.elecgen.setEnergyMix(mixtime, energymix)
+            # the page can change without the figures being updated, so a 
+            #  mix is only stored once for each time it is given for
+            if self.elecgen.gridWriter != None and (mixtime == None or mixtime != self.storedMixTime):
+                self.elecgen.gridWriter.storeMix(localMixTime(mixtime), energymix)
+                self.storedMixTime = mixtime
+        except Exception, exc:
+            # the last energy mix is kept until the next download
+            trc.Error("failed to parse realtime xml")
+            trc.Error(str(emxml))
+            trc.Error(repr(exc))
+            trc.Error(repr(exc.message))
+    def fetchError(self, errmsg):
+        trc.Trace("unable to download realtime xml: " + errmsg)
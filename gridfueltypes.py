@@ -0,0 +1,65 @@
+#
+# CurrentCost GUI
+# 
+#    Copyright (C) 2008  Dale Lane
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  The author of this code can be contacted at Dale.Lane@gmail.com
+#    Any contact about this application is warmly welcomed.
+#
+
+#
+#  The fuel types that the National Grid divides electricity generation 
+#   into, and how much carbon is emitted generating electricity from each.
+# 
+#  Kept apart from gridsourcedata, which downloads the generation figures, 
+#   so that the database code can use them without importing the modules 
+#   used to download data.
+# 
+
+
+# the fuel types that electricity generation is divided into
+FUEL_TYPES = [ 'CCGT', 'OCGT', 'OIL', 'COAL', 'NUCLEAR', 'WIND', 'PS', 'NPSHYD', 'OTHER', 'INTFR', 'INTIRL' ]
+
+# approximate carbon intensity (g CO2 per kWh) of electricity from each fuel 
+#  type - pumped storage (PS) is counted as zero, as the electricity used to 
+#  pump it is counted when it is generated
+CARBON_INTENSITY = { 'CCGT'    : 360,
+                     'OCGT'    : 480,
+                     'OIL'     : 610,
+                     'COAL'    : 910,
+                     'NUCLEAR' : 0,
+                     'WIND'    : 0,
+                     'PS'      : 0,
+                     'NPSHYD'  : 0,
+                     'OTHER'   : 300,
+                     'INTFR'   : 90,
+                     'INTIRL'  : 450 }
+
+#
+# the carbon intensity (g CO2 per kWh) of grid electricity generated with 
+#  an energy mix of percentages - fuel types we don't know about are left 
+#  out, rather than guessed at. returns None if the mix has no figures for
+#  known fuel types (e.g. the default mix used before any are downloaded)
+# 
+def carbonIntensity(energymix):
+    total = 0.0
+    intensity = 0.0
+    for fueltype in FUEL_TYPES:
+        total += energymix[fueltype]
+        intensity += energymix[fueltype] * CARBON_INTENSITY[fueltype]
+    if total < 1.0:
+        return None
+    return intensity / total
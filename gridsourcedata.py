@@ -19,16 +19,37 @@
 #  The author of this code can be contacted at Dale.Lane@gmail.com
 #    Any contact about this application is warmly welcomed.
 #
-import urllib
-import urllib2
 import time
+import datetime
 import re
 
-from tracer             import CurrentCostTracer
+from currentcostwebfetch import getWebFetcher
+from gridfueltypes       import FUEL_TYPES
+from tracer              import CurrentCostTracer
 
 # this class provides logging and diagnostics
 trc = CurrentCostTracer()
 
+
+# used in place of a zero (or missing) percentage, so that every fuel type 
+#  has a (tiny) area on the generation graph
+MIN_PERCENTAGE = 0.00000000000000000000000001
+
+# the XML contains the latest figures in an INST element, followed by 
+#  half-hourly and daily figures which we don't use. e.g.
+#   <INST AT="2011-06-01 12:30:00" TOTAL="35000">
+#     <FUEL TYPE="CCGT" IC="N" VAL="13000" PCT="37.1"></FUEL> ...
+#   </INST>
+#  a response which is cut short before </INST> isn't matched, so that we 
+#   don't use an incomplete mix
+INST_RE = re.compile(r'<INST\b([^>]*)>(.*?)</INST>', re.DOTALL)
+FUEL_RE = re.compile(r'<FUEL\b[^>]*?\bTYPE="([^"]*)"[^>]*?\bPCT="([^"]*)"')
+AT_RE   = re.compile(r'\bAT="([^"]*)"')
+
+INST_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# the times in the XML are UK clock times
+INST_TIMEZONE = 'Europe/London'
+
 #
 #  
 # 
@@ -36,38 +57,91 @@ trc = CurrentCostTracer()
 # 
 class ElectricityGenerationDataSource():
 
+    REALTIME_URL = 'http://www.bmreports.com/bsp/additional/soapfunctions.php?element=generationbyfueltypetable'
+
+    # time (seconds) between requests for the generation data - it doesn't 
+    #  update very often, so no need to download it constantly!
+    POLL_INTERVAL = 180
+
+    fetcher = None
+
+    def __init__(self, url=None, interval=None):
+        if url == None:
+            url = self.REALTIME_URL
+        if interval == None:
+            interval = self.POLL_INTERVAL
+        self.fetcher = getWebFetcher(url, interval)
+
     #
-    # get the XML 
+    # get the XML - downloaded by a shared fetcher, so this only makes a 
+    #  request if the last copy is older than the poll interval
     # 
     def DownloadRealtimeXML(self):
-        try:
-            post_req = urllib2.Request('http://www.bmreports.com/bsp/additional/soapfunctions.php?element=generationbyfueltypetable')
-            post_resp = urllib2.urlopen(post_req)
-            post_resp_body = post_resp.read()
-            return post_resp_body
-        except Exception, exc:
+        post_resp_body = self.fetcher.getContent()
+        if post_resp_body == None:
             return 'Unable to download XML'
+        return post_resp_body
 
-    def generateRE(self, energytype):
-        return "<INST.*?<FUEL TYPE=\"" + energytype + "\".*?PCT=\"(.*?)\"></FUEL>.*?</INST>"
     #
+    # pass the XML to a subscriber whenever it changes - see 
+    #  currentcostwebfetch for the methods called
     # 
+    def startUpdates(self, subscriber):
+        self.fetcher.addSubscriber(subscriber)
+
+    def stopUpdates(self, subscriber):
+        self.fetcher.removeSubscriber(subscriber)
+
+    #
+    # get the percentage of electricity generated from each fuel type 
     # 
     def ParseRealtimeXML(self, xml):
+        return self.ParseGenerationMix(xml)[1]
+
+    #
+    # get the time of the latest generation figures, and the percentage of 
+    #  electricity generated from each fuel type, in a single pass through 
+    #  the INST element of the XML
+    # 
+    #  fuel types missing from the XML are given MIN_PERCENTAGE, and any we 
+    #   don't know about are counted as 'UNKNOWN'. the time is None if it 
+    #   is missing or can't be parsed
+    # 
+    #  raises ValueError if the XML doesn't contain generation figures
+    # 
+    def ParseGenerationMix(self, xml):
         global trc
-        trc.FunctionEntry("ParseRealtimeXML")
-        #trc.Trace(str(xml))
+        trc.FunctionEntry("ParseGenerationMix")
+
+        inst = INST_RE.search(xml)
+        if inst == None:
+            trc.FunctionExit("ParseGenerationMix")
+            raise ValueError('no generation data found in XML')
+
+        timestamp = None
+        at = AT_RE.search(inst.group(1))
+        if at != None:
+            try:
+                timestamp = datetime.datetime.strptime(at.group(1), INST_TIME_FORMAT)
+            except ValueError:
+                trc.Trace("unable to parse generation time : %s", at.group(1))
+
         energygendata = {}
-        energygendata['UNKNOWN'] = 0.0000000000000000000000000001
-        ccreadingskeys = [ 'CCGT', 'OCGT', 'OIL', 'COAL', 'NUCLEAR', 'WIND', 'PS', 'NPSHYD', 'OTHER', 'INTFR', 'INTIRL' ]
-        for key in ccreadingskeys:
-            regexp = self.generateRE(key)
-            #trc.Trace(regexp)
-            m = re.search(regexp, xml)
-            energygendata[key] = float(m.group(1))
-            trc.Trace(key + "   >>> " + str(m.group(1)) + "  ===> " + str(energygendata[key]))
-            if energygendata[key] == 0.0:
-                energygendata[key] = 0.00000000000000000000000001
-        #trc.Trace(str(energygendata))
-        trc.FunctionExit("ParseRealtimeXML")
-        return energygendata
+        unknown = 0.0
+        for fuel in FUEL_RE.finditer(inst.group(2)):
+            fueltype, percentage = fuel.group(1), float(fuel.group(2))
+            if fueltype in FUEL_TYPES:
+                energygendata[fueltype] = percentage
+            else:
+                unknown += percentage
+            trc.Trace("%s   >>> %s", fueltype, fuel.group(2))
+
+        for fueltype in FUEL_TYPES:
+            if energygendata.get(fueltype, 0.0) == 0.0:
+                energygendata[fueltype] = MIN_PERCENTAGE
+        if unknown == 0.0:
+            unknown = 0.0000000000000000000000000001
+        energygendata['UNKNOWN'] = unknown
+
+        trc.FunctionExit("ParseGenerationMix")
+        return timestamp, energygendata
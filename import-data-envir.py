@@ -1,69 +1,506 @@
+import os
 import sys
-import serial
-from time import sleep
+import time
+import json
+import signal
+import Queue
+import getopt
+import datetime
+import threading
 
-# parses the XML
-from currentcostparser    import CurrentCostDataParser
-from currentcostdb import CurrentCostDB 
-from tracer import CurrentCostTracer
+from currentcostserialconn   import CurrentCostConnection
+from currentcostserialreader import parseLiveXML, parseLiveChannels
+from currentcostmqttpublish  import CurrentCostMQTTRepublisher
+from currentcostparser       import CurrentCostDataParser
+from currentcostdb           import CurrentCostDB
+from tracer                  import CurrentCostTracer
 
 
-def run(s, db):
-    trc = CurrentCostTracer()
-    trc.EnableTrace(True)
-    trc.InitialiseTraceFile()
+#
+# Logs data from a CurrentCost meter to a database, without a GUI
+#
+#  Intended to be left running as a daemon: live readings and history
+#   updates are stored as they are received, the connection to the meter is
+#   re-established if it is lost, and it stops cleanly on SIGTERM.
+#
+#  Live readings are found in the XML without parsing it (as is done for the
+#   live graph in the GUI). Data is written to the database in batches: live
+#   readings are committed every few seconds, and each history update in a 
+#   single transaction, rather than committing after every row.
+#
+#  sqlite only allows one write transaction on a db file at a time, so the 
+#   data from every meter is given to a single writer thread, which stores 
+#   it using one connection (see CurrentCostIngestionWriter).
+#
+#  Counters describing throughput (lines, readings and updates received) and
+#   lag (how long data waited before being committed) are printed
+#   periodically, and can also be written to a JSON file for monitoring.
+#
+#  Several meters can be logged at once, each read by its own thread. When 
+#   more than one meter is logged, the data from each is tagged with a meter
+#   id in the database.
+#
+#  The data can also be republished to an MQTT broker (see 
+#   currentcostmqttpublish.py) so that copies of the GUI on other machines
+#   can connect to it via MQTT. When more than one meter is logged, each 
+#   meter's data is published under <topic>/<meterid>.
+#
+
+
+# class for logging diagnostics
+trc = CurrentCostTracer()
+
+
+# types of data given to the writer
+DATA_LIVE    = 'live'
+DATA_HISTORY = 'history'
+
+#
+# writes the data received by every daemon to the database
+#
+#  if each daemon held a transaction open on its own connection while it
+#   waited to commit, the others would be locked out of the db file until 
+#   it did. Instead daemons give their data to this thread, which stores it
+#   in the order it was received and commits everything it has been given
+#   at least every commitInterval seconds.
+#
+#  The writer updates the commit counters of the daemons whose data it 
+#   commits.
+#
+class CurrentCostIngestionWriter(threading.Thread):
+
+    # longest time (seconds) that data is held before it is committed
+    commitInterval = 10
+
+    def __init__(self, dbfile):
+        threading.Thread.__init__(self, name='CurrentCostIngestionWriter')
+        self.setDaemon(True)
+        self.dbfile = dbfile
+        self.pending = Queue.Queue(0)
+        # daemons with data that has been stored but not committed
+        self.uncommitted = []
+        # time the oldest uncommitted data was received, or None if
+        #  everything received has been committed
+        self.uncommittedSince = None
 
-    myparser = CurrentCostDataParser()
-    while True:
+    #
+    # request that the thread store data from a daemon - these return 
+    #  straight away, and can be called on any thread
+    #
+    #  received is the time.time() that the daemon received the data
+    #
+    def storeLiveData(self, daemon, received, timestamp, reading):
+        self.pending.put((DATA_LIVE, daemon, received, (timestamp, reading)))
+    def storeHistory(self, daemon, received, currentcoststruct):
+        self.pending.put((DATA_HISTORY, daemon, received, currentcoststruct))
+
+    #
+    # stop the thread, once it has written everything it has been given
+    #
+    def shutdown(self):
+        self.pending.put(None)
+        if self.isAlive():
+            self.join()
+
+    def run(self):
+        global trc
+        trc.FunctionEntry("writer run")
+
+        db = CurrentCostDB()
+        db.InitialiseDB(self.dbfile)
+        parser = CurrentCostDataParser()
+        db.StartBatch()
+        while True:
+            try:
+                if self.uncommittedSince == None:
+                    item = self.pending.get()
+                else:
+                    timeout = self.uncommittedSince + self.commitInterval - time.time()
+                    item = self.pending.get(True, max(timeout, 0))
+            except Queue.Empty:
+                self.commit(db, time.time())
+                continue
+            if item == None:
+                break
+
+            self.store(db, parser, item)
+            now = time.time()
+            if self.uncommittedSince != None:
+                # each history update is already a large batch of rows
+                #  so there is nothing to gain from waiting to commit it
+                if item[0] == DATA_HISTORY or now - self.uncommittedSince >= self.commitInterval:
+                    self.commit(db, now)
+
+        self.commit(db, time.time())
+        db.CloseDB()
+        trc.FunctionExit("writer run")
+
+    def store(self, db, parser, item):
+        global trc
+        datatype, daemon, received, data = item
+        db.meterid = daemon.meterid
         try:
-            line = s.readline()
-        except Exception, why:
-            print why
-            sleep(1)
-        else:
+            if datatype == DATA_LIVE:
+                db.StoreLiveData(data[0], data[1])
+            else:
+                parser.storeTimedCurrentCostData(db, data)
+        except Exception, err:
+            trc.Error("unable to store data from %s : %s", daemon.port, err)
+            daemon.storeErrors += 1
+            return
+        if daemon.uncommittedSince == None:
+            daemon.uncommittedSince = received
+            self.uncommitted.append(daemon)
+        if self.uncommittedSince == None:
+            self.uncommittedSince = received
+
+    def commit(self, db, now):
+        global trc
+        if self.uncommittedSince == None:
+            return
+        try:
+            db.CommitBatch()
+            for daemon in self.uncommitted:
+                daemon.commits += 1
+                daemon.lastCommitLag = now - daemon.uncommittedSince
+                daemon.maxCommitLag = max(daemon.maxCommitLag, daemon.lastCommitLag)
+        except Exception, err:
+            # the data is lost, but we keep going so that later data is stored
+            trc.Error("unable to commit data : %s", err)
+            db.connection.rollback()
+            for daemon in self.uncommitted:
+                daemon.storeErrors += 1
+        for daemon in self.uncommitted:
+            daemon.uncommittedSince = None
+        self.uncommitted = []
+        self.uncommittedSince = None
+        db.StartBatch()
+
+
+class CurrentCostIngestionDaemon():
+
+    # default for how often (seconds) to report counters
+    statsInterval = 300
+
+    # time to wait (seconds) before trying to reconnect to the meter - doubled
+    #  after each failed attempt up to RECONNECT_MAX_DELAY
+    RECONNECT_DELAY     = 1
+    RECONNECT_MAX_DELAY = 60
+
+    # data is stored by writer, a CurrentCostIngestionWriter which may be 
+    #  shared with other daemons
+    # republisher is an optional CurrentCostMQTTRepublisher
+    def __init__(self, port, writer, meterid=None, republisher=None):
+        self.port = port
+        self.writer = writer
+        self.meterid = meterid
+        self.republisher = republisher
+        self.connection = CurrentCostConnection(meterid)
+        self.parser = CurrentCostDataParser()
+        self.stopped = False
+        self.reconnectDelay = self.RECONNECT_DELAY
+        self.everConnected = False
+
+        self.started = time.time()
+        # counters
+        self.lines = 0
+        self.livereadings = 0
+        self.historyupdates = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.lastReading = None
+        # counters updated by the writer
+        self.storeErrors = 0
+        self.commits = 0
+        self.lastCommitLag = 0.0
+        self.maxCommitLag = 0.0
+        # time the oldest uncommitted data was received, or None if
+        #  everything received has been committed
+        self.uncommittedSince = None
+        # counters at the time of the last report - used to calculate rates
+        self.lastStatsTime = self.started
+        self.lastStatsLines = 0
+
+    #
+    # stop the daemon - used as a signal handler
+    #
+    def stop(self, signum=None, frame=None):
+        self.stopped = True
+
+    def run(self):
+        global trc
+        trc.FunctionEntry("run")
+
+        if self.republisher != None:
+            self.republisher.start()
+        try:
+            self.ingest()
+        finally:
+            if self.republisher != None:
+                self.republisher.stop()
+        trc.FunctionExit("run")
+
+    def ingest(self):
+        while not self.stopped:
+            if not self.connection.isConnected():
+                if not self.reconnect():
+                    continue
+            try:
+                line = self.connection.readUpdate()
+            except Exception, err:
+                # readUpdate will have disconnected - we try to reconnect
+                #  next time round the loop
+                self.errors += 1
+                print "error reading from", self.port, ":", err
+                sys.stdout.flush()
+                continue
+
             if line:
-                line = line.strip()
-                currentcoststruct = myparser.parseCurrentCostXML(line)
-                if currentcoststruct:
-                    print currentcoststruct
-                    if currentcoststruct["msg"].has_key("ch1"):
-                        w1 = int(currentcoststruct["msg"]["ch1"]["watts"])
-                        w2 = int(currentcoststruct["msg"]["ch2"]["watts"])
-                        w3 = int(currentcoststruct["msg"]["ch3"]["watts"])
-                        t = (w1**2 + w2**2 + w3**2 ) **0.5
-                        print "watts are :", t
-                    if currentcoststruct["msg"].has_key("hist"):
-                        print "storing history data"
-                        myparser.storeTimedCurrentCostData(db)
-    
+                self.processLine(line, time.time())
+
+        self.connection.disconnect()
+
+    #
+    # store the data in a line of XML received from the meter
+    #
+    def processLine(self, line, now):
+        self.lines += 1
+        try:
+            reading = parseLiveXML(line)
+            if reading >= 0:
+                self.writer.storeLiveData(self, now, datetime.datetime.now(), reading)
+                self.livereadings += 1
+                self.lastReading = reading
+                if self.republisher != None:
+                    self.republisher.liveReadingReceived(reading)
+                    channels = parseLiveChannels(line)
+                    if channels != None:
+                        self.republisher.liveChannelsReceived(channels[0], channels[1])
+            elif line.find('<hist>') != -1:
+                currentcoststruct = self.parser.parseCurrentCostXML(line)
+                if currentcoststruct != None:
+                    self.writer.storeHistory(self, now, currentcoststruct)
+                    if self.republisher != None and 'hist' in currentcoststruct['msg']:
+                        self.republisher.historyReceived(currentcoststruct)
+                    self.historyupdates += 1
+                else:
+                    self.errors += 1
+        except Exception, err:
+            # partial or garbled lines are not unusual
+            trc.Trace("unable to process line from meter: %s : %s", err, line)
+            self.errors += 1
+
+    #
+    # connect to the meter, waiting before trying again if it fails
+    #
+    #  returns True if a connection was made
+    #
+    def reconnect(self):
+        try:
+            # the baud rate that worked last time is tried first
+            self.connection.connect(self.port, self.connection.baudrate)
+            if self.everConnected:
+                self.reconnects += 1
+            self.everConnected = True
+            self.reconnectDelay = self.RECONNECT_DELAY
+            return True
+        except Exception, err:
+            self.errors += 1
+            print "unable to connect to", self.port, ":", err, "- retrying in", self.reconnectDelay, "seconds"
+            sys.stdout.flush()
+            self.wait(self.reconnectDelay)
+            self.reconnectDelay = min(self.reconnectDelay * 2, self.RECONNECT_MAX_DELAY)
+            return False
+
+    # sleep, waking up early if the daemon is stopped
+    def wait(self, seconds):
+        end = time.time() + seconds
+        while not self.stopped and time.time() < end:
+            time.sleep(min(0.5, end - time.time()))
+
+    #
+    # counters since the daemon started - the line rate is calculated since 
+    #  the last time this was called
+    #
+    def getStats(self, now):
+        elapsed = now - self.lastStatsTime
+        if elapsed > 0:
+            linerate = (self.lines - self.lastStatsLines) / elapsed
+        else:
+            linerate = 0.0
+        self.lastStatsTime = now
+        self.lastStatsLines = self.lines
+        stats = { 'uptime'         : round(now - self.started, 1),
+                  'lines'          : self.lines,
+                  'linespersec'    : round(linerate, 3),
+                  'livereadings'   : self.livereadings,
+                  'lastreading'    : self.lastReading,
+                  'historyupdates' : self.historyupdates,
+                  'errors'         : self.errors + self.storeErrors,
+                  'reconnects'     : self.reconnects,
+                  'commits'        : self.commits,
+                  'lastcommitlag'  : round(self.lastCommitLag, 3),
+                  'maxcommitlag'   : round(self.maxCommitLag, 3) }
+        if self.republisher != None:
+            stats['mqttpublished'] = self.republisher.published
+            stats['mqttconnected'] = self.republisher.session.isConnected()
+        return stats
+
+
+#
+# runs a daemon for each meter in its own thread, and reports their counters
+#
+#  signals are only delivered to the main thread, so it waits here for the 
+#   daemons to finish rather than joining them
+#
+#  the writer is stopped once the daemons have finished, after it has 
+#   committed everything they gave it
+#
+def runDaemons(daemons, writer, statsInterval, statsFile):
+    writer.start()
+    threads = []
+    for daemon in daemons:
+        thread = threading.Thread(target=daemon.run, name=daemon.port)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    lastStatsTime = time.time()
+    while len([ thread for thread in threads if thread.isAlive() ]) > 0:
+        time.sleep(0.5)
+        now = time.time()
+        if now - lastStatsTime >= statsInterval:
+            reportStats(daemons, now, statsFile)
+            lastStatsTime = now
+    writer.shutdown()
+    reportStats(daemons, time.time(), statsFile)
+
+def stopDaemons(daemons):
+    for daemon in daemons:
+        daemon.stop()
+
+def reportStats(daemons, now, statsFile):
+    allstats = {}
+    for daemon in daemons:
+        stats = daemon.getStats(now)
+        line = " ".join([ key + "=" + str(stats[key]) for key in sorted(stats.keys()) ])
+        if daemon.meterid != None:
+            line = "meter=" + daemon.meterid + " " + line
+        print line
+        allstats[daemon.meterid] = stats
+    sys.stdout.flush()
+    if statsFile != None:
+        # a single meter's counters are written as they always have been - 
+        #  counters for several meters are keyed by meter id
+        if len(daemons) == 1:
+            allstats = allstats[daemons[0].meterid]
+        # write to a temporary file and rename it, so that anything
+        #  reading the file never sees it half-written
+        tmpfile = statsFile + ".tmp"
+        f = open(tmpfile, 'w')
+        json.dump(allstats, f)
+        f.close()
+        os.rename(tmpfile, statsFile)
+
+
 def usage():
     print "usage: "
-    print sys.argv[0], " device [dbfile]"
-    print "device is for example /dev/ttyUSB0 on linux and com1 on windows" 
+    print sys.argv[0], " [--commit-interval=SECS] [--stats-interval=SECS] [--stats-file=FILE] [--debug]"
+    print "       [--mqtt=HOST[:PORT]] [--mqtt-topic=TOPIC] [--mqtt-qos=QOS] device[,device...] [dbfile]"
+    print "device is for example /dev/ttyUSB0 on linux and com1 on windows"
+    print "to log several meters at once, give a comma-separated list of devices - each can"
+    print " be given a meter id to tag its data with in the db, as device=meterid (the"
+    print " default meter id is the device)"
     print "dbfile is the path to the db file you want to use, the default is to use the file last used by currentcostgui"
+    print "counters are printed every stats-interval seconds (default 300), and written to stats-file if provided"
+    print "data is committed to the db at least every commit-interval seconds (default 10)"
+    print "with --mqtt, data is also published to the MQTT broker at HOST, under mqtt-topic"
+    print " (default CurrentCost) - live data to TOPIC/live and history data to TOPIC/history"
     sys.exit(1)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'h',
+                                      ['commit-interval=', 'stats-interval=', 'stats-file=', 'debug', 'help',
+                                       'mqtt=', 'mqtt-topic=', 'mqtt-qos='])
+    except getopt.GetoptError, err:
+        print str(err)
         usage()
-    else:
-        dev = sys.argv[1]
-        if len(sys.argv) > 2:
-            dbfile = sys.argv[2]
+
+    if len(args) < 1:
+        usage()
+
+    commitinterval = CurrentCostIngestionWriter.commitInterval
+    statsinterval = CurrentCostIngestionDaemon.statsInterval
+    statsfile = None
+    debug = False
+    mqttaddress = None
+    mqtttopic = 'CurrentCost'
+    mqttqos = 0
+    try:
+        for opt, arg in options:
+            if opt == '--commit-interval':
+                commitinterval = float(arg)
+            elif opt == '--stats-interval':
+                statsinterval = float(arg)
+            elif opt == '--stats-file':
+                statsfile = arg
+            elif opt == '--debug':
+                debug = True
+            elif opt == '--mqtt':
+                mqttaddress = arg
+            elif opt == '--mqtt-topic':
+                mqtttopic = arg
+            elif opt == '--mqtt-qos':
+                mqttqos = int(arg)
+            elif opt in ('-h', '--help'):
+                usage()
+    except ValueError, err:
+        print str(err)
+        usage()
+
+    meters = []
+    for meter in args[0].split(','):
+        if meter.find('=') != -1:
+            dev, meterid = meter.split('=', 1)
         else:
-            #use file from currentcostgui
-            c = open("currentcost.dat")
-            dbfile = c.readline()
+            dev, meterid = meter, meter
+        meters.append((dev, meterid))
+    if len(args) > 1:
+        dbfile = args[1]
+    else:
+        #use file from currentcostgui
+        c = open("currentcost.dat")
+        dbfile = c.readline().strip()
+        c.close()
+
+    trc.EnableTrace(debug)
+    trc.InitialiseTraceFile()
+
+    # the data is only tagged with a meter id if there is more than one meter
+    #  - data from a single meter is stored where the GUI will find it
+    if len(meters) == 1:
+        meters = [ (meters[0][0], None) ]
+
+    # check that the db file can be used, and create any missing tables, 
+    #  before any data is received
     db = CurrentCostDB()
     db.InitialiseDB(dbfile)
-    s = serial.Serial(dev,  baudrate=57600)
-    try:
-        run(s, db)
-    finally:
-        #print db.GetMonthDataCollection()
-        #print db.GetDayDataCollection()
-        #print db.GetHourDataCollection()
-        db.CloseDB()
-        s.close()
-   
+    db.CloseDB()
+
+    writer = CurrentCostIngestionWriter(dbfile)
+    writer.commitInterval = commitinterval
+
+    daemons = []
+    for dev, meterid in meters:
+        republisher = None
+        if mqttaddress != None:
+            if meterid == None:
+                republisher = CurrentCostMQTTRepublisher(mqttaddress, mqtttopic, mqttqos)
+            else:
+                republisher = CurrentCostMQTTRepublisher(mqttaddress, mqtttopic + '/' + meterid, mqttqos)
+        daemons.append(CurrentCostIngestionDaemon(dev, writer, meterid, republisher))
 
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopDaemons(daemons))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopDaemons(daemons))
+    runDaemons(daemons, writer, statsinterval, statsfile)
@@ -19,30 +19,60 @@
 #  The author of this code can be contacted at Dale.Lane@gmail.com
 #    Any contact about this application is warmly welcomed.
 #
-import urllib
-import urllib2
 import time
 
+from currentcostwebfetch import getWebFetcher
+
 
 #
 #  Screen-scapes the National Grid website to get data about the national
 #   electricity demand
 # 
+#  The webpage is downloaded by a shared fetcher (see currentcostwebfetch.py)
+#   which is polled every POLL_INTERVAL seconds. Use startUpdates to be 
+#   given the HTML whenever it changes, rather than downloading it in a loop.
+# 
 #  Dale Lane (http://dalelane.co.uk/blog)
 # 
 class NationalGridDataSource():
 
+    REALTIME_URL = 'http://www.nationalgrid.com/ngrealtime/realtime/systemdata.aspx'
+
+    # time (seconds) between requests for the realtime demand data - the 
+    #  webpage is only updated every few minutes
+    POLL_INTERVAL = 60
+
+    fetcher = None
+
+    def __init__(self, url=None, interval=None):
+        if url == None:
+            url = self.REALTIME_URL
+        if interval == None:
+            interval = self.POLL_INTERVAL
+        self.fetcher = getWebFetcher(url, interval)
+
     #
     # get the HTML for the realtime demand data webpage
     # 
+    #  the webpage is only downloaded if the last copy is older than the poll
+    #   interval (or the fetcher isn't running and is due to poll), so 
+    #   calling this repeatedly doesn't hammer the website
+    # 
     def DownloadRealtimeHTML(self):
-        try:
-            post_req = urllib2.Request('http://www.nationalgrid.com/ngrealtime/realtime/systemdata.aspx')
-            post_resp = urllib2.urlopen(post_req)
-            post_resp_body = post_resp.read()
-            return post_resp_body
-        except Exception, exc:
+        post_resp_body = self.fetcher.getContent()
+        if post_resp_body == None:
             return 'Unable to download HTML from National Grid'
+        return post_resp_body
+
+    #
+    # pass the HTML for the realtime demand data webpage to a subscriber 
+    #  whenever it changes - see currentcostwebfetch for the methods called
+    # 
+    def startUpdates(self, subscriber):
+        self.fetcher.addSubscriber(subscriber)
+
+    def stopUpdates(self, subscriber):
+        self.fetcher.removeSubscriber(subscriber)
 
     #
     # get the demand (int) and frequency (float) values from the provided HTML
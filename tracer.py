@@ -21,27 +21,69 @@
 #
 
 import logging
-import numpy
-import scipy
-import matplotlib
+import logging.handlers
+import threading
+import collections
+import atexit
+import time
+import math
+import sys
 import platform
-import wx
-from pysqlite2 import dbapi2 as sqlite
 
 from time import strftime
 
 #
 # A class to collect debug and trace information.
 #
+#  Trace is written to file by a single background thread, so that threads 
+#   which read from the CurrentCost meter only have to add a message to a 
+#   queue - they never wait for the disk. 
+# 
+#  The queue is bounded: if messages arrive faster than they can be written, 
+#   the oldest are dropped (and a count of how many were dropped is written 
+#   to the file) rather than slowing down the threads that produce them.
+# 
+#  The file is rotated when it reaches TRACE_FILE_MAX_BYTES.
+#
+#  FunctionEntry and FunctionExit mark the start and end of a span. Each 
+#   thread has its own stack of spans (used to indent the trace it writes). 
+#   If metrics are enabled, the duration of each span is recorded so that 
+#   a summary of where time is going can be requested with 
+#   GetMetricsSnapshot or DumpMetrics.
+#
 #
 #  Dale Lane (http://dalelane.co.uk/blog)
 # 
 
-enableTrace = False
+enableTrace   = False
+enableMetrics = False
+
+# the spans that each thread is currently in, and the string used to indent 
+#  the trace that it writes
+traceLocal = threading.local()
 
-# used for indenting trace
-stackDepth = 0
-indentStr  = ""
+TRACE_FILE_NAME      = 'currentcostdiagnostics.log'
+TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_FILE_BACKUPS   = 3
+TRACE_QUEUE_SIZE     = 10000
+
+# messages waiting to be written - as (time, level, message) tuples
+traceQueue   = collections.deque(maxlen=TRACE_QUEUE_SIZE)
+traceLock    = threading.Lock()
+traceWaiting = threading.Event()
+# number of messages dropped because the queue was full - only updated 
+#  while holding traceLock
+traceDropped = 0
+# the background thread writing the queue to file, and where it writes to
+traceWriter  = None
+traceLogger  = logging.getLogger('currentcost')
+
+# number of span durations kept for each function to calculate percentiles
+METRICS_SAMPLE_SIZE = 1000
+
+# span durations for each function name - as SpanMetrics objects
+spanMetrics = {}
+metricsLock = threading.Lock()
 
 class CurrentCostTracer():
 
@@ -52,59 +94,360 @@ class CurrentCostTracer():
         global enableTrace
         return enableTrace
 
+    def EnableMetrics(self, val):
+        global enableMetrics
+        enableMetrics = val
+    def IsMetricsEnabled(self):
+        global enableMetrics
+        return enableMetrics
+
     def InitialiseTraceFile(self):
-        global enableTrace, stackDepth, indentStr
+        global enableTrace
 
-        logging.basicConfig(level=logging.DEBUG,
-                            format='%(asctime)s %(message)s',
-                            filename='currentcostdiagnostics.log',
-                            filemode='w+')
+        startTraceWriter()
 
         if enableTrace == True:
-            stackDepth = 0
-            indentStr  = ""
+            traceLocal.spans = []
+            traceLocal.indentStr = ""
     
-            logging.info("CurrentCost software - v 0.9.30")
-            logging.info("-------------------------------")
-            logging.info("python     : version " + repr(platform.python_version()))
-            logging.info("numpy      : version " + repr(numpy.version.version))
-            logging.info("scipy      : version " + repr(scipy.version.version))
-            logging.info("matplotlib : version " + repr(matplotlib.__version__))
-            logging.info("wxpython   : version " + repr(wx.version()))
-            logging.info("sqlite     : version " + repr(sqlite.version))
-
-
-    def Trace(self, debuginfo):
-        global enableTrace, indentStr
+            writeTrace(logging.INFO, "CurrentCost software - v 0.9.30")
+            writeTrace(logging.INFO, "-------------------------------")
+            writeTrace(logging.INFO, "python     : version " + repr(platform.python_version()))
+            for name, version in getLibraryVersions():
+                writeTrace(logging.INFO, "%-10s : %s" % (name, version))
+
+    #
+    # number of trace messages that have been dropped because they were 
+    #  produced faster than they could be written
+    # 
+    def GetDroppedTraceCount(self):
+        global traceDropped
+        return traceDropped
+
+
+    #
+    # trace and error info can be provided as:
+    #   a string 
+    #   a format string, followed by the values to format into it
+    #   a function which returns the string
+    # 
+    #  format strings and functions are only evaluated if the info is going to
+    #   be written, so expensive descriptions (e.g. str() of a large structure)
+    #   should be provided this way - to avoid the cost when trace is disabled
+    # 
+    #  code in hot paths can check the module-level enableTrace flag directly
+    #   (e.g. 'if tracer.enableTrace:') to avoid even the function call
+    # 
+    def Trace(self, debuginfo, *args):
+        global enableTrace
         if enableTrace == True:
-            logging.debug("DEBUG " + indentStr + " " + debuginfo)
+            writeTrace(logging.DEBUG, "DEBUG " + getIndentString() + " " + formatTraceInfo(debuginfo, args))
 
-    def Error(self, errorinfo):
-        global enableTrace, indentStr        
-        logging.error("ERROR " + indentStr + " " + errorinfo)
+    def Error(self, errorinfo, *args):
+        writeTrace(logging.ERROR, "ERROR " + getIndentString() + " " + formatTraceInfo(errorinfo, args))
 
 
 
     def FunctionEntry(self, functionname):
-        global enableTrace, indentStr, stackDepth
-        if enableTrace == True:
-            stackDepth += 1
-    
-            logging.info("ENTRY " + indentStr + " " + functionname)
-    
+        global enableTrace, enableMetrics
+        if enableTrace or enableMetrics:
+            spans = getSpans()
+            if enableTrace:
+                writeTrace(logging.INFO, "ENTRY " + getIndentString() + " " + functionname)
+            spans.append((functionname, time.time()))
             self.prepareIndentString()
 
     def FunctionExit(self, functionname):
-        global enableTrace, indentStr, stackDepth
-        if enableTrace == True:
-            stackDepth -= 1
+        global enableTrace, enableMetrics
+        if enableTrace or enableMetrics:
+            endtime = time.time()
+            spans = getSpans()
+            # functions which return without calling FunctionExit leave spans
+            #  on the stack - these are closed along with the function that
+            #  called them. an exit without a matching entry (e.g. made 
+            #  before trace was enabled) is ignored
+            for i in range(len(spans) - 1, -1, -1):
+                if spans[i][0] == functionname:
+                    starttime = spans[i][1]
+                    del spans[i:]
+                    if enableMetrics:
+                        recordSpan(functionname, endtime - starttime)
+                    break
             self.prepareIndentString()
-    
-            logging.info("EXIT  " + indentStr + " " + functionname)
+            if enableTrace:
+                writeTrace(logging.INFO, "EXIT  " + getIndentString() + " " + functionname)
 
 
     def prepareIndentString(self):
-        global indentStr, stackDepth
-        indentStr = ""
-        for i in range(0, stackDepth):
-            indentStr += "  "
+        traceLocal.indentStr = "  " * len(getSpans())
+
+
+    #
+    # a summary of span durations for each function, as a dictionary of 
+    #  function name to a dictionary of 'count', 'total', 'p50', 'p95' and
+    #  'max' (durations in seconds)
+    # 
+    #  percentiles are calculated from the most recent METRICS_SAMPLE_SIZE 
+    #   spans for each function
+    # 
+    def GetMetricsSnapshot(self):
+        global spanMetrics, metricsLock
+        snapshot = {}
+        metricsLock.acquire()
+        try:
+            for functionname, metrics in spanMetrics.iteritems():
+                snapshot[functionname] = metrics.summary()
+        finally:
+            metricsLock.release()
+        return snapshot
+
+    #
+    # write a table of the current metrics to the trace file (regardless of 
+    #  whether trace is enabled), sorted by the total time spent in each 
+    #  function. the table is also returned as a string
+    # 
+    def DumpMetrics(self):
+        snapshot = self.GetMetricsSnapshot()
+        lines = [ "%-55s %8s %10s %10s %10s %10s" % ("span", "count", "total ms", "p50 ms", "p95 ms", "max ms") ]
+        for functionname, summary in sorted(snapshot.items(), key=lambda item: item[1]['total'], reverse=True):
+            lines.append("%-55s %8d %10.1f %10.2f %10.2f %10.2f" % (functionname, summary['count'], 
+                                                                   summary['total'] * 1000, summary['p50'] * 1000, 
+                                                                   summary['p95'] * 1000, summary['max'] * 1000))
+        for line in lines:
+            writeTrace(logging.INFO, "METRIC " + line)
+        return "\n".join(lines)
+
+    def ResetMetrics(self):
+        global spanMetrics, metricsLock
+        metricsLock.acquire()
+        spanMetrics = {}
+        metricsLock.release()
+
+
+#
+# prepare a string to be written to the trace file from info provided to 
+#  Trace or Error
+# 
+def formatTraceInfo(info, args):
+    if callable(info):
+        info = info()
+    if len(args) > 0:
+        try:
+            info = info % args
+        except (TypeError, ValueError):
+            # not a format string - just append the values
+            info = " ".join([str(info)] + [str(arg) for arg in args])
+    return str(info)
+
+
+#
+# versions of the libraries used by the application, to include in the 
+#  trace file
+# 
+#  tracer is imported by every module, so it doesn't import these libraries 
+#   itself - that would make command-line tools which don't need them (e.g.
+#   import-data-envir.py) slow to start, and require them to be installed. 
+#   Only libraries which the application has already imported are reported.
+# 
+LIBRARY_VERSIONS = [ ('numpy',      'numpy',            lambda module: module.version.version),
+                     ('scipy',      'scipy',            lambda module: module.version.version),
+                     ('matplotlib', 'matplotlib',       lambda module: module.__version__),
+                     ('wxpython',   'wx',               lambda module: module.version()),
+                     ('sqlite',     'pysqlite2.dbapi2', lambda module: module.version) ]
+
+def getLibraryVersions():
+    versions = []
+    for name, modulename, getversion in LIBRARY_VERSIONS:
+        module = sys.modules.get(modulename)
+        if module == None:
+            versions.append((name, "not loaded"))
+        else:
+            try:
+                versions.append((name, "version " + repr(getversion(module))))
+            except Exception:
+                versions.append((name, "version unknown"))
+    return versions
+
+
+#
+# the stack of spans for the current thread, and the string to indent its 
+#  trace with
+# 
+def getSpans():
+    try:
+        return traceLocal.spans
+    except AttributeError:
+        traceLocal.spans = []
+        return traceLocal.spans
+
+def getIndentString():
+    try:
+        return traceLocal.indentStr
+    except AttributeError:
+        return ""
+
+
+#
+# durations recorded for spans of a single function
+# 
+class SpanMetrics():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+        self.samples = collections.deque(maxlen=METRICS_SAMPLE_SIZE)
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.samples.append(duration)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return { 'count' : self.count,
+                 'total' : self.total,
+                 'p50'   : percentile(samples, 50),
+                 'p95'   : percentile(samples, 95),
+                 'max'   : self.max }
+
+def recordSpan(functionname, duration):
+    global spanMetrics, metricsLock
+    metricsLock.acquire()
+    try:
+        metrics = spanMetrics.get(functionname)
+        if metrics == None:
+            metrics = SpanMetrics()
+            spanMetrics[functionname] = metrics
+        metrics.record(duration)
+    finally:
+        metricsLock.release()
+
+# nearest-rank percentile of an already sorted list
+def percentile(samples, pct):
+    if len(samples) == 0:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+
+#
+# add a message to the queue of trace waiting to be written
+# 
+#  this never blocks - if the queue is full, the oldest message is dropped
+# 
+#  until the trace file has been initialised, messages are passed straight 
+#   to the logging module
+# 
+def writeTrace(level, message):
+    global traceQueue, traceLock, traceDropped, traceWriter
+    if traceWriter == None:
+        logging.log(level, message)
+        return
+    traceLock.acquire()
+    try:
+        if len(traceQueue) == TRACE_QUEUE_SIZE:
+            traceDropped += 1
+        traceQueue.append((time.time(), level, message))
+    finally:
+        traceLock.release()
+    traceWaiting.set()
+
+
+#
+# start the background thread which writes trace to file
+# 
+#  the file is replaced each time the application starts, and rotated when 
+#   it gets too big
+# 
+def startTraceWriter():
+    global traceWriter, traceLogger
+    if traceWriter != None:
+        return
+
+    open(TRACE_FILE_NAME, 'w').close()
+    handler = logging.handlers.RotatingFileHandler(TRACE_FILE_NAME, 
+                                                   maxBytes=TRACE_FILE_MAX_BYTES, 
+                                                   backupCount=TRACE_FILE_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    traceLogger.addHandler(handler)
+    traceLogger.setLevel(logging.DEBUG)
+    traceLogger.propagate = False
+
+    traceWriter = TraceWriterThread()
+    traceWriter.start()
+    atexit.register(stopTraceWriter)
+    # threads are not copied into child processes (e.g. the workers used to 
+    #  render reports), so they need to start a writer thread of their own 
+    import multiprocessing.util
+    multiprocessing.util.register_after_fork(traceLogger, restartTraceWriter)
+
+
+def restartTraceWriter(logger):
+    global traceWriter
+    traceWriter = TraceWriterThread()
+    traceWriter.start()
+
+
+#
+# stop the background writer thread, after writing everything still queued
+# 
+def stopTraceWriter():
+    global traceWriter
+    if traceWriter == None:
+        return
+    traceWriter.stopped = True
+    traceWaiting.set()
+    traceWriter.join()
+    traceWriter = None
+    for handler in traceLogger.handlers:
+        handler.flush()
+
+
+class TraceWriterThread(threading.Thread):
+    stopped = False
+    # number of dropped messages already reported in the trace file
+    reportedDropped = 0
+
+    def __init__(self):
+        global traceDropped
+        threading.Thread.__init__(self, name='CurrentCostTraceWriter')
+        self.setDaemon(True)
+        self.reportedDropped = traceDropped
+
+    def run(self):
+        while True:
+            traceWaiting.wait()
+            traceWaiting.clear()
+            self.writeQueuedTrace()
+            if self.stopped:
+                self.writeQueuedTrace()
+                return
+
+    def writeQueuedTrace(self):
+        global traceQueue, traceLock, traceDropped
+        while True:
+            traceLock.acquire()
+            try:
+                if len(traceQueue) == 0:
+                    break
+                timestamp, level, message = traceQueue.popleft()
+                dropped = traceDropped
+            finally:
+                traceLock.release()
+            if dropped != self.reportedDropped:
+                self.writeRecord(timestamp, logging.WARNING, 
+                                 "WARN  " + str(dropped - self.reportedDropped) + 
+                                 " trace messages dropped")
+                self.reportedDropped = dropped
+            self.writeRecord(timestamp, level, message)
+
+    def writeRecord(self, timestamp, level, message):
+        global traceLogger
+        # the record is given the time the message was traced, rather than 
+        #  the time it is written
+        record = traceLogger.makeRecord(traceLogger.name, level, '', 0, message, None, None)
+        record.created = timestamp
+        record.msecs = (timestamp - long(timestamp)) * 1000
+        traceLogger.handle(record)